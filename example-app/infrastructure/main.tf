@@ -264,7 +264,9 @@ module "utilities-regional-primary" {
   source = "../../modules/utilities-regional"
 
   # Project definition vars
-  project-name = var.project-name
+  project-name    = var.project-name
+  account-primary = data.aws_caller_identity.primary.account_id
+  region-primary  = var.region-primary
 
   # Tag config
   resource-tags = var.resource-tags
@@ -278,7 +280,9 @@ module "utilities-regional-secondary" {
   }
 
   # Project definition vars
-  project-name = var.project-name
+  project-name    = var.project-name
+  account-primary = data.aws_caller_identity.primary.account_id
+  region-primary  = var.region-primary
 
   # Tag config
   resource-tags = var.resource-tags
@@ -317,7 +321,9 @@ module "utilities-regional-second-account-main-region" {
   }
 
   # Project definition vars
-  project-name = var.project-name
+  project-name    = var.project-name
+  account-primary = data.aws_caller_identity.primary.account_id
+  region-primary  = var.region-primary
 
   # Tag config
   resource-tags = var.resource-tags
@@ -2,15 +2,26 @@
 
 import logging
 import sys
+from datetime import timedelta
 from time import strftime
 
-import boto3
-from flask import Flask, request
+from botocore.exceptions import ClientError
+from flask import Flask, g, request
 from flask_cors import CORS
 
 from backend import commands, views
 from backend.aws_utils import AwsUtils
 from backend.exceptions import BaseQuailException
+from backend.idempotency import (
+    COMPLETED_STATUS,
+    DynamoDBIdempotencyStore,
+    InMemoryIdempotencyStore,
+    get_request_fingerprint,
+    get_task_token_key,
+)
+from backend.json_utils import FastJSONProvider
+from backend.listing_cache import ListingCache
+from backend.provisioning_queue import DynamoDBProvisioningQueue, InMemoryProvisioningQueue
 
 
 def create_base_app(config_object):
@@ -20,6 +31,7 @@ def create_base_app(config_object):
     """
     app = Flask(__name__.split(".")[0], static_folder=None)
     app.config.from_object(config_object)
+    app.json = FastJSONProvider(app)
 
     register_errorhandlers(app)
     register_hooks(app)
@@ -28,6 +40,8 @@ def create_base_app(config_object):
     register_routes(app)
     configure_logger(app)
     configure_aws_utils(app)
+    configure_provisioning_queue(app)
+    configure_idempotency_store(app)
 
     return app
 
@@ -84,14 +98,82 @@ def register_hooks(app):
         )
         return response
 
+    @app.before_request
+    def reset_request_cache():
+        # flask.g lives as long as the app context, which can be shared by several requests, e.g. in the tests
+        g.pop("request_cache", None)
+
+    @app.after_request
+    def request_cache_logger(response):
+        # Hit and miss counts of the reads memoized by the request, if it made any
+        cache = g.get("request_cache")
+        if cache:
+            app.logger.info("Request cache: %s hits, %s misses", cache.hits, cache.misses)
+        return response
+
+    @app.before_request
+    def task_token_ledger():
+        # Step Functions retries replay the whole request, record each task token on its first
+        # request and answer the replays with the recorded output instead of running the view again
+        task_token = request.headers.get("TaskToken")
+        if not task_token:
+            return None
+
+        key = get_task_token_key(task_token)
+        record = app.idempotency_store.claim(key=key, fingerprint=get_request_fingerprint())
+        if not record:
+            g.task_token_key = key
+            return None
+
+        if record["status"] != COMPLETED_STATUS:
+            # The first request is still running, it sends the callback
+            app.logger.info("task_token_ledger: request for the task token in progress")
+            g.defer_task_callback = True
+            return {}, 202
+
+        # The callback of the first request may have been lost, it's sent again with the recorded output
+        app.logger.info("task_token_ledger: replaying the recorded output of the task token")
+        g.task_token_replay = True
+        recorded = record["response"]
+        return app.response_class(recorded["body"], status=recorded["status_code"], mimetype=recorded["mimetype"])
+
+    @app.teardown_request
+    def task_token_releaser(error):
+        # The key is still held if the request failed before step_function_notifier or the error handlers
+        # completed or released it, let a replay run the view again
+        # flask.g can outlive the request, e.g. in the tests, the flags only apply to this one
+        g.pop("defer_task_callback", None)
+        g.pop("task_token_replay", None)
+        task_token_key = g.pop("task_token_key", None)
+        if task_token_key:
+            app.logger.info(f"task_token_releaser: releasing the task token of a failed request: {error}")
+            app.idempotency_store.release(key=task_token_key)
+
     @app.after_request
     def step_function_notifier(response):
         # If the API is invoked by step functions and the request succeeds
-        # send a success signal
+        # send a success signal, unless the view deferred it to be sent later
         task_token = request.headers.get("TaskToken")
-        if task_token and 200 <= response.status_code < 300:
-            sfn_client = boto3.client("stepfunctions")
-            sfn_client.send_task_success(taskToken=task_token, output=response.get_data(as_text=True))
+        task_token_key = g.pop("task_token_key", None)
+        if task_token and 200 <= response.status_code < 300 and not g.get("defer_task_callback"):
+            output = response.get_data(as_text=True)
+            if task_token_key:
+                # Recorded before sending, a replay resends the output if the callback is lost
+                app.idempotency_store.complete(
+                    key=task_token_key,
+                    response={"status_code": response.status_code, "body": output, "mimetype": response.mimetype},
+                )
+
+            try:
+                app.aws.send_task_success(task_token=task_token, output=output)
+            except ClientError as e:
+                if not g.get("task_token_replay"):
+                    raise
+                # The callback of the first request went through, the task is already closed
+                app.logger.info(f"step_function_notifier: replayed callback not delivered: {e}")
+        elif task_token_key:
+            # Deferred or unsuccessful, let a replay run the view again
+            app.idempotency_store.release(key=task_token_key)
 
         return response
 
@@ -114,9 +196,12 @@ def register_errorhandlers(app):
                 error.__class__.__name__,
                 error.message if hasattr(error, "message") else "Internal Server Error",
             )
-            sfn_client = boto3.client("stepfunctions")
-            sfn_client.send_task_failure(
-                taskToken=task_token,
+            task_token_key = g.pop("task_token_key", None)
+            if task_token_key:
+                app.idempotency_store.release(key=task_token_key)
+
+            app.aws.send_task_failure(
+                task_token=task_token,
                 error=error.__class__.__name__,
                 cause=error.message if hasattr(error, "message") else "Internal Server Error",
             )
@@ -174,8 +259,21 @@ def configure_aws_utils(app):
         permissions_table_name=app.config["DYNAMODB_PERMISSIONS_TABLE_NAME"],
         regional_data_table_name=app.config["DYNAMODB_REGIONAL_METADATA_TABLE_NAME"],
         state_table_name=app.config["DYNAMODB_STATE_TABLE_NAME"],
+        stackset_pool_table_name=app.config["DYNAMODB_STACKSET_POOL_TABLE_NAME"],
+        stackset_pool_max_size=app.config["STACKSET_POOL_MAX_SIZE"],
+        user_counters_table_name=app.config["DYNAMODB_USER_COUNTERS_TABLE_NAME"],
+        tombstones_table_name=app.config["DYNAMODB_STATE_TOMBSTONES_TABLE_NAME"],
+        tombstone_ttl=timedelta(seconds=app.config["STATE_TOMBSTONE_TTL"]),
         cross_account_role_name=app.config["CROSS_ACCOUNT_ROLE_NAME"],
         admin_group_name=app.config["ADMIN_GROUP_NAME"],
+        operation_preferences={
+            "CREATE": app.config["STACKSET_CREATE_OPERATION_PREFERENCES"],
+            "UPDATE": app.config["STACKSET_UPDATE_OPERATION_PREFERENCES"],
+            "DELETE": app.config["STACKSET_DELETE_OPERATION_PREFERENCES"],
+        },
+        metrics_namespace=app.config["PROJECT_NAME"],
+        operation_timeout=timedelta(seconds=app.config["STACKSET_OPERATION_TIMEOUT"]),
+        listing_cache=ListingCache(maxsize=app.config["LISTING_CACHE_MAX_SIZE"], ttl=app.config["LISTING_CACHE_TTL"]),
         provision_sfn_arn=app.config["PROVISION_SFN_ARN"],
         cleanup_sfn_arn=app.config["CLEANUP_SFN_ARN"],
         update_sfn_arn=app.config["UPDATE_SFN_ARN"],
@@ -185,3 +283,28 @@ def configure_aws_utils(app):
         admin_role_arn=app.config["STACK_SET_ADMIN_ROLE_ARN"],
         logger=app.logger,
     )
+
+
+def configure_provisioning_queue(app):
+    if app.config["PROVISIONING_QUEUE_TABLE_NAME"]:
+        app.provisioning_queue = DynamoDBProvisioningQueue(
+            table_name=app.config["PROVISIONING_QUEUE_TABLE_NAME"],
+            max_in_flight_per_account=app.config["PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT"],
+        )
+    else:
+        # Without a table, e.g. in tests, the queue is kept in memory
+        app.provisioning_queue = InMemoryProvisioningQueue(
+            max_in_flight_per_account=app.config["PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT"],
+        )
+
+
+def configure_idempotency_store(app):
+    ttl = timedelta(seconds=app.config["IDEMPOTENCY_KEY_TTL"])
+    lease = timedelta(seconds=app.config["IDEMPOTENCY_IN_PROGRESS_LEASE"])
+    if app.config["IDEMPOTENCY_TABLE_NAME"]:
+        app.idempotency_store = DynamoDBIdempotencyStore(
+            table_name=app.config["IDEMPOTENCY_TABLE_NAME"], ttl=ttl, lease=lease
+        )
+    else:
+        # Without a table, e.g. in tests, the keys are kept in memory
+        app.idempotency_store = InMemoryIdempotencyStore(ttl=ttl, lease=lease)
@@ -1,24 +1,37 @@
 from uuid import uuid4
 from enum import Enum
-import json
 import random
 from collections import defaultdict
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import perf_counter, time
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from cachetools import cached, TTLCache
 
+from backend import json_utils
 from backend.exceptions import (
     InvalidArgumentsError,
     PermissionsMissing,
     StackSetExecutionInProgressException,
     StackSetUpdateInProgressException,
     InvalidApplicationState,
+    SyncTokenExpiredError,
+    UnauthorizedForInstanceError,
 )
+from backend.request_cache import get_request_cache
+from backend.state_records import STATE_TABLE_CODEC
 
 # StackSet operations incomplete statuses
 # All listed under https://docs.aws.amazon.com/AWSCloudFormation/latest/APIReference/API_StackSetOperationSummary.html
 STACKSET_UPDATING_STATUS = "RUNNING"
 STACKSET_OPERATION_INCOMPLETE_STATUSES = {"QUEUED", "RUNNING", "STOPPING"}
+STACKSET_OPERATION_SUCCESS_STATUS = "SUCCEEDED"
 # Stack Instance Statuses
 # All listed under https://docs.aws.amazon.com/AWSCloudFormation/latest/APIReference/API_StackInstanceSummary.html
 SYNCHRONIZED_STATUS = "CURRENT"
@@ -41,6 +54,112 @@ INSTANCES_STACK_STATUSES = {
 
 EC2_INSTANCE_PENDING_STATE = "pending"
 EC2_INSTANCE_FINAL_STATES = {"running", "stopped"}
+EC2_INSTANCE_STOPPING_STATE = "stopping"
+EC2_INSTANCE_STOPPED_STATE = "stopped"
+
+# Resources backing a single instance stackset, stable for the lifetime of the stackset
+STACKSET_TOPOLOGY_KEYS = ("account_id", "region", "stack_id", "instance_id")
+
+# Maximum number of AWS API calls made concurrently when checking several resources
+MAX_CONCURRENT_REQUESTS = 8
+# Stacksets enriched with their EC2 state at a time by the export, within the 200 values of a DescribeInstances filter
+EXPORT_BATCH_SIZE = 200
+# Columns of the export, the serialized state entries without the task tokens, and the live EC2 state
+EXPORT_FIELDS = (
+    "stackset_id",
+    "expiry",
+    "extension_count",
+    "username",
+    "email",
+    "group",
+    "account",
+    "instance_name",
+    "instance_status",
+    "instance_type",
+    "operating_system",
+    "private_ip",
+    "region",
+    "connection_protocol",
+    "instance_id",
+    "availability_zone",
+    "fleet_id",
+    "pool_key",
+    "operation_id",
+    "template_file",
+    "updated_at",
+    "ec2_state",
+)
+
+# Fields of the state entries read to extend an instance's expiry, and to delete or recycle a stackset
+STATE_EXTENSION_FIELDS = ("email", "group", "expiry", "extension_count")
+STATE_DELETION_FIELDS = ("email", "pool_key", "template_file")
+
+# Global secondary index of the state table, keyed by the EC2 instance ID
+STATE_TABLE_INSTANCE_ID_INDEX = "instanceId-index"
+# Sparse index over the state table, only the unclaimed warm pool stacksets carry a poolKey
+STATE_TABLE_POOL_KEY_INDEX = "poolKey-index"
+# Index over the state table keyed by the owner's email and sorted by the expiry
+STATE_TABLE_EMAIL_INDEX = "email-expiry-index"
+# Index over the state table keyed by the owner's email and sorted by the last update
+STATE_TABLE_UPDATED_AT_INDEX = "email-updatedAt-index"
+# Sync tokens lag behind the time of the read, to pick up the writes stamped before it but committed after it
+SYNC_TOKEN_OVERLAP = timedelta(seconds=10)
+# DynamoDB accepts up to 100 actions in a single TransactWriteItems or BatchGetItem call
+DYNAMODB_TRANSACTION_LIMIT = 100
+DYNAMODB_BATCH_GET_LIMIT = 100
+DYNAMODB_BATCH_WRITE_LIMIT = 25
+
+# StackSet operation actions, as reported by DescribeStackSetOperation
+STACKSET_CREATE_ACTION = "CREATE"
+STACKSET_UPDATE_ACTION = "UPDATE"
+STACKSET_DELETE_ACTION = "DELETE"
+# Let StackSets queue conflicting operations instead of rejecting them, e.g. the creation
+# of the stack instance right after the parameters of a recycled stackset are updated
+STACKSET_MANAGED_EXECUTION = {"Active": True}
+# Number of listing cache lookups between two reports of its hit rate and size
+LISTING_CACHE_METRICS_INTERVAL = 100
+# Seconds during which the permissions and regional parameters are assumed unchanged
+PERMISSIONS_SNAPSHOT_TTL = 600
+# Attempts at a conditional write on a state entry that keeps being changed in between
+CONDITIONAL_WRITE_ATTEMPTS = 3
+# Task callbacks are retried with backoff on throttling and transient errors, and don't wait long on a slow endpoint
+TASK_CALLBACK_CLIENT_CONFIG = Config(
+    retries={"max_attempts": 5, "mode": "standard"}, connect_timeout=2, read_timeout=5, max_pool_connections=10
+)
+# Timestamp format ordering the instance status updates. EventBridge events only have whole seconds, the statuses
+# written by the app have microseconds: a stale event of the same second as a request sorts before it
+EVENT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def chunks(items, size):
+    """Split a list into consecutive lists of at most `size` items."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def get_update_stamp():
+    # Value of the updatedAt attribute of the state entries, ordered the same way as strings
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+def format_event_time(time):
+    # Value of the instanceStatusTime attribute of the state entries, ordered the same way as strings
+    return time.astimezone(timezone.utc).strftime(EVENT_TIME_FORMAT)
+
+
+def get_permissions_snapshot_version():
+    # Changes with every permissions snapshot period, responses depending on the permissions are revalidated with it
+    return int(time() // PERMISSIONS_SNAPSHOT_TTL)
+
+
+# Email and username of the warm pool instances until they are claimed, they're listed for and notified to no one
+WARM_POOL_OWNER = "warm-pool"
+
+
+def warm_pool_key(group, operating_system, account, region, instance_type):
+    # Identifies the warm pool holding the stopped instances of a given configuration
+    return "#".join([group, operating_system, account, region, instance_type])
 
 
 class UpdateLevel(Enum):
@@ -54,8 +173,17 @@ class AwsUtils:
         permissions_table_name,
         regional_data_table_name,
         state_table_name,
+        stackset_pool_table_name,
+        stackset_pool_max_size,
+        user_counters_table_name,
+        tombstones_table_name,
+        tombstone_ttl,
         cross_account_role_name,
         admin_group_name,
+        operation_preferences,
+        metrics_namespace,
+        operation_timeout,
+        listing_cache,
         provision_sfn_arn,
         update_sfn_arn,
         error_topic_arn,
@@ -68,6 +196,12 @@ class AwsUtils:
         self.permissions_table_name = permissions_table_name
         self.regional_data_table_name = regional_data_table_name
         self.state_table_name = state_table_name
+        self.stackset_pool_table_name = stackset_pool_table_name
+        self.stackset_pool_max_size = stackset_pool_max_size
+        self.user_counters_table_name = user_counters_table_name
+        self.tombstones_table_name = tombstones_table_name
+        # Age up to which the deletions of state entries are reported to the clients syncing changes
+        self.tombstone_ttl = tombstone_ttl
 
         self.cleanup_sfn_arn = cleanup_sfn_arn
         self.provision_sfn_arn = provision_sfn_arn
@@ -80,14 +214,43 @@ class AwsUtils:
         self.execution_role_name = execution_role_name
         self.admin_role_arn = admin_role_arn
 
+        # StackSet operation action -> OperationPreferences
+        self.operation_preferences = operation_preferences
+        self.metrics_namespace = metrics_namespace
+        # Age after which an operation holding a stackset is considered abandoned
+        self.operation_timeout = operation_timeout
+        # Serialized instance listings of the public API, invalidated by the writes below
+        self.listing_cache = listing_cache
+
         self.logger = logger
 
+        # StackSet ID -> resolved stackset topology
+        self.topology_cache = TTLCache(maxsize=1024, ttl=3600)
+
+        # Created on first use and shared, so that the callbacks reuse its connections
+        self.task_callback_client = None
+        self.task_callback_client_lock = Lock()
+
     def get_claims_list(self, value):
         # Accepts a string representation of a list, returns a python list
         return value[1:-1].split(" ")
 
+    def memoize(self, key, load):
+        # Reads the value once per request, see RequestCache
+        cache = get_request_cache()
+        return load() if cache is None else cache.get(key, load)
+
+    def invalidate_request_reads(self):
+        # Called after writing to the state entries or updating stacksets, for the rest of the request to see it
+        cache = get_request_cache()
+        if cache is not None:
+            cache.invalidate("stackset", "topology")
+
     def get_claims(self, request):
-        context = json.loads(request.headers["X-Amzn-Request-Context"])
+        return self.memoize(("claims",), lambda: self.parse_claims(request=request))
+
+    def parse_claims(self, request):
+        context = json_utils.loads(request.headers["X-Amzn-Request-Context"])
         claims = context["authorizer"]["jwt"]["claims"]
 
         if "email" not in claims or not claims["email"]:
@@ -136,6 +299,11 @@ class AwsUtils:
         return result
 
     def get_permissions_for_one_group(self, group_name):
+        return self.memoize(
+            ("permissions", group_name), lambda: self.read_permissions_for_one_group(group_name=group_name)
+        )
+
+    def read_permissions_for_one_group(self, group_name):
         client = boto3.client("dynamodb")
 
         result = {}
@@ -148,7 +316,7 @@ class AwsUtils:
 
         item = fetched["Item"]
 
-        operating_systems = json.loads(item["operatingSystems"]["S"])
+        operating_systems = json_utils.loads(item["operatingSystems"]["S"])
         region_map = defaultdict(lambda: defaultdict(dict))
         for os_item in operating_systems:
             for account_id in os_item["region-map"].keys():
@@ -178,7 +346,7 @@ class AwsUtils:
                 message=f"The group '{group_name}' does not have any permissions associated with it."
             )
 
-        os_configs = json.loads(fetched["Item"]["operatingSystems"]["S"])
+        os_configs = json_utils.loads(fetched["Item"]["operatingSystems"]["S"])
         result = [config for config in os_configs if config["name"] == os_name]
 
         if not result:
@@ -186,7 +354,7 @@ class AwsUtils:
 
         return result[0]
 
-    @cached(cache=TTLCache(maxsize=1024, ttl=600))
+    @cached(cache=TTLCache(maxsize=1024, ttl=PERMISSIONS_SNAPSHOT_TTL))
     def get_params_for_region(self, account_id, region):
         dynamodb_client = boto3.client("dynamodb")
         regional_data = dynamodb_client.get_item(
@@ -254,51 +422,86 @@ class AwsUtils:
 
         return result
 
-    def provision_stackset(
+    def get_provisioning_input(
         self,
         account,
         region,
         instance_type,
         operating_system,
         expiry,
-        instance_name,
+        instance_names,
         user,
         username,
         email,
         group,
     ):
+        # All the instances are provisioned as part of a single job, tracked by one SFN execution
+        return {
+            "fleet_id": str(uuid4()),
+            "account": account,
+            "region": region,
+            "instance_type": instance_type,
+            "operating_system": operating_system,
+            "expiry": expiry.isoformat(),
+            "instance_names": instance_names,
+            "user": user,
+            "username": username,
+            "email": email,
+            "group": group,
+        }
+
+    def start_provisioning(self, provisioning_input):
         sfn_client = boto3.client("stepfunctions")
         response = sfn_client.start_execution(
             stateMachineArn=self.provision_sfn_arn,
-            input=json.dumps(
+            input=json_utils.dumps(provisioning_input),
+        )
+        return response["executionArn"]
+
+    def request_provisioning_schedule(self, function_name):
+        # Asynchronously invoke the private API scheduler, so that queued requests start without
+        # waiting for its next scheduled run
+        lambda_client = boto3.client("lambda")
+        lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=json_utils.dumps(
                 {
-                    "account": account,
-                    "region": region,
-                    "instance_type": instance_type,
-                    "operating_system": operating_system,
-                    "expiry": expiry.isoformat(),
-                    "instance_name": instance_name,
-                    "user": user,
-                    "username": username,
-                    "email": email,
-                    "group": group,
+                    "resourcePath": "/scheduleProvisioning",
+                    "path": "/scheduleProvisioning",
+                    "httpMethod": "POST",
                 }
             ),
         )
-        return response["executionArn"]
 
-    def monitor_update(self, stackset_id, update_level, operation_id=""):
+    def monitor_update(self, stackset_id, update_level, operation_id="", topology=None):
         # Kick off the SFN that will monitor the running SS and update its
         # state entry when update completes.
+        # The known topology (account_id, region, stack_id, instance_id) is passed along,
+        # so that the monitor doesn't need to look it up on every poll.
+        self.monitor_updates(
+            stacksets=[{"stackset_id": stackset_id, "operation_id": operation_id, **(topology or {})}],
+            update_level=update_level,
+        )
 
+    def monitor_updates(self, stacksets, update_level):
+        # Monitor the update of several stacksets with a single SFN execution.
+        # Stacksets: list of dicts with "stackset_id", and optionally "operation_id" and the topology keys
         sfn_client = boto3.client("stepfunctions")
         sfn_client.start_execution(
             stateMachineArn=self.update_sfn_arn,
-            input=json.dumps(
+            input=json_utils.dumps(
                 {
-                    "stackset_id": stackset_id,
                     "update_level": update_level.value,
-                    "operation_id": operation_id,
+                    "stacksets": [
+                        {
+                            "stackset_id": stackset["stackset_id"],
+                            "update_level": update_level.value,
+                            "operation_id": stackset.get("operation_id") or "",
+                            **{key: stackset.get(key) or "" for key in STACKSET_TOPOLOGY_KEYS},
+                        }
+                        for stackset in stacksets
+                    ],
                 }
             ),
         )
@@ -307,7 +510,7 @@ class AwsUtils:
         sns_client = boto3.client("sns")
         sns_client.publish(
             TopicArn=self.error_topic_arn,
-            Message=json.dumps(
+            Message=json_utils.dumps(
                 {
                     "message": f"Error provisioning the stackset {stackset_id}",
                 }
@@ -315,47 +518,212 @@ class AwsUtils:
         )
 
     def serialize_state_table_row(self, item):
-        def nullable_get(item, key):
-            return item[key]["S"] if key in item else None
-
+        return STATE_TABLE_CODEC.decode_dict(item)
+
+    @staticmethod
+    def get_state_table_reader(fields=None):
+        # Codec decoding the state entries, and the arguments of the read restricting it to their fields.
+        # The stackset ID is always read, None reads the whole entries.
+        if fields is None:
+            return STATE_TABLE_CODEC, {}
+
+        codec = STATE_TABLE_CODEC.project({"stackset_id", *fields})
+        return codec, codec.get_projection()
+
+    def get_all_stacksets(self, fields=None):
+        return list(self.iter_stacksets(fields=fields))
+
+    def iter_stacksets(self, fields=None):
+        # Every state entry, read lazily page by page
+        codec, projection = self.get_state_table_reader(fields=fields)
+        paginator = boto3.client("dynamodb").get_paginator("scan")
+        for page in paginator.paginate(TableName=self.state_table_name, **projection):
+            yield from (codec.decode_dict(item) for item in page["Items"])
+
+    def iter_stackset_records(self, fields=None):
+        # Same as iter_stacksets, as slotted records for the scans that only read the entries
+        codec, projection = self.get_state_table_reader(fields=fields)
+        paginator = boto3.client("dynamodb").get_paginator("scan")
+        for page in paginator.paginate(TableName=self.state_table_name, **projection):
+            yield from (codec.decode(item) for item in page["Items"])
+
+    def get_instance_states(self, account_id, region, instance_ids):
+        # Instance ID -> EC2 state, instances that don't exist anymore are left out instead of failing the call
+        ec2_client = self.get_remote_client(account_id=account_id, region=region, service="ec2")
+        paginator = ec2_client.get_paginator("describe_instances")
         return {
-            "stackset_id": item["stacksetID"]["S"],
-            "expiry": item["expiry"]["S"],
-            "extension_count": int(item["extensionCount"]["N"]),
-            "username": item["username"]["S"],
-            "email": item["email"]["S"],
-            "group": item["group"]["S"],
-            "account": nullable_get(item, "account"),
-            "instance_name": nullable_get(item, "instanceName"),
-            "instance_status": nullable_get(item, "instanceStatus"),
-            "instance_type": nullable_get(item, "instanceType"),
-            "operating_system": nullable_get(item, "operatingSystem"),
-            "private_ip": nullable_get(item, "privateIp"),
-            "region": nullable_get(item, "region"),
-            "connection_protocol": nullable_get(item, "connectionProtocol"),
-            "instance_id": nullable_get(item, "instanceId"),
-            "availability_zone": nullable_get(item, "availabilityZone"),
+            instance["InstanceId"]: instance["State"]["Name"]
+            for page in paginator.paginate(Filters=[{"Name": "instance-id", "Values": instance_ids}])
+            for reservation in page["Reservations"]
+            for instance in reservation["Instances"]
         }
 
-    def get_all_stacksets(self):
+    def iter_instance_export(self, stacksets):
+        """Join the stacksets with the live state of their EC2 instances, one batch at a time.
+
+        The instances of a batch are described concurrently by (account, region), and the batch is yielded
+        before the next one is read, so that memory use doesn't grow with the size of the fleet.
+        """
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            for batch in chunks(stacksets, EXPORT_BATCH_SIZE):
+                region_to_instances = defaultdict(list)
+                for stackset in batch:
+                    if stackset["instance_id"]:
+                        region_to_instances[(stackset["account"], stackset["region"])].append(stackset["instance_id"])
+
+                states = {}
+                for region_states in executor.map(
+                    lambda key: self.get_instance_states(
+                        account_id=key[0], region=key[1], instance_ids=region_to_instances[key]
+                    ),
+                    region_to_instances,
+                ):
+                    states.update(region_states)
+
+                for stackset in batch:
+                    row = {**stackset, "ec2_state": states.get(stackset["instance_id"])}
+                    yield {field: row[field] for field in EXPORT_FIELDS}
+
+    def get_stacksets_page(self, owner, filters, limit, exclusive_start_key=None, descending=False):
+        """Read a page of the claimed stacksets, of a single owner or of everyone if the owner is None.
+
+        Filters: dict with optional "account", "region", "group", "status", "expiry_from" and "expiry_to".
+        The stacksets of an owner are queried from the email index, sorted by expiry and stackset ID,
+        the others are scanned in the order of the table keys. Either order stays stable across pages.
+        Returns the serialized rows and the key to resume from, None on the last page.
+        """
         dynamodb_client = boto3.client("dynamodb")
-        results = dynamodb_client.scan(
-            TableName=self.state_table_name,
-        )
 
-        return [self.serialize_state_table_row(item) for item in results["Items"]]
+        # Unclaimed warm pool stacksets aren't owned by anyone
+        conditions = ["attribute_not_exists(poolKey)"]
+        names = {}
+        values = {}
+        for attribute, field in [
+            ("account", "account"),
+            ("region", "region"),
+            ("group", "group"),
+            ("instanceStatus", "status"),
+        ]:
+            if filters.get(field):
+                conditions.append(f"#{attribute} = :{attribute}")
+                names[f"#{attribute}"] = attribute
+                values[f":{attribute}"] = {"S": filters[field]}
+
+        # Expiries are compared as ISO 8601 strings
+        expiry_conditions = []
+        if filters.get("expiry_from"):
+            expiry_conditions.append("#expiry >= :expiryFrom")
+            values[":expiryFrom"] = {"S": filters["expiry_from"]}
+        if filters.get("expiry_to"):
+            expiry_conditions.append("#expiry <= :expiryTo")
+            values[":expiryTo"] = {"S": filters["expiry_to"]}
+        if expiry_conditions:
+            names["#expiry"] = "expiry"
+
+        if owner:
+            key_attributes = {"stacksetID", "email", "expiry"}
+            values[":email"] = {"S": owner}
+            if len(expiry_conditions) == 2:
+                expiry_conditions = ["#expiry BETWEEN :expiryFrom AND :expiryTo"]
+            read = partial(
+                dynamodb_client.query,
+                IndexName=STATE_TABLE_EMAIL_INDEX,
+                KeyConditionExpression=" AND ".join(["email = :email", *expiry_conditions]),
+                ScanIndexForward=not descending,
+            )
+        else:
+            key_attributes = {"stacksetID"}
+            conditions.extend(expiry_conditions)
+            read = dynamodb_client.scan
+
+        if exclusive_start_key is not None and (
+            set(exclusive_start_key) != key_attributes or (owner and exclusive_start_key["email"] != {"S": owner})
+        ):
+            raise InvalidArgumentsError(message="The cursor doesn't belong to this listing.")
+
+        # The limit applies before the filter, keep reading until the page is full or the table is exhausted
+        items = []
+        start_key = exclusive_start_key
+        while True:
+            response = read(
+                TableName=self.state_table_name,
+                FilterExpression=" AND ".join(conditions),
+                ExpressionAttributeValues=values,
+                Limit=limit,
+                **({"ExpressionAttributeNames": names} if names else {}),
+                **({"ExclusiveStartKey": start_key} if start_key else {}),
+            )
+            items.extend(response["Items"])
+            start_key = response.get("LastEvaluatedKey")
+            if len(items) >= limit or not start_key:
+                break
+
+        # Resume after the last returned row, rows read past it are read again on the next page
+        next_key = None
+        if len(items) > limit or start_key:
+            items = items[:limit]
+            next_key = {attribute: items[-1][attribute] for attribute in key_attributes}
+
+        return [self.serialize_state_table_row(item) for item in items], next_key
+
+    def get_sync_token(self):
+        # Token to pass to get_stackset_changes, for the changes made after the current read
+        return (datetime.now(timezone.utc) - SYNC_TOKEN_OVERLAP).isoformat(timespec="microseconds")
+
+    def get_stackset_changes(self, owner, since):
+        """Read the claimed stacksets updated, and the IDs of the ones deleted, after the sync token.
+
+        The changes of an owner are queried from the updatedAt index and the tombstones of the owner,
+        the changes of everyone are scanned. Returns the serialized rows, the deleted stackset IDs and the next token.
+        """
+        if since < (datetime.now(timezone.utc) - self.tombstone_ttl).isoformat():
+            raise SyncTokenExpiredError()
 
-    def get_user_stacksets(self, email, permissions, is_superuser):
         dynamodb_client = boto3.client("dynamodb")
-        results = dynamodb_client.scan(
-            TableName=self.state_table_name,
-        )
+        sync_token = self.get_sync_token()
+        values = {":since": {"S": since}}
+
+        if owner:
+            values[":email"] = {"S": owner}
+            pages = dynamodb_client.get_paginator("query").paginate(
+                TableName=self.state_table_name,
+                IndexName=STATE_TABLE_UPDATED_AT_INDEX,
+                KeyConditionExpression="email = :email AND updatedAt > :since",
+                FilterExpression="attribute_not_exists(poolKey)",
+                ExpressionAttributeValues=values,
+            )
+            tombstone_pages = dynamodb_client.get_paginator("query").paginate(
+                TableName=self.tombstones_table_name,
+                KeyConditionExpression="email = :email AND tombstoneKey > :since",
+                ExpressionAttributeValues=values,
+            )
+        else:
+            pages = dynamodb_client.get_paginator("scan").paginate(
+                TableName=self.state_table_name,
+                FilterExpression="updatedAt > :since AND attribute_not_exists(poolKey)",
+                ExpressionAttributeValues=values,
+            )
+            tombstone_pages = dynamodb_client.get_paginator("scan").paginate(
+                TableName=self.tombstones_table_name,
+                FilterExpression="updatedAt > :since",
+                ExpressionAttributeValues=values,
+            )
+
+        stacksets = [self.serialize_state_table_row(item) for page in pages for item in page["Items"]]
+        # Recycled stackset IDs come back to life, only report the ones still deleted
+        current_ids = {stackset["stackset_id"] for stackset in stacksets}
+        deleted = {
+            item["stacksetID"]["S"]
+            for page in tombstone_pages
+            for item in page["Items"]
+            if item["stacksetID"]["S"] not in current_ids
+        }
 
-        results = [self.serialize_state_table_row(item) for item in results["Items"]]
-        filtered_results = [entry for entry in results if is_superuser or entry["email"] == email]
+        return stacksets, sorted(deleted), sync_token
 
+    def annotate_user_stacksets(self, stacksets, permissions, is_superuser):
         # annotate stacksets with permission details
-        for instance_data in filtered_results:
+        for instance_data in stacksets:
             group = instance_data["group"]
             account = instance_data["account"]
             region = instance_data["region"]
@@ -381,14 +749,43 @@ class AwsUtils:
 
             instance_data["available_instance_types"] = available_instance_types
 
-        return filtered_results
+        return stacksets
+
+    def get_cached_listing(self, key):
+        entry = self.listing_cache.get(key)
+
+        stats = self.listing_cache.get_stats()
+        if (stats["hits"] + stats["misses"]) % LISTING_CACHE_METRICS_INTERVAL == 0:
+            self.record_metrics(
+                dimensions={"Cache": "listing"},
+                metrics={"HitRate": stats["hit_rate"] * 100},
+                unit="Percent",
+            )
+            self.record_metrics(dimensions={"Cache": "listing"}, metrics={"Size": stats["bytes"]}, unit="Bytes")
+
+        return entry
+
+    def invalidate_listings(self, email=None):
+        # Called after writing to the state entries of a user, or of unknown users if no email is given
+        self.listing_cache.invalidate(email=email)
+        self.invalidate_request_reads()
+
+    def get_one_stack_set(self, stackset_id, fields=None):
+        codec, projection = self.get_state_table_reader(fields=fields)
+        cache = get_request_cache()
+        cached = cache and cache.get_stackset(stackset_id=stackset_id, fields=codec.fields)
+        if cached:
+            return cached
 
-    def get_one_stack_set(self, stackset_id):
         dynamodb_client = boto3.client("dynamodb")
-        state_data = dynamodb_client.get_item(TableName=self.state_table_name, Key={"stacksetID": {"S": stackset_id}})[
-            "Item"
-        ]
-        return self.serialize_state_table_row(state_data)
+        state_data = dynamodb_client.get_item(
+            TableName=self.state_table_name, Key={"stacksetID": {"S": stackset_id}}, **projection
+        )["Item"]
+        result = codec.decode_dict(state_data)
+        if cache:
+            cache.set_stackset(stackset=result, fields=codec.fields)
+
+        return result
 
     def update_stackset_state_entry(self, stackset_id, data):
         # Data: list of dicts with "field_name" and "value"
@@ -398,7 +795,7 @@ class AwsUtils:
         update_expression_list = ["set "]
         update_values = dict()
 
-        for entry in data:
+        for entry in [*data, {"field_name": "updatedAt", "value": get_update_stamp()}]:
             field_name = entry["field_name"]
             value = entry["value"]
             update_expression_list.append(f" {field_name} = :{field_name},")
@@ -415,24 +812,12 @@ class AwsUtils:
             ReturnValues="ALL_NEW",
         )
 
-        return self.serialize_state_table_row(updated_entry["Attributes"])
-
-    def get_owned_stacksets(self, email, is_superuser=False):
-        client = boto3.client("dynamodb")
-
-        # For superusers, return all created instances
-        # For other users, filter the results by email
-        filter_kwargs = dict(
-            FilterExpression="email = :val",
-            ExpressionAttributeValues={":val": {"S": email}},
-        )
-        if is_superuser:
-            filter_kwargs = {}
-
-        results = client.scan(TableName=self.state_table_name, **filter_kwargs)
-
-        return [self.serialize_state_table_row(item) for item in results["Items"]]
+        stackset = self.serialize_state_table_row(updated_entry["Attributes"])
+        self.invalidate_listings(email=stackset["email"])
+        return stackset
 
+    # Assumed role credentials are valid for an hour, reuse them for most of that time
+    @cached(cache=TTLCache(maxsize=128, ttl=3000))
     def create_remote_role_session(self, account_id):
         sts_client = boto3.client("sts")
         response = sts_client.assume_role(
@@ -457,6 +842,14 @@ class AwsUtils:
         return {x["OutputKey"]: x["OutputValue"] for x in original_outputs}
 
     def fetch_stackset_instances(self, stackset_id, acceptable_statuses=INSTANCES_STACK_STATUSES):
+        return self.memoize(
+            ("topology", stackset_id, frozenset(acceptable_statuses or ())),
+            lambda: list(
+                self.iter_stackset_instances(stackset_id=stackset_id, acceptable_statuses=acceptable_statuses)
+            ),
+        )
+
+    def iter_stackset_instances(self, stackset_id, acceptable_statuses=INSTANCES_STACK_STATUSES):
         client = boto3.client("cloudformation")
 
         stack_instances = client.list_stack_instances(StackSetName=stackset_id)
@@ -487,6 +880,7 @@ class AwsUtils:
                 "stackset_id": stackset_id,
                 "account_id": account_id,
                 "region": region,
+                "stack_id": stack_id,
                 "operatingSystemName": param_dict.get("OperatingSystemName"),
                 "instanceType": param_dict["InstanceType"],
                 "instanceName": param_dict["InstanceName"],
@@ -563,21 +957,72 @@ class AwsUtils:
 
         return instances
 
-    def get_stackset_state_data(self, stackset_id):
+    def get_stackset_state_data(self, stackset_id, consistent_read=False, fields=None):
+        # Consistent reads always go to the table, they are made to check the entry right before writing to it
+        codec, projection = self.get_state_table_reader(fields=fields)
+        cache = get_request_cache()
+        cached = cache and not consistent_read and cache.get_stackset(stackset_id=stackset_id, fields=codec.fields)
+        if cached:
+            return cached
+
         client = boto3.client("dynamodb")
-        item = client.get_item(TableName=self.state_table_name, Key={"stacksetID": {"S": stackset_id}})
+        item = client.get_item(
+            TableName=self.state_table_name,
+            Key={"stacksetID": {"S": stackset_id}},
+            ConsistentRead=consistent_read,
+            **projection,
+        )
 
         if "Item" not in item:
             return {}
 
-        result = self.serialize_state_table_row(item["Item"])
+        result = codec.decode_dict(item["Item"])
+        if cache:
+            cache.set_stackset(stackset=result, fields=codec.fields)
+
+        return result
+
+    def get_stacksets_state_data(self, stackset_ids, fields=None, consistent=False):
+        # Returns a dict of stackset ID -> state table row, missing stacksets are omitted.
+        # Consistent reads see every write acknowledged before them, and skip the request cache.
+        codec, projection = self.get_state_table_reader(fields=fields)
+        cache = None if consistent else get_request_cache()
+        result = {}
+        if cache:
+            for stackset_id in set(stackset_ids):
+                cached = cache.get_stackset(stackset_id=stackset_id, fields=codec.fields)
+                if cached:
+                    result[stackset_id] = cached
+
+        client = boto3.client("dynamodb")
+
+        for batch in chunks(list(set(stackset_ids) - set(result)), DYNAMODB_BATCH_GET_LIMIT):
+            request_items = {
+                self.state_table_name: {
+                    "Keys": [{"stacksetID": {"S": item}} for item in batch],
+                    "ConsistentRead": consistent,
+                    **projection,
+                }
+            }
+            while request_items:
+                response = client.batch_get_item(RequestItems=request_items)
+                for item in response["Responses"].get(self.state_table_name, []):
+                    row = codec.decode_dict(item)
+                    result[row["stackset_id"]] = row
+                    if cache:
+                        cache.set_stackset(stackset=row, fields=codec.fields)
+
+                # Retry the keys DynamoDB didn't get to process
+                request_items = response.get("UnprocessedKeys")
+
         return result
 
     def initiate_stackset_deprovisioning(self, stackset_id, owner_email):
+        self.forget_stackset_topology(stackset_id=stackset_id)
         sfn_client = boto3.client("stepfunctions")
         response = sfn_client.start_execution(
             stateMachineArn=self.cleanup_sfn_arn,
-            input=json.dumps(
+            input=json_utils.dumps(
                 {
                     "stackset_id": stackset_id,
                     "stackset_email": owner_email,
@@ -591,13 +1036,159 @@ class AwsUtils:
             stackset_id=stackset_id,
             data=[
                 {"field_name": "instanceStatus", "value": EC2_INSTANCE_PENDING_STATE},
+                # Discard state-change events emitted before the update was requested
+                {"field_name": "instanceStatusTime", "value": format_event_time(datetime.now(timezone.utc))},
             ],
         )
 
-    def update_stackset(self, stackset_id, **kwargs):
-        cf_client = boto3.client("cloudformation")
-        self.logger.info(f"{stackset_id=}, {kwargs=}")
+    def get_stacksets_by_instance_ids(self, instance_ids):
+        # Returns a dict of instance ID -> state table row for the instances managed by the app
+        dynamodb_client = boto3.client("dynamodb")
+
+        # The index is keyed by instance ID, look the instances of a batch of events up concurrently
+        instance_ids = list(set(instance_ids))
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            responses = executor.map(
+                lambda instance_id: dynamodb_client.query(
+                    TableName=self.state_table_name,
+                    IndexName=STATE_TABLE_INSTANCE_ID_INDEX,
+                    KeyConditionExpression="instanceId = :instanceId",
+                    ExpressionAttributeValues={":instanceId": {"S": instance_id}},
+                ),
+                instance_ids,
+            )
+
+            result = {}
+            for instance_id, response in zip(instance_ids, responses):
+                for item in response["Items"]:
+                    result[instance_id] = self.serialize_state_table_row(item)
+
+        return result
+
+    def update_instance_statuses(self, status_changes):
+        # Status changes: list of dicts with "stackset_id", "instance_id", "state" and "time"
+        dynamodb_client = boto3.client("dynamodb")
+
+        def build_update(change):
+            return {
+                "TableName": self.state_table_name,
+                "Key": {"stacksetID": {"S": change["stackset_id"]}},
+                "UpdateExpression": (
+                    "SET instanceStatus = :instanceStatus, instanceStatusTime = :instanceStatusTime, "
+                    "updatedAt = :updatedAt"
+                ),
+                # Only apply the change to the instance the row still refers to, and never let
+                # a late, out of order event overwrite a more recent status. Events of the same second are
+                # applied in order, they all sort before a status written by the app during that second.
+                "ConditionExpression": (
+                    "instanceId = :instanceId AND "
+                    "(attribute_not_exists(instanceStatusTime) OR instanceStatusTime <= :instanceStatusTime)"
+                ),
+                "ExpressionAttributeValues": {
+                    ":instanceId": {"S": change["instance_id"]},
+                    ":instanceStatus": {"S": change["state"]},
+                    ":instanceStatusTime": {"S": change["time"]},
+                    ":updatedAt": {"S": get_update_stamp()},
+                },
+            }
+
+        applied = []
+        for batch in chunks(status_changes, DYNAMODB_TRANSACTION_LIMIT):
+            try:
+                dynamodb_client.transact_write_items(TransactItems=[{"Update": build_update(item)} for item in batch])
+                applied.extend(batch)
+                continue
+            except dynamodb_client.exceptions.TransactionCanceledException:
+                self.logger.info("update_instance_statuses: transaction cancelled, applying changes one by one")
+
+            # A single stale change cancels the whole transaction, apply the batch item by item instead
+            for change in batch:
+                try:
+                    dynamodb_client.update_item(**build_update(change))
+                    applied.append(change)
+                except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                    self.logger.info(f"update_instance_statuses: skipping stale status change {change=}")
+
+        if applied:
+            self.invalidate_listings()
+        return applied
+
+    def store_update_task_token(self, stackset_ids, task_token):
+        dynamodb_client = boto3.client("dynamodb")
 
+        for batch in chunks(stackset_ids, DYNAMODB_TRANSACTION_LIMIT):
+            dynamodb_client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": self.state_table_name,
+                            "Key": {"stacksetID": {"S": stackset_id}},
+                            "UpdateExpression": "SET updateTaskToken = :updateTaskToken, updatedAt = :updatedAt",
+                            "ExpressionAttributeValues": {
+                                ":updateTaskToken": {"S": task_token},
+                                ":updatedAt": {"S": get_update_stamp()},
+                            },
+                        }
+                    }
+                    for stackset_id in batch
+                ]
+            )
+        self.invalidate_request_reads()
+
+    def clear_update_task_token(self, stackset_id):
+        dynamodb_client = boto3.client("dynamodb")
+        dynamodb_client.update_item(
+            TableName=self.state_table_name,
+            Key={"stacksetID": {"S": stackset_id}},
+            UpdateExpression="SET updatedAt = :updatedAt REMOVE updateTaskToken",
+            ExpressionAttributeValues={":updatedAt": {"S": get_update_stamp()}},
+        )
+        self.invalidate_request_reads()
+
+    def resolve_update_task_token(self, stackset_id, task_token):
+        # Remove the token conditionally, so that only one caller sends the callback
+        dynamodb_client = boto3.client("dynamodb")
+        try:
+            dynamodb_client.update_item(
+                TableName=self.state_table_name,
+                Key={"stacksetID": {"S": stackset_id}},
+                UpdateExpression="SET updatedAt = :updatedAt REMOVE updateTaskToken",
+                ConditionExpression="updateTaskToken = :updateTaskToken",
+                ExpressionAttributeValues={
+                    ":updateTaskToken": {"S": task_token},
+                    ":updatedAt": {"S": get_update_stamp()},
+                },
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            self.logger.info(f"resolve_update_task_token: task token for {stackset_id} already resolved")
+            return False
+        finally:
+            self.invalidate_request_reads()
+
+        try:
+            # Ask the update monitor to check the stacksets again straight away
+            self.send_task_success(task_token=task_token, output=json_utils.dumps({"recheck": True}))
+        except ClientError as e:
+            # The task may have timed out in the meantime, in which case it falls back to polling
+            self.logger.info(f"resolve_update_task_token: could not resolve task token for {stackset_id}: {e}")
+            return False
+
+        return True
+
+    def get_task_callback_client(self):
+        with self.task_callback_client_lock:
+            if self.task_callback_client is None:
+                self.task_callback_client = boto3.client("stepfunctions", config=TASK_CALLBACK_CLIENT_CONFIG)
+
+            return self.task_callback_client
+
+    def send_task_success(self, task_token, output):
+        self.get_task_callback_client().send_task_success(taskToken=task_token, output=output)
+
+    def send_task_failure(self, task_token, error, cause):
+        self.get_task_callback_client().send_task_failure(taskToken=task_token, error=error, cause=cause)
+
+    def submit_stackset_update(self, cf_client, stackset_id, **kwargs):
         # Get current parameters and override the ones provided
         current_stackset = cf_client.describe_stack_set(StackSetName=stackset_id)["StackSet"]
         current_params = current_stackset["Parameters"]
@@ -611,9 +1202,8 @@ class AwsUtils:
             *[{"ParameterKey": key, "ParameterValue": value} for key, value in kwargs.items()],
         ]
 
-        self.mark_stackset_as_updating(stackset_id=stackset_id)
-
         # Update stack set
+        submitted_at = perf_counter()
         operation = cf_client.update_stack_set(
             StackSetName=stackset_id,
             UsePreviousTemplate=True,
@@ -621,43 +1211,384 @@ class AwsUtils:
             Capabilities=current_capabilities,
             AdministrationRoleARN=self.admin_role_arn,
             ExecutionRoleName=self.execution_role_name,
+            OperationPreferences=self.operation_preferences[STACKSET_UPDATE_ACTION],
         )
-
-        self.monitor_update(
-            stackset_id=stackset_id,
-            update_level=UpdateLevel.STACKSET_LEVEL,
-            operation_id=operation["OperationId"],
+        self.invalidate_request_reads()
+        self.record_operation_timing(
+            action=STACKSET_UPDATE_ACTION,
+            timings={"SubmitDuration": perf_counter() - submitted_at},
+            properties={"stackset_id": stackset_id, "operation_id": operation["OperationId"]},
         )
 
-    def stop_instance(self, stackset_id, account_id, region_name, instance_id):
-        self.mark_stackset_as_updating(stackset_id=stackset_id)
+        return operation
 
-        client = self.get_remote_client(account_id=account_id, region=region_name, service="ec2")
-        client.stop_instances(InstanceIds=[instance_id])
+    def acquire_stackset_operation(self, stackset_id, queued_fields):
+        """Hold the stackset for a new operation, or queue the operation behind the one in progress.
 
-        self.monitor_update(stackset_id=stackset_id, update_level=UpdateLevel.INSTANCE_LEVEL)
+        A single operation runs on a stackset at a time. Operations requested in the meantime are recorded in the
+        queued fields of the state entry (field name -> value), so that a later request of the same kind overwrites
+        an earlier one, e.g. the last requested instance type wins. The update monitor runs them once it's done.
+        Returns the state entry if the operation can start right away, None if it was queued.
+        """
+        dynamodb_client = boto3.client("dynamodb")
+        now = datetime.now(timezone.utc)
+        abandoned_before = (now - self.operation_timeout).isoformat()
+
+        for _ in range(CONDITIONAL_WRITE_ATTEMPTS):
+            try:
+                response = dynamodb_client.update_item(
+                    TableName=self.state_table_name,
+                    Key={"stacksetID": {"S": stackset_id}},
+                    UpdateExpression=(
+                        "SET operationStartedAt = :now, instanceStatus = :instanceStatus, "
+                        "instanceStatusTime = :instanceStatusTime, updatedAt = :updatedAt"
+                    ),
+                    ConditionExpression=(
+                        "attribute_exists(stacksetID) AND "
+                        "(attribute_not_exists(operationStartedAt) OR operationStartedAt < :abandonedBefore)"
+                    ),
+                    ExpressionAttributeValues={
+                        ":now": {"S": now.isoformat()},
+                        ":abandonedBefore": {"S": abandoned_before},
+                        ":instanceStatus": {"S": EC2_INSTANCE_PENDING_STATE},
+                        # Discard state-change events emitted before the operation was requested
+                        ":instanceStatusTime": {"S": format_event_time(now)},
+                        ":updatedAt": {"S": get_update_stamp()},
+                    },
+                    ReturnValues="ALL_NEW",
+                )
+                stackset = self.serialize_state_table_row(response["Attributes"])
+                self.invalidate_listings(email=stackset["email"])
+                return stackset
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                pass
+
+            try:
+                dynamodb_client.update_item(
+                    TableName=self.state_table_name,
+                    Key={"stacksetID": {"S": stackset_id}},
+                    UpdateExpression="SET updatedAt = :updatedAt, "
+                    + ", ".join(f"{field} = :{field}" for field in queued_fields),
+                    ConditionExpression="operationStartedAt >= :abandonedBefore",
+                    ExpressionAttributeValues={
+                        ":abandonedBefore": {"S": abandoned_before},
+                        ":updatedAt": {"S": get_update_stamp()},
+                        **{f":{field}": {"S": value} for field, value in queued_fields.items()},
+                    },
+                )
+                self.logger.info(f"acquire_stackset_operation: queued {stackset_id=} {queued_fields=}")
+                self.invalidate_request_reads()
+                return None
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                # The operation in progress finished in the meantime
+                continue
 
-    def start_instance(self, stackset_id, account_id, region_name, instance_id):
-        self.mark_stackset_as_updating(stackset_id=stackset_id)
+        raise StackSetUpdateInProgressException()
 
-        client = self.get_remote_client(account_id=account_id, region=region_name, service="ec2")
-        client.start_instances(InstanceIds=[instance_id])
+    def drain_stackset_operation(self, stackset_id):
+        """Release the stackset once its operation is done, or start the next queued operation.
 
-        self.monitor_update(stackset_id=stackset_id, update_level=UpdateLevel.INSTANCE_LEVEL)
+        Returns the stackset to monitor for the started operation, with the update level of that operation,
+        None if nothing was queued.
+        """
+        dynamodb_client = boto3.client("dynamodb")
+        try:
+            dynamodb_client.update_item(
+                TableName=self.state_table_name,
+                Key={"stacksetID": {"S": stackset_id}},
+                UpdateExpression="SET updatedAt = :updatedAt REMOVE operationStartedAt",
+                ConditionExpression=(
+                    "attribute_exists(stacksetID) AND attribute_not_exists(queuedInstanceType) AND "
+                    "attribute_not_exists(queuedInstanceAction) AND attribute_not_exists(queuedParameters)"
+                ),
+                ExpressionAttributeValues={":updatedAt": {"S": get_update_stamp()}},
+            )
+            self.invalidate_request_reads()
+            return None
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            pass
+
+        # Take the queued operations off the entry, the stackset remains held
+        now = datetime.now(timezone.utc)
+        try:
+            response = dynamodb_client.update_item(
+                TableName=self.state_table_name,
+                Key={"stacksetID": {"S": stackset_id}},
+                UpdateExpression=(
+                    "SET operationStartedAt = :now, instanceStatus = :instanceStatus, "
+                    "instanceStatusTime = :instanceStatusTime, updatedAt = :updatedAt "
+                    "REMOVE queuedInstanceType, queuedInstanceAction, queuedParameters"
+                ),
+                ConditionExpression="attribute_exists(stacksetID)",
+                ExpressionAttributeValues={
+                    ":now": {"S": now.isoformat()},
+                    ":instanceStatus": {"S": EC2_INSTANCE_PENDING_STATE},
+                    ":instanceStatusTime": {"S": format_event_time(now)},
+                    ":updatedAt": {"S": get_update_stamp()},
+                },
+                ReturnValues="ALL_OLD",
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            # The stackset was deprovisioned
+            return None
+
+        item = response["Attributes"]
+        stackset = self.serialize_state_table_row(item)
+        self.invalidate_listings(email=stackset["email"])
+        topology = {
+            "account_id": stackset["account"],
+            "region": stackset["region"],
+            "instance_id": stackset["instance_id"],
+        }
+        instance_type = item.get("queuedInstanceType", {}).get("S")
+        action = item.get("queuedInstanceAction", {}).get("S")
+        parameters = json_utils.loads(item["queuedParameters"]["S"]) if "queuedParameters" in item else {}
+        self.logger.info(f"drain_stackset_operation: {stackset_id=} {instance_type=} {action=} {parameters=}")
+
+        if instance_type:
+            parameters["InstanceType"] = instance_type
+
+        if parameters:
+            if action:
+                # Changing the instance type restarts the instance, run the state change once it's done
+                dynamodb_client.update_item(
+                    TableName=self.state_table_name,
+                    Key={"stacksetID": {"S": stackset_id}},
+                    UpdateExpression=(
+                        "SET queuedInstanceAction = if_not_exists(queuedInstanceAction, :action), "
+                        "updatedAt = :updatedAt"
+                    ),
+                    ExpressionAttributeValues={":action": {"S": action}, ":updatedAt": {"S": get_update_stamp()}},
+                )
+
+        try:
+            if parameters:
+                cf_client = boto3.client("cloudformation")
+                operation = self.submit_stackset_update(cf_client=cf_client, stackset_id=stackset_id, **parameters)
+                return {
+                    "stackset_id": stackset_id,
+                    "update_level": UpdateLevel.STACKSET_LEVEL.value,
+                    "operation_id": operation["OperationId"],
+                    **topology,
+                }
 
-    def update_instance_expiry(self, stackset_id, expiry, extension_count):
-        client = boto3.client("dynamodb")
-        client.update_item(
+            # Nothing to run if the queued operations were taken off by a concurrent drain, the monitor records the
+            # actual state of the instance and releases the stackset
+            if action:
+                self.set_instances_state(
+                    account_id=stackset["account"],
+                    region=stackset["region"],
+                    instance_ids=[stackset["instance_id"]],
+                    action=action,
+                )
+        except Exception:
+            # The stackset is still held for the queued operation, let later operations through
+            self.abandon_stackset_operations(stackset_id=stackset_id, email=stackset["email"])
+            raise
+
+        return {"stackset_id": stackset_id, "update_level": UpdateLevel.INSTANCE_LEVEL.value, **topology}
+
+    def drain_stackset_operations(self, stackset_ids):
+        # Returns the stacksets to monitor for the operations started from the queues
+        started = []
+        for stackset_id in stackset_ids:
+            stackset = self.drain_stackset_operation(stackset_id=stackset_id)
+            if stackset:
+                started.append(stackset)
+
+        return started
+
+    def abandon_stackset_operations(self, stackset_id, email):
+        # Release the stackset of the given owner after a failed operation, dropping the operations queued behind it
+        dynamodb_client = boto3.client("dynamodb")
+        dynamodb_client.update_item(
             TableName=self.state_table_name,
             Key={"stacksetID": {"S": stackset_id}},
-            UpdateExpression="SET extensionCount = :extensionCount, expiry = :expiry",
-            ExpressionAttributeValues={
-                ":extensionCount": {"N": str(extension_count)},
-                ":expiry": {"S": expiry.isoformat()},
-            },
+            UpdateExpression=(
+                "SET updatedAt = :updatedAt "
+                "REMOVE operationStartedAt, queuedInstanceType, queuedInstanceAction, queuedParameters"
+            ),
+            ConditionExpression="attribute_exists(stacksetID)",
+            ExpressionAttributeValues={":updatedAt": {"S": get_update_stamp()}},
         )
+        self.invalidate_listings(email=email)
 
-    def create_stack_set(
+    def update_stackset(self, stackset_id, instance_type):
+        # Returns False if the update was queued behind the operation in progress
+        self.logger.info(f"{stackset_id=}, {instance_type=}")
+
+        stackset_state = self.acquire_stackset_operation(
+            stackset_id=stackset_id, queued_fields={"queuedInstanceType": instance_type}
+        )
+        if not stackset_state:
+            return False
+
+        self.start_stackset_update(stackset_state=stackset_state, InstanceType=instance_type)
+        return True
+
+    def update_stackset_parameters(self, stackset_id, **parameters):
+        # Returns False if the update was queued behind the operation in progress, the last queued parameters win
+        self.logger.info(f"{stackset_id=}, {parameters=}")
+
+        stackset_state = self.acquire_stackset_operation(
+            stackset_id=stackset_id, queued_fields={"queuedParameters": json_utils.dumps(parameters)}
+        )
+        if not stackset_state:
+            return False
+
+        self.start_stackset_update(stackset_state=stackset_state, **parameters)
+        return True
+
+    def start_stackset_update(self, stackset_state, **parameters):
+        # Submit and monitor the update of an acquired stackset, releasing it if the update can't be started
+        stackset_id = stackset_state["stackset_id"]
+        try:
+            cf_client = boto3.client("cloudformation")
+            operation = self.submit_stackset_update(cf_client=cf_client, stackset_id=stackset_id, **parameters)
+
+            self.monitor_update(
+                stackset_id=stackset_id,
+                update_level=UpdateLevel.STACKSET_LEVEL,
+                operation_id=operation["OperationId"],
+                topology={
+                    "account_id": stackset_state["account"],
+                    "region": stackset_state["region"],
+                    "instance_id": stackset_state["instance_id"],
+                },
+            )
+        except Exception:
+            self.abandon_stackset_operations(stackset_id=stackset_id, email=stackset_state["email"])
+            raise
+
+    def set_instances_state(self, account_id, region, instance_ids, action):
+        # Action is either "start" or "stop"
+        self.logger.info(f"set_instances_state: {action=} {account_id=} {region=} {instance_ids=}")
+        client = self.get_remote_client(account_id=account_id, region=region, service="ec2")
+        if action == "start":
+            client.start_instances(InstanceIds=instance_ids)
+        else:
+            client.stop_instances(InstanceIds=instance_ids)
+
+    def stop_instance(self, stackset_id, account_id, region_name, instance_id):
+        return self.change_instances_state(
+            stacksets=[
+                {"stackset_id": stackset_id, "account": account_id, "region": region_name, "instance_id": instance_id}
+            ],
+            action="stop",
+        )
+
+    def start_instance(self, stackset_id, account_id, region_name, instance_id):
+        return self.change_instances_state(
+            stacksets=[
+                {"stackset_id": stackset_id, "account": account_id, "region": region_name, "instance_id": instance_id}
+            ],
+            action="start",
+        )
+
+    def change_instances_state(self, stacksets, action):
+        """Start or stop the instances of several stacksets, action is either "start" or "stop".
+
+        The stacksets with an operation in progress get the action queued, the last requested one wins.
+        Returns the IDs of the stacksets whose instances were started or stopped right away.
+        """
+        started = []
+        owners = {}
+        for stackset in stacksets:
+            stackset_state = self.acquire_stackset_operation(
+                stackset_id=stackset["stackset_id"], queued_fields={"queuedInstanceAction": action}
+            )
+            if stackset_state:
+                started.append(stackset)
+                # Callers don't always know the owner, the acquired entry does
+                owners[stackset["stackset_id"]] = stackset_state["email"]
+
+        # Group the instances by account and region, so that each group only needs a single API call
+        groups = defaultdict(list)
+        for stackset in started:
+            groups[(stackset["account"], stackset["region"])].append(stackset["instance_id"])
+
+        try:
+            for (account_id, region), instance_ids in groups.items():
+                self.set_instances_state(account_id=account_id, region=region, instance_ids=instance_ids, action=action)
+
+            if started:
+                self.monitor_updates(
+                    stacksets=[
+                        {
+                            "stackset_id": stackset["stackset_id"],
+                            "account_id": stackset["account"],
+                            "region": stackset["region"],
+                            "instance_id": stackset["instance_id"],
+                        }
+                        for stackset in started
+                    ],
+                    update_level=UpdateLevel.INSTANCE_LEVEL,
+                )
+        except Exception:
+            # Nothing would drain the acquired stacksets
+            for stackset in started:
+                self.abandon_stackset_operations(
+                    stackset_id=stackset["stackset_id"], email=owners[stackset["stackset_id"]]
+                )
+            raise
+
+        return [stackset["stackset_id"] for stackset in started]
+
+    def extend_instance_expiry(self, stackset, extension, max_extension_count=None, owner_email=None):
+        """Push back the expiry of an instance with a single conditional write.
+
+        The expiry read along with the stackset serves as the version of its entry: the write only applies if the
+        instance wasn't extended in the meantime, otherwise the entry is read again and the extension retried.
+        The extension limit and the owner are checked in the same write, superusers leave them unset.
+        Returns the updated state entry, or None if the extension limit is reached.
+        """
+        client = boto3.client("dynamodb")
+        stackset_id = stackset["stackset_id"]
+
+        for _ in range(CONDITIONAL_WRITE_ATTEMPTS):
+            if owner_email and stackset["email"] != owner_email:
+                raise UnauthorizedForInstanceError()
+            if max_extension_count is not None and stackset["extension_count"] >= max_extension_count:
+                return None
+
+            conditions = ["expiry = :currentExpiry"]
+            values = {
+                ":currentExpiry": {"S": stackset["expiry"]},
+                ":expiry": {"S": (datetime.fromisoformat(stackset["expiry"]) + extension).isoformat()},
+                ":one": {"N": "1"},
+                ":updatedAt": {"S": get_update_stamp()},
+            }
+            if max_extension_count is not None:
+                conditions.append("extensionCount < :maxExtensionCount")
+                values[":maxExtensionCount"] = {"N": str(max_extension_count)}
+            if owner_email:
+                conditions.append("email = :email")
+                values[":email"] = {"S": owner_email}
+
+            try:
+                response = client.update_item(
+                    TableName=self.state_table_name,
+                    Key={"stacksetID": {"S": stackset_id}},
+                    UpdateExpression="SET expiry = :expiry, updatedAt = :updatedAt ADD extensionCount :one",
+                    ConditionExpression=" AND ".join(conditions),
+                    ExpressionAttributeValues=values,
+                    ReturnValues="ALL_NEW",
+                )
+                stackset = self.serialize_state_table_row(response["Attributes"])
+                self.invalidate_listings(email=stackset["email"])
+                return stackset
+            except client.exceptions.ConditionalCheckFailedException:
+                self.logger.info(f"extend_instance_expiry: {stackset_id=} changed in the meantime, reading it again")
+
+            stackset = self.get_stackset_state_data(
+                stackset_id=stackset_id, consistent_read=True, fields=STATE_EXTENSION_FIELDS
+            )
+            if not stackset:
+                raise UnauthorizedForInstanceError()
+
+        raise StackSetUpdateInProgressException()
+
+    def create_stack_sets(
         self,
         project_name,
         tags,
@@ -668,109 +1599,225 @@ class AwsUtils:
         expiry,
         email,
         group,
-        instance_name,
+        instance_names,
         username,
+        fleet_id,
+        pool_key=None,
     ):
+        """Create a stackset with a single stack instance for each of the instance names.
+
+        StackSets only support one stack instance per account and region, so a fleet of identical
+        instances is made of one stackset per instance, created concurrently as part of one provisioning job.
+        When a pool_key is given, the stacksets are added to that warm pool instead of being owned by a user.
+        Returns a list of dicts with the "stackset_id" and "operation_id" of each instance.
+        """
         # Get the remaining params from permissions
         os_config = self.get_os_config(
             group_name=group,
             os_name=operating_system,
         )
 
-        # Create the stackset
-        template_url = f"https://s3.amazonaws.com/{self.cfn_data_bucket}/{os_config['template-filename']}"
+        # Pick the subnets and claim the recycled stacksets upfront, the regional params cache isn't thread-safe
+        recycled_stackset_ids = self.claim_recycled_stack_sets(
+            template_filename=os_config["template-filename"], count=len(instance_names)
+        )
+        instances = [
+            {
+                "instance_name": instance_name,
+                "region_params": self.get_provisioning_params_for_region(
+                    account_id=account, region=region, instance_type=instance_type
+                ),
+                "recycled_stackset_id": recycled_stackset_ids[i] if i < len(recycled_stackset_ids) else None,
+            }
+            for i, instance_name in enumerate(instance_names)
+        ]
 
         client = boto3.client("cloudformation")
-        response = client.create_stack_set(
-            StackSetName=f"{project_name}-stackset-{str(uuid4())}",
-            Description=f"Provisioning compute instances using {project_name}",
-            TemplateURL=template_url,
-            Parameters=[
-                {
-                    "ParameterKey": "ProjectName",
-                    "ParameterValue": project_name,
-                },
-                {
-                    "ParameterKey": "OperatingSystemName",
-                    "ParameterValue": operating_system,
-                },
-                {
-                    "ParameterKey": "InstanceType",
-                    "ParameterValue": instance_type,
-                },
-                {
-                    "ParameterKey": "InstanceExpiry",
-                    "ParameterValue": expiry.isoformat(),
-                },
-                {
-                    "ParameterKey": "ConnectionProtocol",
-                    "ParameterValue": os_config["connection-protocol"],
-                },
-                {
-                    "ParameterKey": "UserDataBucket",
-                    "ParameterValue": self.cfn_data_bucket,
-                },
-                {
-                    "ParameterKey": "UserDataFile",
-                    "ParameterValue": os_config["user-data-file"],
-                },
-                {
-                    "ParameterKey": "AMI",
-                    "ParameterValue": os_config["region-map"][account][region]["ami"],
-                },
-                {
-                    "ParameterKey": "SecurityGroupId",
-                    "ParameterValue": os_config["region-map"][account][region]["security-group"],
-                },
-                {
-                    "ParameterKey": "InstanceProfileName",
-                    "ParameterValue": os_config["region-map"][account][region]["instance-profile-name"],
-                },
-                # Tags
-                {
-                    "ParameterKey": "InstanceName",
-                    "ParameterValue": instance_name,
-                },
-                {
-                    "ParameterKey": "TagNameOne",
-                    "ParameterValue": tags[0]["tag-name"],
-                },
-                {
-                    "ParameterKey": "TagValueOne",
-                    "ParameterValue": tags[0]["tag-value"],
-                },
-                {
-                    "ParameterKey": "TagNameTwo",
-                    "ParameterValue": tags[1]["tag-name"],
-                },
-                {
-                    "ParameterKey": "TagValueTwo",
-                    "ParameterValue": tags[1]["tag-value"],
-                },
-                # Provide empty string as the temporary values of the parameters,
-                # to be overridden using config values fetched
-                {
-                    "ParameterKey": "VPCID",
-                    "ParameterValue": "",
-                },
-                {
-                    "ParameterKey": "SubnetId",
-                    "ParameterValue": "",
-                },
-                {
-                    "ParameterKey": "SSHKeyName",
-                    "ParameterValue": "",
-                },
-            ],
-            AdministrationRoleARN=self.admin_role_arn,
-            ExecutionRoleName=self.execution_role_name,
-            PermissionModel="SELF_MANAGED",
-        )
-        stackset_id = response["StackSetId"]
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            created = list(
+                executor.map(
+                    lambda instance: self.create_stack_set(
+                        client=client,
+                        project_name=project_name,
+                        tags=tags,
+                        os_config=os_config,
+                        account=account,
+                        region=region,
+                        instance_type=instance_type,
+                        operating_system=operating_system,
+                        expiry=expiry,
+                        **instance,
+                    ),
+                    instances,
+                )
+            )
 
-        region_params = self.get_provisioning_params_for_region(
-            account_id=account, region=region, instance_type=instance_type
-        )
+        def build_item(instance, result):
+            item = {
+                "stacksetID": {"S": result["stackset_id"]},
+                "updatedAt": {"S": get_update_stamp()},
+                "fleetId": {"S": fleet_id},
+                "username": {"S": username},
+                "email": {"S": email},
+                "group": {"S": group},
+                "extensionCount": {"N": "0"},
+                "expiry": {"S": expiry.isoformat()},
+                "account": {"S": account},
+                "region": {"S": region},
+                "instanceType": {"S": instance_type},
+                "operatingSystem": {"S": operating_system},
+                "privateIp": {"S": ""},
+                "instanceStatus": {"S": ""},
+                "instanceName": {"S": instance["instance_name"]},
+                "connectionProtocol": {"S": os_config["connection-protocol"]},
+                "availabilityZone": {"S": instance["region_params"]["availability_zone"]},
+                "templateFile": {"S": os_config["template-filename"]},
+            }
+            if pool_key:
+                # The pool replenisher tracks the creation itself, instead of a provisioning state machine
+                item["poolKey"] = {"S": pool_key}
+                item["operationId"] = {"S": result["operation_id"]}
+
+            return item
+
+        # Save the state of each instance to dynamodb
+        dynamodb_client = boto3.client("dynamodb")
+        for batch in chunks(list(zip(instances, created)), DYNAMODB_BATCH_WRITE_LIMIT):
+            request_items = {
+                self.state_table_name: [
+                    {"PutRequest": {"Item": build_item(instance, result)}} for instance, result in batch
+                ]
+            }
+            while request_items:
+                response = dynamodb_client.batch_write_item(RequestItems=request_items)
+                # Retry the items DynamoDB didn't get to process
+                request_items = response.get("UnprocessedItems")
+
+        self.invalidate_listings(email=email)
+        return created
+
+    def create_stack_set(
+        self,
+        client,
+        project_name,
+        tags,
+        os_config,
+        account,
+        region,
+        instance_type,
+        operating_system,
+        expiry,
+        instance_name,
+        region_params,
+        recycled_stackset_id=None,
+    ):
+        template_url = f"https://s3.amazonaws.com/{self.cfn_data_bucket}/{os_config['template-filename']}"
+
+        parameters = [
+            {
+                "ParameterKey": "ProjectName",
+                "ParameterValue": project_name,
+            },
+            {
+                "ParameterKey": "OperatingSystemName",
+                "ParameterValue": operating_system,
+            },
+            {
+                "ParameterKey": "InstanceType",
+                "ParameterValue": instance_type,
+            },
+            {
+                "ParameterKey": "InstanceExpiry",
+                "ParameterValue": expiry.isoformat(),
+            },
+            {
+                "ParameterKey": "ConnectionProtocol",
+                "ParameterValue": os_config["connection-protocol"],
+            },
+            {
+                "ParameterKey": "UserDataBucket",
+                "ParameterValue": self.cfn_data_bucket,
+            },
+            {
+                "ParameterKey": "UserDataFile",
+                "ParameterValue": os_config["user-data-file"],
+            },
+            {
+                "ParameterKey": "AMI",
+                "ParameterValue": os_config["region-map"][account][region]["ami"],
+            },
+            {
+                "ParameterKey": "SecurityGroupId",
+                "ParameterValue": os_config["region-map"][account][region]["security-group"],
+            },
+            {
+                "ParameterKey": "InstanceProfileName",
+                "ParameterValue": os_config["region-map"][account][region]["instance-profile-name"],
+            },
+            # Tags
+            {
+                "ParameterKey": "InstanceName",
+                "ParameterValue": instance_name,
+            },
+            {
+                "ParameterKey": "TagNameOne",
+                "ParameterValue": tags[0]["tag-name"],
+            },
+            {
+                "ParameterKey": "TagValueOne",
+                "ParameterValue": tags[0]["tag-value"],
+            },
+            {
+                "ParameterKey": "TagNameTwo",
+                "ParameterValue": tags[1]["tag-name"],
+            },
+            {
+                "ParameterKey": "TagValueTwo",
+                "ParameterValue": tags[1]["tag-value"],
+            },
+            # Provide empty string as the temporary values of the parameters,
+            # to be overridden using config values fetched
+            {
+                "ParameterKey": "VPCID",
+                "ParameterValue": "",
+            },
+            {
+                "ParameterKey": "SubnetId",
+                "ParameterValue": "",
+            },
+            {
+                "ParameterKey": "SSHKeyName",
+                "ParameterValue": "",
+            },
+        ]
+
+        # Reuse an empty stackset created from the same template if one was claimed,
+        # only its parameters need to be updated
+        submitted_at = perf_counter()
+        stackset_id = recycled_stackset_id
+        if stackset_id:
+            client.update_stack_set(
+                StackSetName=stackset_id,
+                Description=f"Provisioning compute instances using {project_name}",
+                TemplateURL=template_url,
+                Parameters=parameters,
+                AdministrationRoleARN=self.admin_role_arn,
+                ExecutionRoleName=self.execution_role_name,
+                ManagedExecution=STACKSET_MANAGED_EXECUTION,
+                OperationPreferences=self.operation_preferences[STACKSET_UPDATE_ACTION],
+            )
+        else:
+            response = client.create_stack_set(
+                StackSetName=f"{project_name}-stackset-{str(uuid4())}",
+                Description=f"Provisioning compute instances using {project_name}",
+                TemplateURL=template_url,
+                Parameters=parameters,
+                AdministrationRoleARN=self.admin_role_arn,
+                ExecutionRoleName=self.execution_role_name,
+                PermissionModel="SELF_MANAGED",
+                ManagedExecution=STACKSET_MANAGED_EXECUTION,
+            )
+            stackset_id = response["StackSetId"]
 
         create_operation = client.create_stack_instances(
             StackSetName=stackset_id,
@@ -790,36 +1837,41 @@ class AwsUtils:
                     "ParameterValue": region_params["ssh_key_name"],
                 },
             ],
+            OperationPreferences=self.operation_preferences[STACKSET_CREATE_ACTION],
         )
-
-        # Save stackset state to dynamodb
-        dynamodb_client = boto3.client("dynamodb")
-        dynamodb_client.put_item(
-            TableName=self.state_table_name,
-            Item={
-                "stacksetID": {"S": stackset_id},
-                "username": {"S": username},
-                "email": {"S": email},
-                "group": {"S": group},
-                "extensionCount": {"N": "0"},
-                "expiry": {"S": expiry.isoformat()},
-                "account": {"S": account},
-                "region": {"S": region},
-                "instanceType": {"S": instance_type},
-                "operatingSystem": {"S": operating_system},
-                "privateIp": {"S": ""},
-                "instanceStatus": {"S": ""},
-                "instanceName": {"S": instance_name},
-                "connectionProtocol": {"S": os_config["connection-protocol"]},
-                "availabilityZone": {"S": region_params["availability_zone"]},
+        self.record_operation_timing(
+            action=STACKSET_CREATE_ACTION,
+            timings={"SubmitDuration": perf_counter() - submitted_at},
+            properties={
+                "stackset_id": stackset_id,
+                "operation_id": create_operation["OperationId"],
+                "recycled": bool(recycled_stackset_id),
             },
         )
 
-        return stackset_id, create_operation["OperationId"]
+        return {"stackset_id": stackset_id, "operation_id": create_operation["OperationId"]}
 
-    def check_stackset_complete(self, stackset_id, operation_id):
+    def check_stacksets_complete(self, stacksets):
+        # Check the operations of several stacksets concurrently, stacksets: list of dicts
+        # with "stackset_id" and "operation_id"
         cf_client = boto3.client("cloudformation")
 
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            # Consuming the results re-raises the exceptions raised by the checks
+            list(
+                executor.map(
+                    lambda stackset: self.check_stackset_complete(
+                        stackset_id=stackset["stackset_id"],
+                        operation_id=stackset["operation_id"],
+                        cf_client=cf_client,
+                    ),
+                    stacksets,
+                )
+            )
+
+    def check_stackset_complete(self, stackset_id, operation_id, cf_client=None):
+        cf_client = cf_client or boto3.client("cloudformation")
+
         stack_operation = cf_client.describe_stack_set_operation(StackSetName=stackset_id, OperationId=operation_id)
         self.logger.info(f"check_stackset_update_complete: {stack_operation=}")
 
@@ -835,81 +1887,689 @@ class AwsUtils:
             ):
                 raise StackSetExecutionInProgressException()
 
-    def check_stackset_update_complete(self, stackset_id, update_level, operation_id):
-        # Update level can be: stackset (updating params) or instance (updating instance state)
-        self.logger.info(f"check_stackset_update_complete: {stackset_id=} {update_level=} {operation_id=}")
+        self.record_stack_operation_timing(stack_operation=stack_operation["StackSetOperation"])
+
+    def record_metrics(self, dimensions, metrics, unit, properties=None):
+        # Metrics are emitted as CloudWatch embedded metrics, extracted from the lambda logs
+        self.logger.info(
+            json_utils.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.metrics_namespace,
+                                "Dimensions": [list(dimensions.keys())],
+                                "Metrics": [{"Name": name, "Unit": unit} for name in metrics],
+                            }
+                        ],
+                    },
+                    **dimensions,
+                    **metrics,
+                    **(properties or {}),
+                }
+            )
+        )
+
+    def record_operation_timing(self, action, timings, properties=None):
+        # Timings are in seconds
+        self.record_metrics(dimensions={"Action": action}, metrics=timings, unit="Seconds", properties=properties)
+
+    def record_stack_operation_timing(self, stack_operation):
+        # Split a completed operation into the time CloudFormation spent executing it,
+        # and the time it took the app to notice it finished
+        if "EndTimestamp" not in stack_operation:
+            return
+
+        self.record_operation_timing(
+            action=stack_operation["Action"],
+            timings={
+                "ExecutionDuration": (
+                    stack_operation["EndTimestamp"] - stack_operation["CreationTimestamp"]
+                ).total_seconds(),
+                "CompletionDetectionDelay": (
+                    datetime.now(timezone.utc) - stack_operation["EndTimestamp"]
+                ).total_seconds(),
+            },
+            properties={
+                "stackset_id": stack_operation["StackSetId"],
+                "operation_id": stack_operation["OperationId"],
+                "status": stack_operation["Status"],
+            },
+        )
+
+    def get_pooled_stacksets(self, pool_key):
+        client = boto3.client("dynamodb")
+        paginator = client.get_paginator("query")
+        pages = paginator.paginate(
+            TableName=self.state_table_name,
+            IndexName=STATE_TABLE_POOL_KEY_INDEX,
+            KeyConditionExpression="poolKey = :poolKey",
+            ExpressionAttributeValues={":poolKey": {"S": pool_key}},
+        )
+
+        return [self.serialize_state_table_row(item) for page in pages for item in page["Items"]]
+
+    def claim_pooled_stacksets(self, pool_key, instance_names, email, username, expiry):
+        """Take ready (stopped) instances out of a warm pool and assign them to a user.
+
+        Each claim is a conditional write on the state table, so an instance is never handed out twice.
+        Returns the claimed state table rows, fewer than the requested instance names if the pool runs short.
+        """
+        client = boto3.client("dynamodb")
+
+        candidates = [
+            stackset
+            for stackset in self.get_pooled_stacksets(pool_key=pool_key)
+            if stackset["instance_status"] == EC2_INSTANCE_STOPPED_STATE
+        ]
+        # Spread concurrent claims across the pool to limit conflicts
+        random.shuffle(candidates)
+
+        claimed = []
+        for candidate in candidates:
+            if len(claimed) == len(instance_names):
+                break
+
+            try:
+                response = client.update_item(
+                    TableName=self.state_table_name,
+                    Key={"stacksetID": {"S": candidate["stackset_id"]}},
+                    UpdateExpression=(
+                        "SET email = :email, username = :username, instanceName = :instanceName, expiry = :expiry, "
+                        "instanceStatus = :instanceStatus, instanceStatusTime = :instanceStatusTime, "
+                        "updatedAt = :updatedAt REMOVE poolKey, operationId"
+                    ),
+                    ConditionExpression="poolKey = :poolKey AND instanceStatus = :stoppedStatus",
+                    ExpressionAttributeValues={
+                        ":email": {"S": email},
+                        ":username": {"S": username},
+                        ":instanceName": {"S": instance_names[len(claimed)]},
+                        ":expiry": {"S": expiry.isoformat()},
+                        ":instanceStatus": {"S": EC2_INSTANCE_PENDING_STATE},
+                        ":instanceStatusTime": {"S": format_event_time(datetime.now(timezone.utc))},
+                        ":poolKey": {"S": pool_key},
+                        ":stoppedStatus": {"S": EC2_INSTANCE_STOPPED_STATE},
+                        ":updatedAt": {"S": get_update_stamp()},
+                    },
+                    ReturnValues="ALL_NEW",
+                )
+            except ClientError as e:
+                # Claimed by a concurrent request in the meantime
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                continue
+
+            claimed.append(self.serialize_state_table_row(response["Attributes"]))
+
+        self.logger.info(f"claim_pooled_stacksets: {pool_key=} {len(claimed)=} {len(instance_names)=}")
+        if claimed:
+            self.invalidate_listings(email=email)
+        return claimed
+
+    def activate_pooled_stacksets(self, stacksets, tags):
+        # Retag the claimed instances right away and start them
+        for stackset in stacksets:
+            client = self.get_remote_client(account_id=stackset["account"], region=stackset["region"], service="ec2")
+            client.create_tags(
+                Resources=[stackset["instance_id"]],
+                Tags=[
+                    {"Key": "Name", "Value": stackset["instance_name"]},
+                    {"Key": "Expiry", "Value": stackset["expiry"]},
+                    *[{"Key": tag["tag-name"], "Value": tag["tag-value"]} for tag in tags],
+                ],
+            )
+
+        self.change_instances_state(stacksets=stacksets, action="start")
+
+        # Bring the stackset parameters in line with the new tags, so that later stackset updates don't revert them.
+        # The start holds the stacksets, the update is queued behind it and run by its update monitor.
+        for stackset in stacksets:
+            self.update_stackset_parameters(
+                stackset_id=stackset["stackset_id"],
+                InstanceName=stackset["instance_name"],
+                InstanceExpiry=stackset["expiry"],
+                TagValueOne=tags[0]["tag-value"],
+                TagValueTwo=tags[1]["tag-value"],
+            )
+
+    def return_to_warm_pool(self, stacksets, pool_key):
+        """Put claimed stacksets whose activation failed back in their warm pool.
+
+        Their instances may have been started already, they're stopped again and the replenishment
+        picks them up once stopped. Stacksets changed by their new owner in the meantime are left to them.
+        """
+        client = boto3.client("dynamodb")
+        for stackset in stacksets:
+            try:
+                client.update_item(
+                    TableName=self.state_table_name,
+                    Key={"stacksetID": {"S": stackset["stackset_id"]}},
+                    UpdateExpression=(
+                        "SET email = :poolOwner, username = :poolOwner, poolKey = :poolKey, "
+                        "instanceStatus = :instanceStatus, instanceStatusTime = :instanceStatusTime, "
+                        "updatedAt = :updatedAt"
+                    ),
+                    ConditionExpression="email = :email AND attribute_not_exists(poolKey)",
+                    ExpressionAttributeValues={
+                        ":poolOwner": {"S": WARM_POOL_OWNER},
+                        ":poolKey": {"S": pool_key},
+                        ":email": {"S": stackset["email"]},
+                        ":instanceStatus": {"S": EC2_INSTANCE_STOPPING_STATE},
+                        ":instanceStatusTime": {"S": format_event_time(datetime.now(timezone.utc))},
+                        ":updatedAt": {"S": get_update_stamp()},
+                    },
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                continue
+
+            ec2_client = self.get_remote_client(
+                account_id=stackset["account"], region=stackset["region"], service="ec2"
+            )
+            try:
+                ec2_client.stop_instances(InstanceIds=[stackset["instance_id"]])
+            except ClientError as e:
+                # Still pending, its state change events record the state it ends up in
+                self.logger.warning(f"return_to_warm_pool: {stackset['stackset_id']=} {e}")
+            self.invalidate_listings(email=stackset["email"])
+
+    def remove_from_warm_pool(self, stackset_id, pool_key):
+        # Returns False if the stackset was claimed in the meantime
+        client = boto3.client("dynamodb")
+        try:
+            client.update_item(
+                TableName=self.state_table_name,
+                Key={"stacksetID": {"S": stackset_id}},
+                UpdateExpression="SET updatedAt = :updatedAt REMOVE poolKey, operationId",
+                ConditionExpression="poolKey = :poolKey",
+                ExpressionAttributeValues={":poolKey": {"S": pool_key}, ":updatedAt": {"S": get_update_stamp()}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+
+        self.invalidate_request_reads()
+        return True
+
+    def replenish_warm_pool(
+        self,
+        project_name,
+        tags,
+        expiry,
+        group,
+        operating_system,
+        account,
+        region,
+        instance_type,
+        size,
+    ):
+        """Keep a warm pool at its target size.
+
+        Pooled stacksets whose creation completed get their instance stopped, failed ones are deprovisioned,
+        missing ones are created and a surplus of ready instances is deprovisioned.
+        """
+        pool_key = warm_pool_key(
+            group=group, operating_system=operating_system, account=account, region=region, instance_type=instance_type
+        )
+        pooled = self.get_pooled_stacksets(pool_key=pool_key)
+
+        # Check the creation of the stacksets still being created concurrently
+        creating = [stackset for stackset in pooled if not stackset["instance_status"]]
         cf_client = boto3.client("cloudformation")
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            statuses = list(
+                executor.map(
+                    lambda stackset: cf_client.describe_stack_set_operation(
+                        StackSetName=stackset["stackset_id"], OperationId=stackset["operation_id"]
+                    )["StackSetOperation"]["Status"],
+                    creating,
+                )
+            )
 
-        if operation_id:
-            stack_operation = cf_client.describe_stack_set_operation(StackSetName=stackset_id, OperationId=operation_id)
-            self.logger.info(f"check_stackset_update_complete: {stack_operation=}")
+        # Instances of freshly created stacksets are running, stop them until they are claimed
+        failed = []
+        for stackset, status in zip(creating, statuses):
+            if status in STACKSET_OPERATION_INCOMPLETE_STATUSES:
+                continue
+            if status != STACKSET_OPERATION_SUCCESS_STATUS:
+                failed.append(stackset)
+                continue
 
-            if stack_operation["StackSetOperation"]["Status"] in STACKSET_OPERATION_INCOMPLETE_STATUSES:
-                raise StackSetUpdateInProgressException("StackSet operation still in progress")
+            instance_data = next(self.iter_stackset_instances(stackset_id=stackset["stackset_id"]), None)
+            if not instance_data:
+                failed.append(stackset)
+                continue
+
+            self.update_stackset_state_entry(
+                stackset_id=stackset["stackset_id"],
+                data=[
+                    {"field_name": "instanceId", "value": instance_data["instance_id"]},
+                    {"field_name": "privateIp", "value": instance_data["private_ip"]},
+                    {"field_name": "instanceStatus", "value": EC2_INSTANCE_STOPPING_STATE},
+                    {
+                        "field_name": "instanceStatusTime",
+                        "value": format_event_time(datetime.now(timezone.utc)),
+                    },
+                ],
+            )
+            client = self.get_remote_client(account_id=account, region=region, service="ec2")
+            client.stop_instances(InstanceIds=[instance_data["instance_id"]])
+            stackset["instance_status"] = EC2_INSTANCE_STOPPING_STATE
+
+        # Ready instances are the first to go when the pool is over its target
+        healthy = [stackset for stackset in pooled if stackset not in failed]
+        ready = [stackset for stackset in healthy if stackset["instance_status"] == EC2_INSTANCE_STOPPED_STATE]
+        surplus = ready[: max(len(healthy) - size, 0)]
+
+        for stackset in [*failed, *surplus]:
+            if self.remove_from_warm_pool(stackset_id=stackset["stackset_id"], pool_key=pool_key):
+                self.initiate_stackset_deprovisioning(stackset_id=stackset["stackset_id"], owner_email=WARM_POOL_OWNER)
+
+        missing = max(size - len(healthy), 0)
+        if missing:
+            self.create_stack_sets(
+                project_name=project_name,
+                tags=tags,
+                account=account,
+                region=region,
+                instance_type=instance_type,
+                operating_system=operating_system,
+                expiry=expiry,
+                email=WARM_POOL_OWNER,
+                group=group,
+                instance_names=[f"{project_name}-warm-pool"] * missing,
+                username=WARM_POOL_OWNER,
+                fleet_id=str(uuid4()),
+                pool_key=pool_key,
+            )
+
+        return {
+            "pool_key": pool_key,
+            "size": len(healthy) - len(surplus) + missing,
+            "ready": len(ready) - len(surplus),
+            "created": missing,
+            "deprovisioned": len(failed) + len(surplus),
+        }
+
+    def get_stackset_topology(self, stackset_id, **known_topology):
+        """Resolve the account, region, stack and instance backing a single instance stackset.
+
+        The values are stable until the stackset is recycled, so they're cached in-process and
+        only the values neither provided nor cached are looked up.
+        """
+        known_topology = {key: value for key, value in known_topology.items() if value}
+        cached = self.topology_cache.get(stackset_id, {})
+        # The stackset was recycled in another process since it was cached, none of the cached values hold
+        if any(cached.get(key) not in (None, value) for key, value in known_topology.items()):
+            cached = {}
+        topology = {**cached, **known_topology}
+
+        if not topology.get("instance_id"):
+            if not all(topology.get(key) for key in ("account_id", "region", "stack_id")):
+                cf_client = boto3.client("cloudformation")
+                stack_instances = cf_client.list_stack_instances(StackSetName=stackset_id)
+                self.logger.info(f"get_stackset_topology: {stack_instances=}")
+                if len(stack_instances["Summaries"]) != 1:
+                    raise InvalidApplicationState(message="Unexpected number of stack instances")
+
+                stack_instance = stack_instances["Summaries"][0]
+                topology["account_id"] = stack_instance["Account"]
+                topology["region"] = stack_instance["Region"]
+                topology["stack_id"] = stack_instance["StackId"]
+
+            stack_client = self.get_remote_client(
+                account_id=topology["account_id"], region=topology["region"], service="cloudformation"
+            )
+            described_stacks = stack_client.describe_stacks(StackName=topology["stack_id"])
+            self.logger.info(f"get_stackset_topology: {described_stacks=}")
+
+            output_dict = self.parse_stack_outputs(described_stacks["Stacks"][0]["Outputs"])
+            topology["instance_id"] = output_dict["InstanceID"]
+
+        self.topology_cache[stackset_id] = topology
+        return topology
+
+    def forget_stackset_topology(self, stackset_id):
+        # Recycled stacksets get a new stack and instance
+        self.topology_cache.pop(stackset_id, None)
+
+    def get_synchronized_stack_instance(self, cf_client, stackset_id, operation_id):
+        # Returns the stack instance once the operation is finished and the instance synchronized, None otherwise
+        stack_operation = cf_client.describe_stack_set_operation(StackSetName=stackset_id, OperationId=operation_id)
+        self.logger.info(f"get_synchronized_stack_instance: {stack_operation=}")
+
+        if stack_operation["StackSetOperation"]["Status"] in STACKSET_OPERATION_INCOMPLETE_STATUSES:
+            return None
 
         stack_instances = cf_client.list_stack_instances(StackSetName=stackset_id)
-        self.logger.info(f"check_stackset_update_complete: {stack_instances=}")
+        self.logger.info(f"get_synchronized_stack_instance: {stack_instances=}")
         if len(stack_instances["Summaries"]) != 1:
             raise InvalidApplicationState(message="Unexpected number of stack instances")
 
-        stack_instances = stack_instances["Summaries"][0]
+        stack_instance = stack_instances["Summaries"][0]
         # Stack instances are in progress of being updated
         if (
-            stack_instances["Status"] != SYNCHRONIZED_STATUS
-            or stack_instances["StackInstanceStatus"]["DetailedStatus"] != SUCCESS_DETAILED_STATUS
+            stack_instance["Status"] != SYNCHRONIZED_STATUS
+            or stack_instance["StackInstanceStatus"]["DetailedStatus"] != SUCCESS_DETAILED_STATUS
         ):
-            raise StackSetUpdateInProgressException("Stack Instances is being updated")
+            return None
+
+        self.record_stack_operation_timing(stack_operation=stack_operation["StackSetOperation"])
+        return stack_instance
+
+    def check_stacksets_update_complete(self, stacksets, update_level):
+        """Check the progress of the update of several stacksets in one batched pass.
+
+        Update level can be: stackset (updating params) or instance (updating instance state), the stacksets
+        drained from the operation queues carry their own.
+        Returns a tuple of the finished stacksets, with the "state" and "instance_type" of their
+        instances, and of the stacksets still being updated, annotated with their topology.
+        """
+        self.logger.info(f"check_stacksets_update_complete: {stacksets=} {update_level=}")
+        pending = []
+
+        # Check the progress of the stackset operations concurrently
+        ready = [stackset for stackset in stacksets if not stackset.get("operation_id")]
+        with_operation = [stackset for stackset in stacksets if stackset.get("operation_id")]
+        if with_operation:
+            cf_client = boto3.client("cloudformation")
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                stack_instances = executor.map(
+                    lambda stackset: self.get_synchronized_stack_instance(
+                        cf_client=cf_client, stackset_id=stackset["stackset_id"], operation_id=stackset["operation_id"]
+                    ),
+                    with_operation,
+                )
+
+                for stackset, stack_instance in zip(with_operation, stack_instances):
+                    if stack_instance is None:
+                        pending.append(stackset)
+                        continue
+
+                    ready.append(
+                        {
+                            **stackset,
+                            "account_id": stack_instance["Account"],
+                            "region": stack_instance["Region"],
+                            "stack_id": stack_instance["StackId"],
+                        }
+                    )
 
-        # Check the state of the running ec2 instances
-        account_id = stack_instances["Account"]
-        region = stack_instances["Region"]
-        stack_id = stack_instances["StackId"]
+        # Resolve the instances backing the stacksets, and group them by account and region
+        topologies = {}
+        region_to_stacksets = defaultdict(list)
+        for stackset in ready:
+            stackset_id = stackset["stackset_id"]
+            topology = self.get_stackset_topology(
+                stackset_id=stackset_id, **{key: stackset.get(key) for key in STACKSET_TOPOLOGY_KEYS}
+            )
+            topologies[stackset_id] = topology
+            region_to_stacksets[(topology["account_id"], topology["region"])].append(stackset)
 
-        stack_client = self.get_remote_client(account_id=account_id, region=region, service="cloudformation")
-        described_stacks = stack_client.describe_stacks(StackName=stack_id)
-        self.logger.info(f"check_stackset_update_complete: {described_stacks=}")
+        # Describe the instances of each account and region with a single call
+        finished = []
+        for (account_id, region), region_stacksets in region_to_stacksets.items():
+            ec2_client = self.get_remote_client(account_id=account_id, region=region, service="ec2")
+            described_instances = ec2_client.describe_instances(
+                InstanceIds=[topologies[stackset["stackset_id"]]["instance_id"] for stackset in region_stacksets]
+            )
 
-        current_stack = described_stacks["Stacks"][0]
-        output_dict = self.parse_stack_outputs(current_stack["Outputs"])
-        instance_id = output_dict["InstanceID"]
+            ec2_instances = {
+                instance["InstanceId"]: instance
+                for reservation in described_instances.get("Reservations", [])
+                for instance in reservation["Instances"]
+            }
 
-        ec2_client = self.get_remote_client(account_id=account_id, region=region, service="ec2")
-        described_instances = ec2_client.describe_instances(InstanceIds=[instance_id])
+            for stackset in region_stacksets:
+                topology = topologies[stackset["stackset_id"]]
+                ec2_instance = ec2_instances.get(topology["instance_id"])
+                if not ec2_instance:
+                    self.logger.info(f"{described_instances=}")
+                    raise InvalidApplicationState(message=f"Could not find the ec2 instance {topology['instance_id']}")
+
+                state = ec2_instance["State"]["Name"]
+                if state in EC2_INSTANCE_FINAL_STATES:
+                    finished.append(
+                        {
+                            "stackset_id": stackset["stackset_id"],
+                            "state": state,
+                            "instance_type": ec2_instance["InstanceType"],
+                        }
+                    )
+                else:
+                    pending.append({**stackset, **topology})
 
-        if (
-            len(described_instances.get("Reservations", [])) != 1
-            or len(described_instances["Reservations"][0]["Instances"]) != 1
-        ):
-            self.logger.info(f"{described_instances=}")
-            raise InvalidApplicationState(message="Unexpected number of ec2 instances")
+        self.logger.info(f"check_stacksets_update_complete: {finished=} {pending=}")
+        return finished, pending
 
-        ec2_instance = described_instances["Reservations"][0]["Instances"][0]
-        state = ec2_instance["State"]["Name"]
+    def complete_stackset_updates(self, finished):
+        # Finished: list of dicts with "stackset_id", "state" and "instance_type"
+        dynamodb_client = boto3.client("dynamodb")
+
+        for batch in chunks(finished, DYNAMODB_TRANSACTION_LIMIT):
+            dynamodb_client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": self.state_table_name,
+                            "Key": {"stacksetID": {"S": item["stackset_id"]}},
+                            "UpdateExpression": (
+                                "SET instanceType = :instanceType, instanceStatus = :instanceStatus, "
+                                "updatedAt = :updatedAt REMOVE updateTaskToken"
+                            ),
+                            "ConditionExpression": "attribute_exists(stacksetID)",
+                            "ExpressionAttributeValues": {
+                                ":instanceType": {"S": item["instance_type"]},
+                                ":instanceStatus": {"S": item["state"]},
+                                ":updatedAt": {"S": get_update_stamp()},
+                            },
+                        }
+                    }
+                    for item in batch
+                ]
+            )
 
-        if state not in EC2_INSTANCE_FINAL_STATES:
-            raise StackSetUpdateInProgressException("EC2 instance is still being updated.")
+        self.invalidate_listings()
 
     def delete_stack_instance(self, stackset_id, account_id, region):
         cfn_client = boto3.client("cloudformation")
 
+        submitted_at = perf_counter()
         response = cfn_client.delete_stack_instances(
             StackSetName=stackset_id,
             Accounts=[account_id],
             Regions=[region],
             RetainStacks=False,
+            OperationPreferences=self.operation_preferences[STACKSET_DELETE_ACTION],
+        )
+        self.record_operation_timing(
+            action=STACKSET_DELETE_ACTION,
+            timings={"SubmitDuration": perf_counter() - submitted_at},
+            properties={"stackset_id": stackset_id, "operation_id": response["OperationId"]},
         )
 
         return response["OperationId"]
 
+    def claim_recycled_stack_sets(self, template_filename, count):
+        # Take up to `count` empty stacksets created from the template out of the recycling pool
+        client = boto3.client("dynamodb")
+        response = client.query(
+            TableName=self.stackset_pool_table_name,
+            KeyConditionExpression="templateFile = :templateFile",
+            ExpressionAttributeValues={":templateFile": {"S": template_filename}},
+            Limit=count,
+        )
+
+        claimed = []
+        for item in response["Items"]:
+            try:
+                client.delete_item(
+                    TableName=self.stackset_pool_table_name,
+                    Key={"templateFile": item["templateFile"], "stacksetId": item["stacksetId"]},
+                    ConditionExpression="attribute_exists(stacksetId)",
+                )
+            except ClientError as e:
+                # Claimed by a concurrent request in the meantime
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                continue
+
+            claimed.append(item["stacksetId"]["S"])
+            self.forget_stackset_topology(stackset_id=item["stacksetId"]["S"])
+
+        self.logger.info(f"claim_recycled_stack_sets: {template_filename=} {claimed=}")
+        return claimed
+
+    def recycle_stack_set(self, stackset_id):
+        # Return an emptied stackset to the recycling pool of its template, delete it if the pool is full
+        self.forget_stackset_topology(stackset_id=stackset_id)
+        dynamodb_client = boto3.client("dynamodb")
+        stackset = self.get_stackset_state_data(
+            stackset_id=stackset_id, consistent_read=True, fields=STATE_DELETION_FIELDS
+        )
+        template_filename = stackset.get("template_file")
+
+        if template_filename:
+            pool_size = dynamodb_client.query(
+                TableName=self.stackset_pool_table_name,
+                KeyConditionExpression="templateFile = :templateFile",
+                ExpressionAttributeValues={":templateFile": {"S": template_filename}},
+                Select="COUNT",
+            )["Count"]
+
+            if pool_size < self.stackset_pool_max_size:
+                # Move the StackSet record from the state table to the pool
+                response = dynamodb_client.transact_write_items(
+                    TransactItems=[
+                        {
+                            "Put": {
+                                "TableName": self.stackset_pool_table_name,
+                                "Item": {
+                                    "templateFile": {"S": template_filename},
+                                    "stacksetId": {"S": stackset_id},
+                                    "recycledAt": {"S": datetime.now(timezone.utc).isoformat()},
+                                },
+                            }
+                        },
+                        *self.build_state_entry_deletion(stackset=stackset),
+                    ]
+                )
+                self.invalidate_listings(email=stackset["email"])
+                return response
+
+        return self.delete_stack_set(stackset_id=stackset_id)
+
     def delete_stack_set(self, stackset_id):
         cfn_client = boto3.client("cloudformation")
         cfn_client.delete_stack_set(StackSetName=stackset_id)
 
         # Remove the StackSet record from the state table
         dynamodb_client = boto3.client("dynamodb")
-        response = dynamodb_client.delete_item(
-            TableName=self.state_table_name,
-            Key={"stacksetID": {"S": stackset_id}},
+        stackset = self.get_stackset_state_data(
+            stackset_id=stackset_id, consistent_read=True, fields=STATE_DELETION_FIELDS
         )
+        if not stackset:
+            return None
 
+        response = dynamodb_client.transact_write_items(
+            TransactItems=self.build_state_entry_deletion(stackset=stackset)
+        )
+        self.invalidate_listings(email=stackset["email"])
         return response
+
+    def build_state_entry_deletion(self, stackset):
+        # Transaction items deleting the state entry, taking the instance off its owner's count
+        # and leaving a tombstone for the clients syncing changes
+        items = [
+            {
+                "Delete": {
+                    "TableName": self.state_table_name,
+                    "Key": {"stacksetID": {"S": stackset["stackset_id"]}},
+                    # Never release the same instance twice
+                    "ConditionExpression": "attribute_exists(stacksetID)",
+                }
+            }
+        ]
+        # Unclaimed warm pool instances aren't counted, nor listed, even once taken out of the pool
+        if not stackset["pool_key"] and stackset["email"] != WARM_POOL_OWNER:
+            updated_at = get_update_stamp()
+            items.extend(
+                [
+                    {
+                        "Update": {
+                            "TableName": self.user_counters_table_name,
+                            "Key": {"email": {"S": stackset["email"]}},
+                            "UpdateExpression": "ADD instanceCount :released",
+                            "ExpressionAttributeValues": {":released": {"N": "-1"}},
+                        }
+                    },
+                    {
+                        "Put": {
+                            "TableName": self.tombstones_table_name,
+                            "Item": {
+                                "email": {"S": stackset["email"]},
+                                "tombstoneKey": {"S": f"{updated_at}#{stackset['stackset_id']}"},
+                                "stacksetID": {"S": stackset["stackset_id"]},
+                                "updatedAt": {"S": updated_at},
+                                "expiresAt": {
+                                    "N": str(int((datetime.now(timezone.utc) + self.tombstone_ttl).timestamp()))
+                                },
+                            },
+                        }
+                    },
+                ]
+            )
+
+        return items
+
+    def get_instance_count(self, email):
+        client = boto3.client("dynamodb")
+        item = client.get_item(
+            TableName=self.user_counters_table_name, Key={"email": {"S": email}}, ConsistentRead=True
+        ).get("Item", {})
+
+        return int(item["instanceCount"]["N"]) if "instanceCount" in item else 0
+
+    def reserve_instances(self, email, count, max_instance_count=None):
+        """Count new instances against the quota of their owner with a single conditional write.
+
+        Returns False, without counting them, if they would take the owner over max_instance_count.
+        Superusers leave the limit unset.
+        """
+        remaining = None if max_instance_count is None else max_instance_count - count
+        if remaining is not None and remaining < 0:
+            return False
+
+        client = boto3.client("dynamodb")
+        values = {":count": {"N": str(count)}}
+        condition_kwargs = {}
+        if remaining is not None:
+            values[":remaining"] = {"N": str(remaining)}
+            condition_kwargs["ConditionExpression"] = (
+                "attribute_not_exists(instanceCount) OR instanceCount <= :remaining"
+            )
+        try:
+            client.update_item(
+                TableName=self.user_counters_table_name,
+                Key={"email": {"S": email}},
+                UpdateExpression="ADD instanceCount :count",
+                ExpressionAttributeValues=values,
+                **condition_kwargs,
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    def release_instances(self, email, count):
+        # Give back instances reserved for a request that failed before creating them
+        client = boto3.client("dynamodb")
+        client.update_item(
+            TableName=self.user_counters_table_name,
+            Key={"email": {"S": email}},
+            UpdateExpression="ADD instanceCount :released",
+            ExpressionAttributeValues={":released": {"N": str(-count)}},
+        )
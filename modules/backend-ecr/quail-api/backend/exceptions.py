@@ -50,3 +50,18 @@ class StackSetUpdateInProgressException(BaseQuailException):
 
 class InvalidApplicationState(BaseQuailException):
     pass
+
+
+class IdempotencyKeyReusedError(BaseQuailException):
+    status_code = 422
+    message = "The idempotency key was already used for a different request."
+
+
+class IdempotentRequestInProgressError(BaseQuailException):
+    status_code = 409
+    message = "A request with the same idempotency key is in progress."
+
+
+class SyncTokenExpiredError(BaseQuailException):
+    status_code = 410
+    message = "The sync token expired, list the instances again."
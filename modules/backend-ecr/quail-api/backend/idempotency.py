@@ -0,0 +1,264 @@
+"""Idempotency keys, so that a retried mutation request is answered with the response of the first attempt.
+
+The first request carrying a key claims it and its response is stored for a limited time. Repeated requests with the
+same key get the stored response back, without running the view again. The private API keys its requests by their
+Step Functions task token the same way.
+
+A request holds its key under a lease while it runs. A request that dies without completing or releasing the key,
+e.g. killed by the Lambda timeout, stops holding it once the lease is over, and the next retry takes the key over.
+"""
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from functools import wraps
+from hashlib import sha256
+from threading import Lock
+
+import boto3
+from botocore.exceptions import ClientError
+from flask import current_app, request
+
+from backend.exceptions import (
+    InvalidArgumentsError,
+    IdempotencyKeyReusedError,
+    IdempotentRequestInProgressError,
+)
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENT_REPLAYED_HEADER = "Idempotent-Replayed"
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+IN_PROGRESS_STATUS = "IN_PROGRESS"
+COMPLETED_STATUS = "COMPLETED"
+
+
+def get_request_fingerprint():
+    # Tells apart a retry from a different request reusing the same key
+    digest = sha256()
+    digest.update(f"{request.method} {request.path}\n".encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def get_task_token_key(task_token):
+    # Task tokens can be longer than a DynamoDB key
+    return f"task#{sha256(task_token.encode()).hexdigest()}"
+
+
+class IdempotencyStore(ABC):
+    """Claiming and recording of the keys, the storage is implemented by the subclasses."""
+
+    def __init__(self, ttl, lease):
+        self.ttl = ttl
+        self.lease = lease
+
+    def get_expiry(self):
+        return int((datetime.now(timezone.utc) + self.ttl).timestamp())
+
+    def get_lease_expiry(self):
+        return int((datetime.now(timezone.utc) + self.lease).timestamp())
+
+    @staticmethod
+    def is_claimable(record, now):
+        # Expired keys, and the keys of requests that outlived their lease without completing
+        return record["expires_at"] < now or (
+            record["status"] == IN_PROGRESS_STATUS and record["in_progress_until"] < now
+        )
+
+    @abstractmethod
+    def claim(self, key, fingerprint):
+        """Claim the key for a new request.
+
+        Returns None if the key was claimed, otherwise the record of the request that claimed it first,
+        a dict with "fingerprint", "status" and, once completed, "response".
+        """
+
+    @abstractmethod
+    def complete(self, key, response):
+        # Response: dict with "status_code", "body" and "mimetype"
+        ...
+
+    @abstractmethod
+    def release(self, key):
+        # Forget the key of a failed request, so that it can be retried
+        ...
+
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """Keys kept in the memory of the process, a stand-in for the DynamoDB table in tests and local development."""
+
+    def __init__(self, ttl, lease):
+        super().__init__(ttl=ttl, lease=lease)
+        self.records = {}
+        self.lock = Lock()
+
+    def claim(self, key, fingerprint):
+        with self.lock:
+            record = self.records.get(key)
+            if record and not self.is_claimable(record=record, now=datetime.now(timezone.utc).timestamp()):
+                return dict(record)
+
+            self.records[key] = {
+                "fingerprint": fingerprint,
+                "status": IN_PROGRESS_STATUS,
+                "expires_at": self.get_expiry(),
+                "in_progress_until": self.get_lease_expiry(),
+            }
+            return None
+
+    def complete(self, key, response):
+        with self.lock:
+            if key in self.records:
+                self.records[key].update({"status": COMPLETED_STATUS, "response": response})
+
+    def release(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+
+
+class DynamoDBIdempotencyStore(IdempotencyStore):
+    """Keys stored in a DynamoDB table, expired by DynamoDB TTL on the expiresAt attribute."""
+
+    def __init__(self, table_name, ttl, lease):
+        super().__init__(ttl=ttl, lease=lease)
+        self.table_name = table_name
+
+    def serialize_item(self, item):
+        record = {
+            "fingerprint": item["fingerprint"]["S"],
+            "status": item["status"]["S"],
+            "expires_at": int(item["expiresAt"]["N"]),
+            # Records written before the leases were introduced are held until they expire
+            "in_progress_until": int(item.get("inProgressUntil", item["expiresAt"])["N"]),
+        }
+        if "responseBody" in item:
+            record["response"] = {
+                "status_code": int(item["responseStatusCode"]["N"]),
+                "body": item["responseBody"]["S"],
+                "mimetype": item["responseMimetype"]["S"],
+            }
+
+        return record
+
+    def claim(self, key, fingerprint):
+        client = boto3.client("dynamodb")
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "idempotencyKey": {"S": key},
+                    "fingerprint": {"S": fingerprint},
+                    "status": {"S": IN_PROGRESS_STATUS},
+                    "expiresAt": {"N": str(self.get_expiry())},
+                    "inProgressUntil": {"N": str(self.get_lease_expiry())},
+                },
+                # TTL deletion lags behind, expired keys can be claimed again straight away
+                ConditionExpression=(
+                    "attribute_not_exists(idempotencyKey) OR expiresAt < :now "
+                    "OR (#status = :inProgress AND inProgressUntil < :now)"
+                ),
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={
+                    ":now": {"N": str(int(datetime.now(timezone.utc).timestamp()))},
+                    ":inProgress": {"S": IN_PROGRESS_STATUS},
+                },
+            )
+            return None
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+        response = client.get_item(TableName=self.table_name, Key={"idempotencyKey": {"S": key}}, ConsistentRead=True)
+        if "Item" not in response:
+            # Released in the meantime, the first request failed
+            return self.claim(key=key, fingerprint=fingerprint)
+
+        record = self.serialize_item(response["Item"])
+        if self.is_claimable(record=record, now=datetime.now(timezone.utc).timestamp()):
+            # The lease ran out between the write and the read
+            return self.claim(key=key, fingerprint=fingerprint)
+
+        return record
+
+    def complete(self, key, response):
+        client = boto3.client("dynamodb")
+        client.update_item(
+            TableName=self.table_name,
+            Key={"idempotencyKey": {"S": key}},
+            UpdateExpression=(
+                "SET #status = :completed, responseStatusCode = :statusCode, "
+                "responseBody = :body, responseMimetype = :mimetype"
+            ),
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={
+                ":completed": {"S": COMPLETED_STATUS},
+                ":statusCode": {"N": str(response["status_code"])},
+                ":body": {"S": response["body"]},
+                ":mimetype": {"S": response["mimetype"]},
+            },
+        )
+
+    def release(self, key):
+        client = boto3.client("dynamodb")
+        client.delete_item(TableName=self.table_name, Key={"idempotencyKey": {"S": key}})
+
+
+def idempotent(view):
+    """Let clients retry the view safely by sending an Idempotency-Key header.
+
+    Keys are scoped to the user sending them. Responses other than server errors are stored and replayed,
+    requests that raise or fail with a server error release the key, so that they can be retried.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise InvalidArgumentsError(
+                message=f"The {IDEMPOTENCY_KEY_HEADER} header is limited to {IDEMPOTENCY_KEY_MAX_LENGTH} characters."
+            )
+
+        email = current_app.aws.get_claims(request=request)["email"]
+        scoped_key = f"{email}#{key}"
+        fingerprint = get_request_fingerprint()
+
+        store = current_app.idempotency_store
+        record = store.claim(key=scoped_key, fingerprint=fingerprint)
+        if record:
+            if record["fingerprint"] != fingerprint:
+                raise IdempotencyKeyReusedError()
+            if record["status"] != COMPLETED_STATUS:
+                raise IdempotentRequestInProgressError()
+
+            current_app.logger.info(f"idempotent: replaying the response of {scoped_key=}")
+            stored_response = record["response"]
+            response = current_app.response_class(
+                stored_response["body"], status=stored_response["status_code"], mimetype=stored_response["mimetype"]
+            )
+            response.headers[IDEMPOTENT_REPLAYED_HEADER] = "true"
+            return response
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            store.release(key=scoped_key)
+            raise
+
+        if response.status_code >= 500:
+            store.release(key=scoped_key)
+        else:
+            store.complete(
+                key=scoped_key,
+                response={
+                    "status_code": response.status_code,
+                    "body": response.get_data(as_text=True),
+                    "mimetype": response.mimetype,
+                },
+            )
+
+        return response
+
+    return wrapper
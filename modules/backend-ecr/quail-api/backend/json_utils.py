@@ -0,0 +1,52 @@
+"""JSON encoding of the responses and of the AWS payloads, with orjson if it's installed and the stdlib otherwise."""
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    # Compact JSON string, dict keys that aren't strings are converted like the stdlib does
+    if orjson is None:
+        return json.dumps(obj, separators=(",", ":"))
+
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def loads(value):
+    if orjson is None:
+        return json.loads(value)
+
+    return orjson.loads(value)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's default JSON provider, encoding with orjson when it's installed.
+
+    Dates, decimals and the other types orjson doesn't handle the way Flask does are still converted by the
+    provider's default function, so the responses are the same as with the stdlib, minus the whitespace and
+    the escaping of non-ASCII characters.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+
+        return orjson.loads(s)
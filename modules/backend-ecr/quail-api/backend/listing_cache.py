@@ -0,0 +1,58 @@
+"""In-process cache of the serialized GET /instance responses, keyed by the user they were computed for."""
+
+from threading import Lock
+
+from cachetools import TTLCache
+
+
+class ListingCache:
+    """LRU of serialized listings, keyed by the user, the permissions snapshot version and the query parameters.
+
+    Writes made through AwsUtils in this process invalidate the listings of the affected user, and the superuser
+    listings which include every user's stacksets. Writes made by other processes, e.g. the instance status updates
+    of the private API, are only picked up once the entries expire.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(email, groups, is_superuser, snapshot_version, query):
+        # Query: list of (parameter, value) pairs of the request
+        return email, tuple(sorted(groups)), is_superuser, snapshot_version, tuple(sorted(query))
+
+    def get(self, key):
+        # Returns the (etag, body) pair of the listing, None if it isn't cached
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return entry
+
+    def set(self, key, etag, body):
+        with self.lock:
+            self.entries[key] = (etag, body)
+
+    def invalidate(self, email=None):
+        # Drop the listings of the given user and of the superusers, or all of them if the user isn't known
+        with self.lock:
+            stale_keys = [key for key in self.entries.keys() if email is None or key[0] == email or key[2]]
+            for key in stale_keys:
+                self.entries.pop(key, None)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "entries": len(self.entries),
+                "bytes": sum(len(body) for _, body in self.entries.values()),
+            }
@@ -13,16 +13,15 @@ def create_blueprint():
 def register_routes(blueprint):
     # Add rules for serving the API
     blueprint.add_url_rule("/provision", "provision", view_func=views.post_provision, methods=["post"])
+    blueprint.add_url_rule(
+        "/provisionFailure", "provision-failure", view_func=views.post_provision_failure, methods=["post"]
+    )
     blueprint.add_url_rule("/wait", "wait", view_func=views.get_wait)
+    blueprint.add_url_rule("/wait", "post-wait", view_func=views.post_wait, methods=["post"])
     blueprint.add_url_rule(
         "/waitForUpdateCompletion",
         "wait-for-update-completion",
-        view_func=views.get_wait_for_update_completion,
-    )
-    blueprint.add_url_rule(
-        "/updateComplete",
-        "update-complete",
-        view_func=views.post_update_complete,
+        view_func=views.post_wait_for_update_completion,
         methods=["post"],
     )
     blueprint.add_url_rule(
@@ -55,12 +54,31 @@ def register_routes(blueprint):
         view_func=views.post_cleanup_complete,
         methods=["post"],
     )
+    blueprint.add_url_rule(
+        "/instanceStateChange",
+        "instance-state-change",
+        view_func=views.post_instance_state_change,
+        methods=["post"],
+    )
     blueprint.add_url_rule(
         "/cleanupSchedule",
         "cleanup-schedule",
         view_func=views.post_cleanup_schedule,
         methods=["post"],
     )
+    blueprint.add_url_rule(
+        "/replenishWarmPool",
+        "replenish-warm-pool",
+        view_func=views.post_replenish_warm_pool,
+        methods=["post"],
+    )
+    blueprint.add_url_rule(
+        "/scheduleProvisioning",
+        "schedule-provisioning",
+        view_func=views.post_schedule_provisioning,
+        methods=["post"],
+    )
+    blueprint.add_url_rule("/provisioningQueue", "provisioning-queue", view_func=views.get_provisioning_queue)
     # Temporary endpoint
     # TODO: Clean up
     blueprint.add_url_rule(
@@ -1,30 +1,27 @@
 import json
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
-from flask import request, current_app
+from flask import request, current_app, g
 
+from backend.aws_utils import (
+    UpdateLevel,
+    EC2_INSTANCE_FINAL_STATES,
+    WARM_POOL_OWNER,
+    format_event_time,
+    get_update_stamp,
+)
 from backend.email_utils import send_email, format_expiry
 from backend.exceptions import InstanceUpdateError
+from backend.tag_utils import get_tags
 from backend.serializers import (
     WaitRequestValidator,
+    ProvisioningWaitRequestValidator,
     WaitForUpdateCompletionRequestValidator,
+    InstanceStateChangeEventValidator,
 )
 
 
-def get_tags(environment, tag_config):
-    tags = []
-
-    for tag in tag_config:
-        if tag["tag-value"].startswith("$"):
-            # Skip leading dollar sign
-            attribute_key = tag["tag-value"][1:]
-            tag["tag-value"] = environment[attribute_key]
-
-        tags.append(tag)
-
-    return tags
-
-
 def post_provision():
     # Get body params
     payload = request.json
@@ -40,7 +37,7 @@ def post_provision():
     user_claims = payload["user"]
     tags = get_tags(environment={**user_claims, "group": payload["group"]}, tag_config=tag_config)
 
-    stackset_id, create_operation_id = current_app.aws.create_stack_set(
+    stacksets = current_app.aws.create_stack_sets(
         project_name=project_name,
         tags=tags,
         account=payload["account"],
@@ -50,17 +47,33 @@ def post_provision():
         expiry=datetime.fromisoformat(payload["expiry"]),
         email=payload["email"],
         group=payload["group"],
-        instance_name=payload["instance_name"],
+        instance_names=payload["instance_names"],
         username=payload["username"],
+        fleet_id=payload["fleet_id"],
     )
 
     return {
-        "stackset_id": stackset_id,
+        "fleet_id": payload["fleet_id"],
+        "stacksets": stacksets,
         "stackset_email": payload["email"],
-        "operation_id": create_operation_id,
+        # Passed along to release the capacity held in the provisioning queue once done
+        "account": payload["account"],
+        "queue_request_id": payload.get("queue_request_id"),
     }
 
 
+def post_provision_failure():
+    # The Provision state failed, so no state entries were written for the instances. Give back the quota
+    # they were counted against and their slot in the provisioning queue, nothing else would release them.
+    payload = request.json
+    current_app.logger.warning(f"Provisioning failed before creating the instances: {payload.get('error')}")
+
+    complete_provisioning_request(payload)
+    current_app.aws.release_instances(email=payload["email"], count=len(payload["instance_names"]))
+
+    return {}, 204
+
+
 def get_wait():
     wait_data = WaitRequestValidator().load(request.args)
 
@@ -71,30 +84,123 @@ def get_wait():
     return {}, 204
 
 
-def get_wait_for_update_completion():
-    wait_data = WaitForUpdateCompletionRequestValidator().load(request.args)
+def post_wait():
+    wait_data = ProvisioningWaitRequestValidator().load(request.json)
 
-    current_app.aws.check_stackset_update_complete(
-        stackset_id=wait_data["stackset_id"],
-        update_level=wait_data["update_level"],
-        operation_id=wait_data["operation_id"],
-    )
+    current_app.aws.check_stacksets_complete(stacksets=wait_data["stacksets"])
 
     return {}, 204
 
 
-def post_notify_success():
+def post_wait_for_update_completion():
+    wait_data = WaitForUpdateCompletionRequestValidator().load(request.json)
+    update_level = wait_data["update_level"]
+
+    finished, pending = current_app.aws.check_stacksets_update_complete(
+        stacksets=wait_data["stacksets"],
+        update_level=update_level,
+    )
+
+    # Finalize the stacksets as they complete, without waiting for the rest of the batch
+    drained = []
+    if finished:
+        current_app.aws.complete_stackset_updates(finished=finished)
+        # Run the operations queued behind the finished ones as part of this same execution
+        drained = current_app.aws.drain_stackset_operations(
+            stackset_ids=[stackset["stackset_id"] for stackset in finished]
+        )
+
+    if drained:
+        # The queued operations get the full update timeout
+        return {"complete": False, "stacksets": [*pending, *drained], "drained": True}
+
+    if not pending:
+        return {"complete": True}
+
+    task_token = request.headers.get("TaskToken")
+    awaiting_instances_only = all(
+        (stackset.get("update_level") or update_level) == UpdateLevel.INSTANCE_LEVEL.value
+        and not stackset.get("operation_id")
+        for stackset in pending
+    )
+    if task_token and not finished and awaiting_instances_only:
+        # Park the task token on the state entries instead of polling, EC2 state-change
+        # events resolve it as soon as one of the instances settles. If no event arrives, the task
+        # heartbeat times out and the state machine falls back to polling.
+        stackset_ids = [stackset["stackset_id"] for stackset in pending]
+        current_app.aws.store_update_task_token(stackset_ids=stackset_ids, task_token=task_token)
+        g.defer_task_callback = True
+
+        # An event recorded between the check and the parking of the token found no token to resolve
+        stacksets = current_app.aws.get_stacksets_state_data(
+            stackset_ids=stackset_ids, fields=["instance_status"], consistent=True
+        )
+        settled = [
+            stackset_id
+            for stackset_id, stackset in stacksets.items()
+            if stackset["instance_status"] in EC2_INSTANCE_FINAL_STATES
+        ]
+        for stackset_id in settled:
+            # A single callback is enough, the update monitor checks all the stacksets again
+            if current_app.aws.resolve_update_task_token(stackset_id=stackset_id, task_token=task_token):
+                break
+
+        return {}, 202
+
+    # The pending stacksets replace the monitored ones, so the finished ones aren't checked again
+    return {"complete": False, "stacksets": pending}
+
+
+def parse_instance_state_change_events(payload):
+    # Events are either delivered by SQS in batches, or posted directly as a list or a single event
+    if "Records" in payload:
+        raw_events = [json.loads(record["body"]) for record in payload["Records"]]
+    elif "events" in payload:
+        raw_events = payload["events"]
+    else:
+        raw_events = [payload]
+
+    return InstanceStateChangeEventValidator(many=True).load(raw_events)
+
+
+def post_instance_state_change():
+    events = parse_instance_state_change_events(request.json)
+
+    # Only keep the most recent event for each instance
+    latest_events = {}
+    for event in sorted(events, key=lambda item: item["time"]):
+        latest_events[event["detail"]["instance_id"]] = event
+
+    stacksets = current_app.aws.get_stacksets_by_instance_ids(instance_ids=list(latest_events.keys()))
+    current_app.logger.info("state change events for stacksets: %s", list(stacksets.keys()))
+
+    status_changes = [
+        {
+            "stackset_id": stackset["stackset_id"],
+            "instance_id": instance_id,
+            "state": latest_events[instance_id]["detail"]["state"],
+            "time": format_event_time(latest_events[instance_id]["time"]),
+        }
+        for instance_id, stackset in stacksets.items()
+    ]
+    applied = current_app.aws.update_instance_statuses(status_changes=status_changes)
+
+    # Resolve the update state machines waiting for the instances to settle
+    for change in applied:
+        task_token = stacksets[change["instance_id"]]["update_task_token"]
+        if task_token and change["state"] in EC2_INSTANCE_FINAL_STATES:
+            current_app.aws.resolve_update_task_token(stackset_id=change["stackset_id"], task_token=task_token)
+
+    return {"updated": [change["stackset_id"] for change in applied]}
+
+
+def notify_stackset_success(stackset_id, stackset_email):
     # read in data from environment
     project_name = current_app.config["PROJECT_NAME"]
     notification_email = current_app.config["NOTIFICATION_EMAIL"]
 
-    # read in data passed to the lambda call
-    payload = request.json
-    stackset_id = payload["stackset_id"]
-    stackset_email = payload["stackset_email"]
-
     # Get config from dynamodb
-    stack_set = current_app.aws.get_one_stack_set(stackset_id=stackset_id)
+    stack_set = current_app.aws.get_one_stack_set(stackset_id=stackset_id, fields=["expiry"])
     current_app.logger.info("state data: %s", stack_set)
 
     instances = list(current_app.aws.fetch_stackset_instances(stackset_id=stackset_id))
@@ -130,45 +236,25 @@ def post_notify_success():
     )
     current_app.logger.info("send mail response : %s", response)
 
-    return {}, 204
 
-
-def post_update_complete():
+def post_notify_success():
     # read in data passed to the lambda call
     payload = request.json
-    stackset_id = payload["stackset_id"]
 
-    # Get config from dynamodb
-    stackset = current_app.aws.get_one_stack_set(stackset_id=stackset_id)
-    current_app.logger.info("state data: %s", stackset)
+    for entry in payload["stacksets"]:
+        notify_stackset_success(stackset_id=entry["stackset_id"], stackset_email=payload["stackset_email"])
 
-    instances = current_app.aws.get_instance_details(stacksets=[stackset])
-    instance_data = instances[0]
-    current_app.logger.info("instances: %s", instances)
-    current_app.logger.info("instance data: %s", instance_data)
-
-    current_app.aws.update_stackset_state_entry(
-        stackset_id=stackset_id,
-        data=[
-            {"field_name": "instanceType", "value": instance_data["instanceType"]},
-            {"field_name": "instanceStatus", "value": instance_data["state"]},
-        ],
-    )
+    complete_provisioning_request(payload=payload)
 
     return {}, 204
 
 
-def post_notify_failure():
+def notify_stackset_failure(stackset_id, stackset_email):
     # read in app configuration
     project_name = current_app.config["PROJECT_NAME"]
     notification_email = current_app.config["NOTIFICATION_EMAIL"]
     admin_email = current_app.config["ADMIN_EMAIL"]
 
-    # read in data passed to the lambda call
-    payload = request.json
-    stackset_id = payload["stackset_id"]
-    stackset_email = payload["stackset_email"]
-
     # send SNS failure notification
     current_app.aws.send_error_sns_message(stackset_id=stackset_id)
 
@@ -198,24 +284,34 @@ def post_notify_failure():
         )
         current_app.logger.info(f"SFN cleanup execution response: {response}")
 
+
+def post_notify_failure():
+    # read in data passed to the lambda call
+    payload = request.json
+
+    for entry in payload["stacksets"]:
+        notify_stackset_failure(stackset_id=entry["stackset_id"], stackset_email=payload["stackset_email"])
+
+    complete_provisioning_request(payload=payload)
+
     return {}, 204
 
 
-def post_update_failure():
+def fail_stackset_update(stackset_id):
     # read in app configuration
     project_name = current_app.config["PROJECT_NAME"]
     notification_email = current_app.config["NOTIFICATION_EMAIL"]
     admin_email = current_app.config["ADMIN_EMAIL"]
 
-    # read in data passed to the lambda call
-    payload = request.json
-    stackset_id = payload["stackset_id"]
-
     # send SNS failure notification
     current_app.aws.send_error_sns_message(stackset_id=stackset_id)
 
     # fetch stackset state to access the user's email
-    stackset = current_app.aws.get_one_stack_set(stackset_id=stackset_id)
+    stackset = current_app.aws.get_one_stack_set(stackset_id=stackset_id, fields=["email", "update_task_token"])
+    if stackset["update_task_token"]:
+        current_app.aws.clear_update_task_token(stackset_id=stackset_id)
+    # Let later operations on the stackset through, the queued ones were meant to follow the failed one
+    current_app.aws.abandon_stackset_operations(stackset_id=stackset_id, email=stackset["email"])
 
     for instance_data in current_app.aws.fetch_stackset_instances(stackset_id=stackset_id, acceptable_statuses=None):
         template_data = {
@@ -248,6 +344,14 @@ def post_update_failure():
             ],
         )
 
+
+def post_update_failure():
+    # read in data passed to the lambda call
+    payload = request.json
+
+    for entry in payload["stacksets"]:
+        fail_stackset_update(stackset_id=entry["stackset_id"])
+
     return {}, 204
 
 
@@ -272,6 +376,10 @@ def post_cleanup_start():
         region=instance_data["region"],
     )
 
+    # Unclaimed warm pool instances have no one to notify
+    if owner_email == WARM_POOL_OWNER:
+        return {"stackset_id": stackset_id, "operation_id": operation_id}
+
     template_data = {
         "account": instance_data["account_id"],
         "region": instance_data["region"],
@@ -297,28 +405,105 @@ def post_cleanup_complete():
     payload = request.json
     stackset_id = payload["stackset_id"]
 
-    # Delete StackSet
-    response = current_app.aws.delete_stack_set(stackset_id=stackset_id)
+    # Return the now empty StackSet to the recycling pool, or delete it
+    response = current_app.aws.recycle_stack_set(stackset_id=stackset_id)
     current_app.logger.info(response)
 
     return response
 
 
+def complete_provisioning_request(payload):
+    # Executions started before the provisioning queue was introduced aren't tracked by it
+    if not payload.get("queue_request_id"):
+        return
+
+    current_app.provisioning_queue.complete(account=payload["account"], request_id=payload["queue_request_id"])
+    schedule_provisioning()
+
+
+def schedule_provisioning():
+    queue = current_app.provisioning_queue
+
+    expired, started, stats = queue.run(
+        start=lambda queued_request: current_app.aws.start_provisioning(
+            provisioning_input={**queued_request["payload"], "queue_request_id": queued_request["request_id"]}
+        ),
+        max_in_flight_age=timedelta(seconds=current_app.config["PROVISIONING_IN_FLIGHT_TIMEOUT"]),
+    )
+    for queued_request in expired:
+        current_app.logger.warning(
+            f"Provisioning request never reported back, released its capacity: {queued_request=}"
+        )
+    current_app.logger.info(
+        f"Started provisioning requests: {[queued_request['request_id'] for queued_request in started]}"
+    )
+
+    current_app.aws.record_metrics(
+        dimensions={"Queue": "provisioning"},
+        metrics={"QueueDepth": stats["queued"], "InstancesInFlight": stats["in_flight"]},
+        unit="Count",
+    )
+    current_app.aws.record_metrics(
+        dimensions={"Queue": "provisioning"},
+        metrics={"OldestWaitTime": stats["oldest_wait_seconds"]},
+        unit="Seconds",
+    )
+
+    return started, stats
+
+
+def post_schedule_provisioning():
+    started, stats = schedule_provisioning()
+
+    return {"started": [queued_request["request_id"] for queued_request in started], **stats}
+
+
+def get_provisioning_queue():
+    return current_app.provisioning_queue.get_stats()
+
+
+def post_replenish_warm_pool():
+    # read in data from environment
+    project_name = current_app.config["PROJECT_NAME"]
+
+    pools = []
+    for target in current_app.config["WARM_POOL_TARGETS"]:
+        permissions = current_app.aws.get_permissions_for_one_group(group_name=target["group"])
+
+        # Pooled instances have no owner yet, user-specific tags are set when they are claimed
+        tags = get_tags(
+            environment=defaultdict(str, group=target["group"]),
+            tag_config=json.loads(current_app.config["TAG_CONFIG"]),
+        )
+
+        pool = current_app.aws.replenish_warm_pool(
+            project_name=project_name,
+            tags=tags,
+            expiry=datetime.now(timezone.utc) + timedelta(days=permissions["max_days_to_expiry"]),
+            **target,
+        )
+        current_app.logger.info(f"Replenished warm pool: {pool=}")
+        pools.append(pool)
+
+    return {"pools": pools}
+
+
 def post_cleanup_schedule():
     # read in data from environment
     project_name = current_app.config["PROJECT_NAME"]
     notification_email = current_app.config["NOTIFICATION_EMAIL"]
     cleanup_notice_notification_hours = json.loads(current_app.config["CLEANUP_NOTICE_NOTIFICATION_HOURS"])
 
-    stack_sets = current_app.aws.get_all_stacksets()
-    current_app.logger.debug("Current state data: %s", stack_sets)
-
-    # Make provisions for paging of the results
+    # The whole table is scanned, one page of records at a time
     now = datetime.now(timezone.utc)
-    for entry in stack_sets:
-        stackset_id = entry["stackset_id"]
-        owner_email = entry["email"]
-        expiry = datetime.fromisoformat(entry["expiry"])
+    for entry in current_app.aws.iter_stackset_records(fields=["email", "expiry", "pool_key"]):
+        # Warm pool stacksets are managed by the pool replenisher
+        if entry.pool_key:
+            continue
+
+        stackset_id = entry.stackset_id
+        owner_email = entry.email
+        expiry = datetime.fromisoformat(entry.expiry)
 
         if expiry <= now:
             # If instance is expired, kick off cleanup
@@ -369,7 +554,7 @@ def post_migrate_data():
     import boto3  # noqa
 
     # Get all state data
-    stacksets = current_app.aws.get_all_stacksets()
+    stacksets = current_app.aws.get_all_stacksets(fields=["account", "email", "expiry", "group", "username"])
 
     # Find data that's incomplete
     stacksets = [entry for entry in stacksets if entry["account"] is None]
@@ -398,7 +583,8 @@ def post_migrate_data():
                 "connectionProtocol = :connectionProtocol,"
                 "privateIp = :privateIp,"
                 "instanceId = :instanceId,"
-                "instanceStatus = :instanceStatus"
+                "instanceStatus = :instanceStatus,"
+                "updatedAt = :updatedAt"
             ),
             ExpressionAttributeValues={
                 ":account": {"S": entry["account_id"]},
@@ -410,6 +596,7 @@ def post_migrate_data():
                 ":privateIp": {"S": entry["private_ip"]},
                 ":instanceId": {"S": entry["instance_id"]},
                 ":instanceStatus": {"S": entry["state"]},
+                ":updatedAt": {"S": get_update_stamp()},
             },
             ExpressionAttributeNames={
                 "#region": "region",
@@ -0,0 +1,402 @@
+"""Provisioning queue, bounding the number of StackSet operations in flight in each target account.
+
+Requests are queued per target account and started by the scheduler in the private API. Capacity freed in an
+account is shared fairly across the groups waiting for it.
+"""
+
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timezone
+from operator import itemgetter
+from threading import Lock
+from uuid import uuid4
+
+import boto3
+from botocore.exceptions import ClientError
+
+from backend import json_utils
+
+QUEUED_STATUS = "QUEUED"
+IN_FLIGHT_STATUS = "IN_FLIGHT"
+# Request ID of the item counting the instances in flight in an account, sorts before the request IDs
+IN_FLIGHT_COUNTER_ID = "#in-flight"
+
+
+def select_requests_to_start(requests, max_in_flight_per_account):
+    """Pick the queued requests to start, without exceeding the in-flight limit of any account.
+
+    Requests weigh as many slots as the instances they provision. Each free slot of an account goes to the group
+    with the fewest instances in flight in that account, ties are broken by the oldest queued request. A request
+    bigger than the limit is only started once nothing else is in flight in its account.
+    """
+    requests_by_account = defaultdict(list)
+    for request in requests:
+        requests_by_account[request["account"]].append(request)
+
+    selected = []
+    for account_requests in requests_by_account.values():
+        in_flight = Counter()
+        for request in account_requests:
+            if request["status"] == IN_FLIGHT_STATUS:
+                in_flight[request["group"]] += request["size"]
+
+        queued = defaultdict(deque)
+        for request in sorted(account_requests, key=itemgetter("enqueued_at")):
+            if request["status"] == QUEUED_STATUS:
+                queued[request["group"]].append(request)
+
+        while queued:
+            group = min(queued, key=lambda group: (in_flight[group], queued[group][0]["enqueued_at"]))
+            request = queued[group][0]
+
+            in_flight_total = sum(in_flight.values())
+            if in_flight_total and in_flight_total + request["size"] > max_in_flight_per_account:
+                # Keep the slots for the head of the fairest group, rather than letting smaller requests overtake it
+                break
+
+            selected.append(queued[group].popleft())
+            in_flight[group] += request["size"]
+            if not queued[group]:
+                del queued[group]
+
+    return selected
+
+
+class ProvisioningQueue(ABC):
+    """Scheduling logic of the queue, the storage is implemented by the subclasses."""
+
+    def __init__(self, max_in_flight_per_account):
+        self.max_in_flight_per_account = max_in_flight_per_account
+
+    def enqueue(self, account, group, size, payload):
+        enqueued_at = datetime.now(timezone.utc).isoformat()
+        request = {
+            "account": account,
+            # Sorts the requests of an account in the order they were queued
+            "request_id": f"{enqueued_at}#{uuid4()}",
+            "group": group,
+            "size": size,
+            "status": QUEUED_STATUS,
+            "enqueued_at": enqueued_at,
+            "started_at": None,
+            "payload": payload,
+        }
+        self.put_request(request)
+
+        return request
+
+    def run(self, start, max_in_flight_age):
+        """Expire the stale requests, start the queued ones that fit and compute the stats, listing the queue once.
+
+        Returns the expired requests, the started requests and the stats after the run.
+        """
+        requests = self.list_requests()
+
+        expired = self.expire(max_in_flight_age=max_in_flight_age, requests=requests)
+        expired_ids = {request["request_id"] for request in expired}
+        requests = [request for request in requests if request["request_id"] not in expired_ids]
+
+        # The started requests are marked in flight in the listing, the stats account for them
+        started = self.schedule(start=start, requests=requests)
+
+        return expired, started, self.get_stats(requests=requests)
+
+    def schedule(self, start, requests=None):
+        """Start the queued requests that fit in the free capacity.
+
+        start: callable taking a request and starting its provisioning.
+        requests: listing of the queue, listed again if not given. The started requests are marked in flight in it.
+        Returns the started requests.
+        """
+        if requests is None:
+            requests = self.list_requests()
+
+        started = []
+        for request in select_requests_to_start(
+            requests=requests, max_in_flight_per_account=self.max_in_flight_per_account
+        ):
+            # Another scheduler run started it in the meantime
+            if not self.mark_in_flight(request):
+                continue
+
+            try:
+                start(request)
+            except Exception:
+                self.mark_queued(request)
+                raise
+
+            request["status"] = IN_FLIGHT_STATUS
+            started.append(request)
+
+        return started
+
+    def complete(self, account, request_id):
+        self.delete_request(account=account, request_id=request_id)
+
+    def expire(self, max_in_flight_age, requests=None):
+        # Release the slots of requests whose provisioning never reported back
+        now = datetime.now(timezone.utc)
+        expired = [
+            request
+            for request in (self.list_requests() if requests is None else requests)
+            if request["status"] == IN_FLIGHT_STATUS
+            and now - datetime.fromisoformat(request["started_at"]) > max_in_flight_age
+        ]
+        for request in expired:
+            self.delete_request(account=request["account"], request_id=request["request_id"])
+
+        return expired
+
+    def get_stats(self, requests=None):
+        """Queue depth, instances in flight and wait time of the oldest queued request, per account."""
+        now = datetime.now(timezone.utc)
+        accounts = defaultdict(lambda: {"queued": 0, "in_flight": 0, "oldest_wait_seconds": 0})
+        for request in self.list_requests() if requests is None else requests:
+            stats = accounts[request["account"]]
+            if request["status"] == IN_FLIGHT_STATUS:
+                stats["in_flight"] += request["size"]
+                continue
+
+            stats["queued"] += 1
+            wait_seconds = (now - datetime.fromisoformat(request["enqueued_at"])).total_seconds()
+            stats["oldest_wait_seconds"] = max(stats["oldest_wait_seconds"], wait_seconds)
+
+        return {
+            "queued": sum(stats["queued"] for stats in accounts.values()),
+            "in_flight": sum(stats["in_flight"] for stats in accounts.values()),
+            "oldest_wait_seconds": max((stats["oldest_wait_seconds"] for stats in accounts.values()), default=0),
+            "accounts": dict(accounts),
+        }
+
+    # Storage
+    @abstractmethod
+    def put_request(self, request):
+        """Store a queued request."""
+
+    @abstractmethod
+    def list_requests(self):
+        """Every request, queued or in flight."""
+
+    @abstractmethod
+    def mark_in_flight(self, request):
+        """Move a queued request to in flight.
+
+        Returns False if it isn't queued anymore or if it doesn't fit in the capacity of its account,
+        as seen by the storage rather than by the listing of this scheduler run.
+        """
+
+    @abstractmethod
+    def mark_queued(self, request):
+        """Move a request back from in flight to queued."""
+
+    @abstractmethod
+    def delete_request(self, account, request_id):
+        """Forget a request, releasing its capacity if it was in flight."""
+
+
+class InMemoryProvisioningQueue(ProvisioningQueue):
+    """Queue kept in the memory of the process, a stand-in for the DynamoDB queue in tests and local development."""
+
+    def __init__(self, max_in_flight_per_account):
+        super().__init__(max_in_flight_per_account=max_in_flight_per_account)
+        self.requests = {}
+        self.lock = Lock()
+
+    def put_request(self, request):
+        with self.lock:
+            self.requests[(request["account"], request["request_id"])] = dict(request)
+
+    def list_requests(self):
+        with self.lock:
+            return [dict(request) for request in self.requests.values()]
+
+    def mark_in_flight(self, request):
+        with self.lock:
+            stored = self.requests.get((request["account"], request["request_id"]))
+            if not stored or stored["status"] != QUEUED_STATUS:
+                return False
+
+            in_flight = sum(
+                other["size"]
+                for other in self.requests.values()
+                if other["account"] == request["account"] and other["status"] == IN_FLIGHT_STATUS
+            )
+            if in_flight and in_flight + stored["size"] > self.max_in_flight_per_account:
+                return False
+
+            stored["status"] = IN_FLIGHT_STATUS
+            stored["started_at"] = datetime.now(timezone.utc).isoformat()
+            return True
+
+    def mark_queued(self, request):
+        with self.lock:
+            stored = self.requests.get((request["account"], request["request_id"]))
+            if stored:
+                stored["status"] = QUEUED_STATUS
+                stored["started_at"] = None
+
+    def delete_request(self, account, request_id):
+        with self.lock:
+            self.requests.pop((account, request_id), None)
+
+
+class DynamoDBProvisioningQueue(ProvisioningQueue):
+    """Queue stored in a DynamoDB table, keyed by the target account and the request ID.
+
+    Each account also has a counter item, holding the number of instances in flight in the account. Requests are
+    moved in and out of flight in transactions with their counter, conditioned on the capacity left, so concurrent
+    scheduler runs can't exceed the limit of an account.
+    """
+
+    def __init__(self, table_name, max_in_flight_per_account):
+        super().__init__(max_in_flight_per_account=max_in_flight_per_account)
+        self.table_name = table_name
+
+    def serialize_item(self, item):
+        return {
+            "account": item["account"]["S"],
+            "request_id": item["requestId"]["S"],
+            "group": item["group"]["S"],
+            "size": int(item["size"]["N"]),
+            "status": item["status"]["S"],
+            "enqueued_at": item["enqueuedAt"]["S"],
+            "started_at": item["startedAt"]["S"] if "startedAt" in item else None,
+            "payload": json_utils.loads(item["payload"]["S"]),
+        }
+
+    def put_request(self, request):
+        client = boto3.client("dynamodb")
+        client.put_item(
+            TableName=self.table_name,
+            Item={
+                "account": {"S": request["account"]},
+                "requestId": {"S": request["request_id"]},
+                "group": {"S": request["group"]},
+                "size": {"N": str(request["size"])},
+                "status": {"S": request["status"]},
+                "enqueuedAt": {"S": request["enqueued_at"]},
+                "payload": {"S": json_utils.dumps(request["payload"])},
+            },
+        )
+
+    def list_requests(self):
+        client = boto3.client("dynamodb")
+        paginator = client.get_paginator("scan")
+
+        return [
+            self.serialize_item(item)
+            for page in paginator.paginate(TableName=self.table_name)
+            for item in page["Items"]
+            if item["requestId"]["S"] != IN_FLIGHT_COUNTER_ID
+        ]
+
+    def get_key(self, account, request_id):
+        return {"account": {"S": account}, "requestId": {"S": request_id}}
+
+    def get_counter_update(self, account, size):
+        # Transaction item adding the size to the instances in flight in the account
+        return {
+            "Update": {
+                "TableName": self.table_name,
+                "Key": self.get_key(account=account, request_id=IN_FLIGHT_COUNTER_ID),
+                "UpdateExpression": "ADD inFlight :size",
+                "ExpressionAttributeValues": {":size": {"N": str(size)}},
+            }
+        }
+
+    def mark_in_flight(self, request):
+        client = boto3.client("dynamodb")
+        counter_update = self.get_counter_update(account=request["account"], size=request["size"])
+        # Requests bigger than the limit only start once nothing is in flight
+        counter_update["Update"][
+            "ConditionExpression"
+        ] = "attribute_not_exists(inFlight) OR inFlight <= :zero OR inFlight <= :available"
+        counter_update["Update"]["ExpressionAttributeValues"].update(
+            {":zero": {"N": "0"}, ":available": {"N": str(self.max_in_flight_per_account - request["size"])}}
+        )
+        try:
+            client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": self.table_name,
+                            "Key": self.get_key(account=request["account"], request_id=request["request_id"]),
+                            "UpdateExpression": "SET #status = :inFlight, startedAt = :startedAt",
+                            "ConditionExpression": "#status = :queued",
+                            "ExpressionAttributeNames": {"#status": "status"},
+                            "ExpressionAttributeValues": {
+                                ":inFlight": {"S": IN_FLIGHT_STATUS},
+                                ":queued": {"S": QUEUED_STATUS},
+                                ":startedAt": {"S": datetime.now(timezone.utc).isoformat()},
+                            },
+                        }
+                    },
+                    counter_update,
+                ]
+            )
+        except ClientError as e:
+            # Either the request was started by another scheduler run, or the account is full
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            return False
+
+        return True
+
+    def mark_queued(self, request):
+        client = boto3.client("dynamodb")
+        try:
+            client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": self.table_name,
+                            "Key": self.get_key(account=request["account"], request_id=request["request_id"]),
+                            "UpdateExpression": "SET #status = :queued REMOVE startedAt",
+                            "ConditionExpression": "#status = :inFlight",
+                            "ExpressionAttributeNames": {"#status": "status"},
+                            "ExpressionAttributeValues": {
+                                ":queued": {"S": QUEUED_STATUS},
+                                ":inFlight": {"S": IN_FLIGHT_STATUS},
+                            },
+                        }
+                    },
+                    self.get_counter_update(account=request["account"], size=-request["size"]),
+                ]
+            )
+        except ClientError as e:
+            # The request isn't in flight anymore, its slots were already released
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+
+    def delete_request(self, account, request_id):
+        client = boto3.client("dynamodb")
+        key = self.get_key(account=account, request_id=request_id)
+        item = client.get_item(TableName=self.table_name, Key=key, ConsistentRead=True).get("Item")
+        if not item:
+            return
+
+        request = self.serialize_item(item)
+        if request["status"] != IN_FLIGHT_STATUS:
+            client.delete_item(TableName=self.table_name, Key=key)
+            return
+
+        try:
+            client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Delete": {
+                            "TableName": self.table_name,
+                            "Key": key,
+                            "ConditionExpression": "#status = :inFlight",
+                            "ExpressionAttributeNames": {"#status": "status"},
+                            "ExpressionAttributeValues": {":inFlight": {"S": IN_FLIGHT_STATUS}},
+                        }
+                    },
+                    self.get_counter_update(account=account, size=-request["size"]),
+                ]
+            )
+        except ClientError as e:
+            # Deleted or requeued in the meantime, by another scheduler run
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            self.delete_request(account=account, request_id=request_id)
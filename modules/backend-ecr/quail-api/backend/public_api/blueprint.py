@@ -14,12 +14,36 @@ def register_routes(blueprint):
     # Add rules for serving the API
     blueprint.add_url_rule("/param", "params:list", view_func=views.get_params)
     blueprint.add_url_rule("/instance", "instance:list_get", view_func=views.get_instances, methods=["get"])
+    blueprint.add_url_rule(
+        "/instance/events",
+        "instance:events_get",
+        view_func=views.get_instance_events,
+        methods=["get"],
+    )
+    blueprint.add_url_rule(
+        "/instance/export",
+        "instance:export_get",
+        view_func=views.get_instance_export,
+        methods=["get"],
+    )
     blueprint.add_url_rule(
         "/instance",
         "instance:list_post",
         view_func=views.post_instances,
         methods=["post"],
     )
+    blueprint.add_url_rule(
+        "/instance/batch/start",
+        "instance:batch_post_start",
+        view_func=views.post_instance_batch_start,
+        methods=["post"],
+    )
+    blueprint.add_url_rule(
+        "/instance/batch/stop",
+        "instance:batch_post_stop",
+        view_func=views.post_instance_batch_stop,
+        methods=["post"],
+    )
     blueprint.add_url_rule(
         "/instance/<stackset_id>/start",
         "instance:detail_post_start",
@@ -1,21 +1,92 @@
+import csv
+import io
 import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from hashlib import sha256
 from operator import itemgetter
-from datetime import timedelta, datetime
+from time import monotonic, sleep
+from datetime import timedelta, timezone
 
-from flask import current_app, request
+from flask import current_app, request, stream_with_context
 from marshmallow import ValidationError
 
+from backend import json_utils
+from backend.aws_utils import EXPORT_FIELDS, STATE_EXTENSION_FIELDS, get_permissions_snapshot_version, warm_pool_key
 from backend.exceptions import (
+    SyncTokenExpiredError,
     UnauthorizedForInstanceError,
     InvalidArgumentsError,
     InstanceUpdateError,
 )
+from backend.idempotency import idempotent
+from backend.listing_cache import ListingCache
+from backend.tag_utils import get_tags
 from backend.serializers import (
     group_serializer,
     instance_post_serializer,
     instance_patch_serializer,
+    validate_instance_owner,
+    InstanceBatchRequestValidator,
+    InstanceListRequestValidator,
+    InstanceEventsRequestValidator,
+    InstanceExportRequestValidator,
 )
 
+# Fields of the state entries read by the instance actions, only the ones needed to authorize and carry them out
+INSTANCE_OWNER_FIELDS = ("email", "group")
+INSTANCE_DETAILS_FIELDS = ("email", "group", "expiry", "username")
+INSTANCE_STATE_CHANGE_FIELDS = ("email", "account", "region", "instance_id")
+
+
+def encode_cursor(key):
+    # Opaque cursor of a listing page, from the DynamoDB key to resume after
+    return urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode() if key else None
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        key = None
+
+    if not isinstance(key, dict) or not all(
+        isinstance(value, dict) and set(value) == {"S"} and isinstance(value["S"], str) for value in key.values()
+    ):
+        raise InvalidArgumentsError(message="Invalid cursor.")
+
+    return key
+
+
+def compute_etag(*parts):
+    return sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def not_modified(etag):
+    # Returns a 304 response if the client already holds the current representation, None otherwise
+    if etag not in request.if_none_match:
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def with_etag(result, etag):
+    response = current_app.make_response(result)
+    response.set_etag(etag)
+    # Let clients cache the response, but have them revalidate it on every use
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response
+
+
+def with_body_etag(result):
+    # Versions the response by its serialized body, for the responses that are cheap to build but not to version
+    response = current_app.make_response(result)
+    etag = sha256(response.get_data()).hexdigest()
+    return not_modified(etag) or with_etag(response, etag)
+
 
 def get_params():
     groups = itemgetter("groups")(current_app.aws.get_claims(request=request))
@@ -25,7 +96,8 @@ def get_params():
     for item in permissions.values():
         del item["instance_types"]
 
-    return permissions
+    # The permissions are cached, the client only saves the transfer of unchanged parameters
+    return with_body_etag(permissions)
 
 
 def get_instances():
@@ -33,17 +105,204 @@ def get_instances():
         current_app.aws.get_claims(request=request)
     )
 
-    # Get config from dynamodb
+    try:
+        query = InstanceListRequestValidator().load(request.args)
+    except ValidationError as e:
+        raise InvalidArgumentsError(message=str(e))
+
+    # Regular users only list their own stacksets
+    owner = query.get("owner") if is_superuser else email
+
+    if "since" in query:
+        # Delta sync, the changes are few and per client so neither paged nor cached
+        stacksets, deleted, sync_token = current_app.aws.get_stackset_changes(
+            owner=owner,
+            since=query["since"].astimezone(timezone.utc).isoformat(timespec="microseconds"),
+        )
+        permissions = current_app.aws.get_permissions_for_all_groups(groups=groups)
+        instances = current_app.aws.annotate_user_stacksets(
+            stacksets=stacksets,
+            permissions=permissions,
+            is_superuser=is_superuser,
+        )
+        return {"instances": instances, "deleted": deleted, "sync_token": sync_token}
+
+    snapshot_version = get_permissions_snapshot_version()
+    cache_key = ListingCache.get_key(email, groups, is_superuser, snapshot_version, request.args.items(multi=True))
+    if cached := current_app.aws.get_cached_listing(cache_key):
+        etag, body = cached
+        if response := not_modified(etag):
+            return response
+        return with_etag(current_app.response_class(body, mimetype="application/json"), etag)
+
+    sync_token = current_app.aws.get_sync_token()
+    stacksets, next_key = current_app.aws.get_stacksets_page(
+        owner=owner,
+        filters={
+            "account": query.get("account"),
+            "region": query.get("region"),
+            "group": query.get("group"),
+            "status": query.get("status"),
+            "expiry_from": (
+                query["expiry_from"].astimezone(timezone.utc).isoformat() if "expiry_from" in query else None
+            ),
+            "expiry_to": query["expiry_to"].astimezone(timezone.utc).isoformat() if "expiry_to" in query else None,
+        },
+        limit=query["limit"],
+        exclusive_start_key=decode_cursor(query["cursor"]) if "cursor" in query else None,
+        descending=query["order"] == "desc",
+    )
+    next_cursor = encode_cursor(next_key)
+
+    # Skip the permission lookups if neither the page of stacksets nor the permissions changed
+    etag = compute_etag(stacksets, next_cursor, groups, is_superuser, snapshot_version)
+    if response := not_modified(etag):
+        return response
+
+    # Only the stacksets of the page are annotated
     permissions = current_app.aws.get_permissions_for_all_groups(groups=groups)
-    instances = current_app.aws.get_user_stacksets(
-        email=email,
+    instances = current_app.aws.annotate_user_stacksets(
+        stacksets=stacksets,
         permissions=permissions,
         is_superuser=is_superuser,
     )
 
-    return {"instances": instances}
+    # The sync token is left out of the ETag, an older token only makes the next sync report more changes
+    response = with_etag({"instances": instances, "next_cursor": next_cursor, "sync_token": sync_token}, etag)
+    current_app.aws.listing_cache.set(cache_key, etag, response.get_data())
+    return response
+
+
+def format_event(event, data, event_id=None):
+    lines = [f"event: {event}", f"data: {json_utils.dumps(data)}"]
+    if event_id:
+        lines.append(f"id: {event_id}")
+
+    return "\n".join(lines) + "\n\n"
+
+
+def get_instance_events():
+    """Long poll for the changes to the user's instances, in the server-sent events format.
+
+    Returns an "instance" event for each created or updated instance and a "deleted" event for each deleted one,
+    read from the updatedAt index like GET /instance?since=. The request is held until there are changes, or for
+    EVENT_STREAM_MAX_DURATION seconds. API Gateway buffers the Lambda responses, so the events only reach the client
+    once the response ends, which is why it ends with the first changes. The ID of the last event is the sync token
+    to resume from, which EventSource clients send back in the Last-Event-ID header when they reconnect right after.
+    New polls start from the sync token query parameter, or from now.
+    """
+    groups, email, is_superuser = itemgetter("groups", "email", "is_superuser")(
+        current_app.aws.get_claims(request=request)
+    )
+
+    params = request.args.to_dict()
+    if request.headers.get("Last-Event-ID"):
+        params["since"] = request.headers["Last-Event-ID"]
+    try:
+        query = InstanceEventsRequestValidator().load(params)
+    except ValidationError as e:
+        raise InvalidArgumentsError(message=str(e))
+
+    owner = query.get("owner") if is_superuser else email
+    since = (
+        query["since"].astimezone(timezone.utc).isoformat(timespec="microseconds")
+        if "since" in query
+        else current_app.aws.get_sync_token()
+    )
+    # Read the first changes before the response starts, so that an expired token still gets its error status
+    changes = current_app.aws.get_stackset_changes(owner=owner, since=since)
+    permissions = current_app.aws.get_permissions_for_all_groups(groups=groups)
+
+    config = current_app.config
+    poll_interval = config["EVENT_STREAM_POLL_INTERVAL"]
+
+    def generate(changes):
+        deadline = monotonic() + config["EVENT_STREAM_MAX_DURATION"]
+        last_sent = monotonic()
+        # Have clients poll again straight away once the response ends
+        yield f"retry: {int(poll_interval * 1000)}\n\n"
+
+        while True:
+            stacksets, deleted, sync_token = changes
+            instances = current_app.aws.annotate_user_stacksets(
+                stacksets=stacksets,
+                permissions=permissions,
+                is_superuser=is_superuser,
+            )
+            events = [("instance", instance) for instance in instances] + [
+                ("deleted", {"stackset_id": stackset_id}) for stackset_id in deleted
+            ]
+            # Only the last event of a batch moves the resumption point past the batch
+            for index, (event, data) in enumerate(events):
+                yield format_event(event, data, event_id=sync_token if index == len(events) - 1 else None)
+
+            # Holding the response any longer would only delay these events
+            if events:
+                return
+
+            if monotonic() - last_sent >= config["EVENT_STREAM_HEARTBEAT_INTERVAL"]:
+                # Keeps the resumption point recent, and the connection open when the response isn't buffered
+                yield f": heartbeat\nid: {sync_token}\n\n"
+                last_sent = monotonic()
+
+            if monotonic() + poll_interval >= deadline:
+                return
+
+            sleep(poll_interval)
+            try:
+                changes = current_app.aws.get_stackset_changes(owner=owner, since=sync_token)
+            except SyncTokenExpiredError:
+                yield format_event("resync", {})
+                return
+
+    response = current_app.response_class(stream_with_context(generate(changes)), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # Don't let reverse proxies buffer the response, e.g. when running locally behind nginx
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def iter_csv(rows):
+    # Serialize the rows one at a time, starting with the header
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def get_instance_export():
+    """Stream every state entry joined with the live state of its EC2 instance, as NDJSON or CSV.
+
+    The rows are scanned, enriched and serialized batch by batch while the response is sent.
+    """
+    is_superuser = itemgetter("is_superuser")(current_app.aws.get_claims(request=request))
+    if not is_superuser:
+        raise UnauthorizedForInstanceError(message="Only superusers can export the instances.")
 
+    try:
+        query = InstanceExportRequestValidator().load(request.args)
+    except ValidationError as e:
+        raise InvalidArgumentsError(message=str(e))
 
+    rows = current_app.aws.iter_instance_export(stacksets=current_app.aws.iter_stacksets())
+    if query["format"] == "csv":
+        body, mimetype = iter_csv(rows), "text/csv"
+    else:
+        body, mimetype = (json_utils.dumps(row) + "\n" for row in rows), "application/x-ndjson"
+
+    response = current_app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=instances.{query['format']}"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@idempotent
 def post_instances():
     # Get auth params
     email, groups, username, is_superuser, claims = itemgetter("email", "groups", "username", "is_superuser", "claims")(
@@ -74,12 +333,11 @@ def post_instances():
         region_map=permissions["region_map"],
         instance_types=permissions["instance_types"],
         max_days_to_expiry=permissions["max_days_to_expiry"],
-        initiator_username=username,
-        initator_email=email,
-        is_superuser=is_superuser,
     )
     try:
         data = serializer.load(payload)
+        if not is_superuser:
+            validate_instance_owner(data=data, initiator_email=email, initiator_username=username)
     except ValidationError as e:
         return {
             "statusCode": 400,
@@ -87,42 +345,117 @@ def post_instances():
             "headers": {"Content-Type": "application/json"},
         }
 
-    # Check if instance count is within limits if the user isn't a superuser
+    # Expand the request into the list of instances making up the fleet
     stack_email = data.pop("email")
     stack_username = data.pop("username")
-
-    if not is_superuser:
-        stacksets = current_app.aws.get_owned_stacksets(email=stack_email)
-        if len(stacksets) >= permissions["max_instance_count"]:
-            return {
-                "statusCode": 400,
-                "body": json.dumps(
-                    {"message": f"Instance limit exceeded. You already own {len(stacksets)} instances."}
-                ),
-                "headers": {"Content-Type": "application/json"},
-            }
-
-    # Provision stackset
-    sfn_execution_arn = current_app.aws.provision_stackset(
+    count = data.pop("count", 1)
+    instance_names = data.pop("instance_names", None)
+    if instance_names is None:
+        instance_name = data.pop("instance_name")
+        instance_names = [instance_name] if count == 1 else [f"{instance_name}-{i + 1}" for i in range(count)]
+
+    # Count the instances against the owner's quota, superusers aren't limited
+    reserved = current_app.aws.reserve_instances(
         email=stack_email,
+        count=len(instance_names),
+        max_instance_count=None if is_superuser else permissions["max_instance_count"],
+    )
+    if not reserved:
+        instance_count = current_app.aws.get_instance_count(email=stack_email)
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"message": f"Instance limit exceeded. You already own {instance_count} instances."}),
+            "headers": {"Content-Type": "application/json"},
+        }
+
+    # Claim ready instances from the matching warm pool, if one is configured
+    claimed = []
+    pool_key = warm_pool_key(
         group=current_group,
-        username=stack_username,
-        user=claims,
-        **data,
+        operating_system=data["operating_system"],
+        account=data["account"],
+        region=data["region"],
+        instance_type=data["instance_type"],
     )
+    if pool_key in get_warm_pool_keys(current_app.config["WARM_POOL_TARGETS"]):
+        try:
+            claimed = current_app.aws.claim_pooled_stacksets(
+                pool_key=pool_key,
+                instance_names=instance_names,
+                email=stack_email,
+                username=stack_username,
+                expiry=data["expiry"],
+            )
+        except Exception:
+            current_app.aws.release_instances(email=stack_email, count=len(instance_names))
+            raise
+
+    if claimed:
+        tags = get_tags(
+            environment={**claims, "group": current_group},
+            tag_config=json.loads(current_app.config["TAG_CONFIG"]),
+        )
+        try:
+            current_app.aws.activate_pooled_stacksets(stacksets=claimed, tags=tags)
+        except Exception:
+            current_app.aws.return_to_warm_pool(stacksets=claimed, pool_key=pool_key)
+            current_app.aws.release_instances(email=stack_email, count=len(instance_names))
+            raise
+
+    # Queue the provisioning of the instances the warm pool couldn't supply, the private API scheduler
+    # starts it once the target account has capacity for it
+    request_id = None
+    claimed_count = len(claimed)
+    if claimed_count < len(instance_names):
+        try:
+            provisioning_input = current_app.aws.get_provisioning_input(
+                email=stack_email,
+                group=current_group,
+                username=stack_username,
+                user=claims,
+                instance_names=instance_names[claimed_count:],
+                **data,
+            )
+            queued_request = current_app.provisioning_queue.enqueue(
+                account=data["account"],
+                group=current_group,
+                size=len(provisioning_input["instance_names"]),
+                payload=provisioning_input,
+            )
+        except Exception:
+            # The instances the warm pool didn't supply won't be provisioned
+            current_app.aws.release_instances(email=stack_email, count=len(instance_names) - claimed_count)
+            raise
+        request_id = queued_request["request_id"]
+        current_app.aws.request_provisioning_schedule(function_name=current_app.config["PRIVATE_API_FUNCTION_NAME"])
 
     return {
-        "sfn_execution_arn": sfn_execution_arn,
+        "request_id": request_id,
+        "stackset_ids": [stackset["stackset_id"] for stackset in claimed],
         "email": stack_email,
         "username": stack_username,
     }
 
 
+def get_warm_pool_keys(targets):
+    return {
+        warm_pool_key(
+            group=target["group"],
+            operating_system=target["operating_system"],
+            account=target["account"],
+            region=target["region"],
+            instance_type=target["instance_type"],
+        )
+        for target in targets
+    }
+
+
+@idempotent
 def post_instance_start(stackset_id):
     email, is_superuser = itemgetter("email", "is_superuser")(current_app.aws.get_claims(request=request))
 
     # get details of the specified stackset
-    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id)
+    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id, fields=INSTANCE_DETAILS_FIELDS)
     if not stackset_data or (stackset_data["email"] != email and not is_superuser):
         return {
             "statusCode": 400,
@@ -133,21 +466,25 @@ def post_instance_start(stackset_id):
     instances = current_app.aws.get_instance_details(stacksets=[stackset_data])
 
     target_instance = instances[0]
-    current_app.aws.start_instance(
+    started = current_app.aws.start_instance(
         stackset_id=stackset_id,
         account_id=target_instance["account_id"],
         region_name=target_instance["region"],
         instance_id=target_instance["instance_id"],
     )
+    if not started:
+        # Runs once the operation in progress on the instance completes
+        return {"queued": True}, 202
 
     return {}, 204
 
 
+@idempotent
 def post_instance_stop(stackset_id):
     email, is_superuser = itemgetter("email", "is_superuser")(current_app.aws.get_claims(request=request))
 
     # get details of the specified stackset
-    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id)
+    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id, fields=INSTANCE_DETAILS_FIELDS)
     if not stackset_data or (stackset_data["email"] != email and not is_superuser):
         return {
             "statusCode": 400,
@@ -158,16 +495,56 @@ def post_instance_stop(stackset_id):
     instances = current_app.aws.get_instance_details(stacksets=[stackset_data])
 
     target_instance = instances[0]
-    current_app.aws.stop_instance(
+    started = current_app.aws.stop_instance(
         stackset_id=stackset_id,
         account_id=target_instance["account_id"],
         region_name=target_instance["region"],
         instance_id=target_instance["instance_id"],
     )
+    if not started:
+        # Runs once the operation in progress on the instance completes
+        return {"queued": True}, 202
 
     return {}, 204
 
 
+def change_instances_state_in_batch(action):
+    email, is_superuser = itemgetter("email", "is_superuser")(current_app.aws.get_claims(request=request))
+
+    try:
+        stackset_ids = InstanceBatchRequestValidator().load(request.json)["stackset_ids"]
+    except ValidationError as e:
+        raise InvalidArgumentsError(message=str(e))
+
+    # get details of all the specified stacksets at once
+    stacksets = current_app.aws.get_stacksets_state_data(stackset_ids=stackset_ids, fields=INSTANCE_STATE_CHANGE_FIELDS)
+    for stackset_id in stackset_ids:
+        stackset_data = stacksets.get(stackset_id)
+        if not stackset_data or (stackset_data["email"] != email and not is_superuser):
+            raise UnauthorizedForInstanceError()
+
+        if not stackset_data["instance_id"]:
+            raise InvalidArgumentsError(message=f"The instance {stackset_id} hasn't been provisioned yet.")
+
+    started = current_app.aws.change_instances_state(stacksets=list(stacksets.values()), action=action)
+    queued = [stackset_id for stackset_id in stackset_ids if stackset_id not in started]
+    if queued:
+        return {"queued": queued}, 202
+
+    return {}, 204
+
+
+@idempotent
+def post_instance_batch_start():
+    return change_instances_state_in_batch(action="start")
+
+
+@idempotent
+def post_instance_batch_stop():
+    return change_instances_state_in_batch(action="stop")
+
+
+@idempotent
 def patch_instance(stackset_id):
     email, is_superuser = itemgetter("email", "is_superuser")(current_app.aws.get_claims(request=request))
 
@@ -175,7 +552,7 @@ def patch_instance(stackset_id):
     payload = request.json
 
     # get details of the specified stackset
-    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id)
+    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id, fields=INSTANCE_OWNER_FIELDS)
     if not stackset_data or (stackset_data["email"] != email and not is_superuser):
         raise UnauthorizedForInstanceError()
 
@@ -191,16 +568,19 @@ def patch_instance(stackset_id):
         raise InvalidArgumentsError(message=str(e))
 
     instance_type = data["instance_type"]
-    current_app.aws.update_stackset(stackset_id=stackset_id, InstanceType=instance_type)
+    if not current_app.aws.update_stackset(stackset_id=stackset_id, instance_type=instance_type):
+        # Runs once the operation in progress on the instance completes
+        return {"queued": True}, 202
 
     return {}, 204
 
 
+@idempotent
 def post_instance_extend(stackset_id):
     email, is_superuser = itemgetter("email", "is_superuser")(current_app.aws.get_claims(request=request))
 
     # get details of the specified stackset
-    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id)
+    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id, fields=STATE_EXTENSION_FIELDS)
     if not stackset_data or (stackset_data["email"] != email and not is_superuser):
         raise UnauthorizedForInstanceError()
 
@@ -208,31 +588,29 @@ def post_instance_extend(stackset_id):
     permissions = current_app.aws.get_permissions_for_one_group(group_name=stackset_data["group"])
     max_extension_count = permissions["max_extension_count"]
 
-    # check user hasn't exceeded the max number of extensions
-    if not is_superuser and stackset_data["extension_count"] >= max_extension_count:
-        raise InstanceUpdateError(
-            f"You cannot extend instance lifetime more than {stackset_data['extension_count']} times."
-        )
-
-    new_expiry = datetime.fromisoformat(stackset_data["expiry"]) + timedelta(days=1)
-    new_extension_count = stackset_data["extension_count"] + 1
-
-    current_app.aws.update_instance_expiry(
-        stackset_id=stackset_id, expiry=new_expiry, extension_count=new_extension_count
+    # check and count the extension in a single write, superusers can extend instances without limit
+    stackset = current_app.aws.extend_instance_expiry(
+        stackset=stackset_data,
+        extension=timedelta(days=1),
+        max_extension_count=None if is_superuser else max_extension_count,
+        owner_email=None if is_superuser else email,
     )
+    if not stackset:
+        raise InstanceUpdateError(f"You cannot extend instance lifetime more than {max_extension_count} times.")
 
     return {
         "stackset_id": stackset_id,
-        "can_extend": is_superuser or new_extension_count < max_extension_count,
-        "expiry": new_expiry.isoformat(),
+        "can_extend": is_superuser or stackset["extension_count"] < max_extension_count,
+        "expiry": stackset["expiry"],
     }
 
 
+@idempotent
 def delete_instances(stackset_id):
     email, is_superuser = itemgetter("email", "is_superuser")(current_app.aws.get_claims(request=request))
 
     # Check if the requester owns the stackset
-    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id)
+    stackset_data = current_app.aws.get_stackset_state_data(stackset_id=stackset_id, fields=INSTANCE_OWNER_FIELDS)
     if not stackset_data or (stackset_data["email"] != email and not is_superuser):
         return {
             "statusCode": 400,
@@ -0,0 +1,56 @@
+"""Reads memoized for the duration of a single request, kept on flask.g."""
+
+from copy import deepcopy
+
+from flask import g, has_request_context
+
+
+class RequestCache:
+    """Memoizes the claims, group permissions, state entries and stackset topologies read by a request.
+
+    Entries are keyed by a tuple starting with their kind, e.g. ("permissions", group_name). The state entries
+    and topologies are dropped as soon as the request writes to them. Callers get copies of the entries, as some
+    of them annotate what they read in place.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        if key in self.entries:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.entries[key] = load()
+
+        return deepcopy(self.entries[key])
+
+    def get_stackset(self, stackset_id, fields):
+        # The state entry, if it was read with at least the given fields, None otherwise
+        entry = self.entries.get(("stackset", stackset_id))
+        if entry is None or not entry[0].issuperset(fields):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return deepcopy(entry[1])
+
+    def set_stackset(self, stackset, fields):
+        self.entries[("stackset", stackset["stackset_id"])] = (frozenset(fields), deepcopy(stackset))
+
+    def invalidate(self, *kinds):
+        for key in [key for key in self.entries if key[0] in kinds]:
+            del self.entries[key]
+
+
+def get_request_cache():
+    # The cache of the current request, None outside of requests, e.g. in the worker threads and the CLI commands
+    if not has_request_context():
+        return None
+
+    if "request_cache" not in g:
+        g.request_cache = RequestCache()
+
+    return g.request_cache
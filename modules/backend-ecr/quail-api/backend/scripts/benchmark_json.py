@@ -0,0 +1,72 @@
+import json
+from timeit import timeit
+
+import click
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from backend import json_utils
+from backend.json_utils import FastJSONProvider
+from backend.state_records import STATE_TABLE_ATTRIBUTES
+
+CLAIMS_HEADER = json.dumps(
+    {
+        "authorizer": {
+            "jwt": {
+                "claims": {
+                    "email": "user@example.com",
+                    "groups": "[devs quail-admins]",
+                    "name": "user",
+                }
+            }
+        }
+    }
+)
+
+
+def get_listing(size):
+    # A page of GET /instance, annotated state entries
+    instances = [
+        {
+            **{field: f"{field}-{i}" for field, _, type_key in STATE_TABLE_ATTRIBUTES if type_key == "S"},
+            "extension_count": i % 3,
+            "can_extend": True,
+            "available_instance_types": ["t3.nano", "t3.micro", "t3.small", "t3.medium"],
+        }
+        for i in range(size)
+    ]
+    return {"instances": instances, "next_cursor": None, "sync_token": "2030-01-01T00:00:00.000000+00:00"}
+
+
+def measure(function, number):
+    # Milliseconds per call
+    return timeit(function, number=number) / number * 1000
+
+
+@click.command()
+@click.option("--size", "-s", help="Number of instances listed", default=500, type=int)
+@click.option("--number", "-n", help="Number of listings serialized", default=200, type=int)
+def benchmark(size, number):
+    """Measure the cost of serializing instance listings, and of parsing the claims header"""
+    if json_utils.orjson is None:
+        raise click.ClickException("orjson isn't installed, there's nothing to compare the stdlib to.")
+
+    app = Flask(__name__)
+    providers = {"stdlib": DefaultJSONProvider(app), "orjson": FastJSONProvider(app)}
+    listing = get_listing(size=size)
+
+    with app.app_context():
+        for name, provider in providers.items():
+            duration = measure(lambda: provider.response(listing).get_data(), number=number)
+            body_size = len(provider.response(listing).get_data())
+            print(f"{name:>6} listing of {size} instances: {duration:8.3f} ms, {body_size} bytes")
+
+    for name, loads in (("stdlib", json.loads), ("orjson", json_utils.orjson.loads)):
+        duration = measure(lambda: loads(CLAIMS_HEADER), number=number * 100)
+        print(f"{name:>6} claims header: {duration * 1000:8.3f} us")
+
+    exit(0)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+from timeit import timeit
+
+import click
+
+from backend.serializers import (
+    build_group_serializer,
+    build_instance_patch_serializer,
+    build_instance_post_serializer,
+    group_serializer,
+    instance_patch_serializer,
+    instance_post_serializer,
+)
+
+PERMISSIONS = {
+    "accounts": ["111111111111", "222222222222"],
+    "region_map": {
+        "111111111111": {"eu-west-1": {"os_types": ["AWS Linux 2", "Windows Server 2019"]}},
+        "222222222222": {"us-east-1": {"os_types": ["AWS Linux 2"]}},
+    },
+    "instance_types": ["t3.nano", "t3.micro", "t3.small", "t3.medium"],
+    "max_days_to_expiry": 5,
+}
+
+
+def get_payload():
+    return {
+        "group": "devs",
+        "account": "111111111111",
+        "region": "eu-west-1",
+        "instanceType": "t3.micro",
+        "operatingSystem": "AWS Linux 2",
+        "instanceName": "benchmark",
+        "expiry": (datetime.now(timezone.utc) + timedelta(days=1)).isoformat(),
+        "email": "user@example.com",
+        "username": "user",
+    }
+
+
+def validate_request(payload):
+    # The validation of a provisioning request, as made by POST /instance
+    group_serializer(groups=["devs", "admins"]).load(payload)
+    instance_post_serializer(**PERMISSIONS).load(payload)
+    instance_patch_serializer(instance_types=PERMISSIONS["instance_types"]).load(payload)
+
+
+@click.command()
+@click.option("--number", "-n", help="Number of requests validated", default=2000, type=int)
+def benchmark(number):
+    """Measure the request validation throughput, with the serializers cached and rebuilt for every request"""
+    payload = get_payload()
+
+    cached = timeit(lambda: validate_request(payload), number=number)
+
+    def validate_uncached():
+        # Same as before the serializers were cached, each request builds its schema classes
+        for builder in (build_group_serializer, build_instance_post_serializer, build_instance_patch_serializer):
+            builder.cache_clear()
+        validate_request(payload)
+
+    rebuilt = timeit(validate_uncached, number=number)
+
+    print(f"cached serializers:  {number / cached:10.0f} requests/s")
+    print(f"rebuilt serializers: {number / rebuilt:10.0f} requests/s")
+    print(f"speedup: {rebuilt / cached:.1f}x")
+
+    exit(0)
+
+
+if __name__ == "__main__":
+    benchmark()
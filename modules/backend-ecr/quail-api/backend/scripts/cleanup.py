@@ -2,6 +2,8 @@ import click
 import boto3
 from botocore.config import Config
 
+from backend.state_records import STATE_TABLE_CODEC
+
 SYNCHRONIZED_STATUS = "CURRENT"
 INCOMPLETE_DETAILED_STATUS = {"PENDING", "RUNNING"}
 
@@ -9,29 +11,6 @@ INCOMPLETE_DETAILED_STATUS = {"PENDING", "RUNNING"}
 retry_config = Config(retries={"mode": "adaptive", "max_attempts": 7})
 
 
-def serialize_state_table_row(item):
-    def nullable_get(item, key):
-        return item[key]["S"] if key in item else None
-
-    return {
-        "stackset_id": item["stacksetID"]["S"],
-        "expiry": item["expiry"]["S"],
-        "extension_count": int(item["extensionCount"]["N"]),
-        "username": item["username"]["S"],
-        "email": item["email"]["S"],
-        "group": item["group"]["S"],
-        "account": nullable_get(item, "account"),
-        "instance_name": nullable_get(item, "instanceName"),
-        "instance_status": nullable_get(item, "instanceStatus"),
-        "instance_type": nullable_get(item, "instanceType"),
-        "operating_system": nullable_get(item, "operatingSystem"),
-        "private_ip": nullable_get(item, "privateIp"),
-        "region": nullable_get(item, "region"),
-        "connection_protocol": nullable_get(item, "connectionProtocol"),
-        "instance_id": nullable_get(item, "instanceId"),
-    }
-
-
 @click.command()
 @click.option(
     "--state-table",
@@ -52,19 +31,22 @@ def cleanup(state_table, number, dry_run):
     stackset_whitelist = []  # noqa
     stackset_blacklist = []  # noqa
 
-    # Fetch stackset state from dynamodb
-    stackset_state_raw = dynamodb_client.scan(
-        TableName=state_table,
-    )
-    print(f"{stackset_state_raw=}")
-    stackset_state = [serialize_state_table_row(item) for item in stackset_state_raw["Items"]]
+    # Fetch stackset state from dynamodb, only reading the fields used below
+    codec = STATE_TABLE_CODEC.project(["stackset_id"])
+    paginator = dynamodb_client.get_paginator("scan")
+    stackset_state = [
+        codec.decode(item)
+        for page in paginator.paginate(TableName=state_table, **codec.get_projection())
+        for item in page["Items"]
+    ]
+    print(f"{stackset_state=}")
 
     filtered_stackset_state = [
         entry
         for entry in stackset_state
         if (
-            (len(stackset_whitelist) == 0 or entry["stackset_id"] in stackset_whitelist)
-            and (len(stackset_blacklist) == 0 or entry["stackset_id"] not in stackset_blacklist)
+            (len(stackset_whitelist) == 0 or entry.stackset_id in stackset_whitelist)
+            and (len(stackset_blacklist) == 0 or entry.stackset_id not in stackset_blacklist)
         )
     ]
     print(f"Stacksets prepared for update: {filtered_stackset_state=}")
@@ -75,25 +57,25 @@ def cleanup(state_table, number, dry_run):
     # Fetch stackset details
     cf_client = boto3.client("cloudformation", config=retry_config)
     for target_stackset in limited_stacksets:
-        stackset_id = target_stackset["stackset_id"]
+        stackset_id = target_stackset.stackset_id
         stack_instances = cf_client.list_stack_instances(StackSetName=stackset_id)
 
         if len(stack_instances["Summaries"]) != 0:
             raise Exception(f"Wrong number of stack instances for stackset: {stackset_id}")
 
         print("################################################")
-        print(f"Removing stackset {target_stackset['stackset_id']}")
+        print(f"Removing stackset {target_stackset.stackset_id}")
 
         if dry_run:
             continue
 
-        cf_client.delete_stack_set(StackSetName=target_stackset["stackset_id"])
+        cf_client.delete_stack_set(StackSetName=target_stackset.stackset_id)
 
         # Remove the StackSet record from the state table
         dynamodb_client = boto3.client("dynamodb")
         dynamodb_client.delete_item(
             TableName=state_table,
-            Key={"stacksetID": {"S": target_stackset["stackset_id"]}},
+            Key={"stacksetID": {"S": target_stackset.stackset_id}},
         )
 
     exit(0)
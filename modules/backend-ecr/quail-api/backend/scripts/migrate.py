@@ -2,6 +2,8 @@ import click
 import boto3
 from botocore.config import Config
 
+from backend.state_records import STATE_TABLE_CODEC
+
 SYNCHRONIZED_STATUS = "CURRENT"
 INCOMPLETE_DETAILED_STATUS = {"PENDING", "RUNNING"}
 
@@ -9,33 +11,10 @@ INCOMPLETE_DETAILED_STATUS = {"PENDING", "RUNNING"}
 retry_config = Config(retries={"mode": "adaptive", "max_attempts": 7})
 
 
-def serialize_state_table_row(item):
-    def nullable_get(item, key):
-        return item[key]["S"] if key in item else None
-
-    return {
-        "stackset_id": item["stacksetID"]["S"],
-        "expiry": item["expiry"]["S"],
-        "extension_count": int(item["extensionCount"]["N"]),
-        "username": item["username"]["S"],
-        "email": item["email"]["S"],
-        "group": item["group"]["S"],
-        "account": nullable_get(item, "account"),
-        "instance_name": nullable_get(item, "instanceName"),
-        "instance_status": nullable_get(item, "instanceStatus"),
-        "instance_type": nullable_get(item, "instanceType"),
-        "operating_system": nullable_get(item, "operatingSystem"),
-        "private_ip": nullable_get(item, "privateIp"),
-        "region": nullable_get(item, "region"),
-        "connection_protocol": nullable_get(item, "connectionProtocol"),
-        "instance_id": nullable_get(item, "instanceId"),
-    }
-
-
 def get_instance_details(stackset):
     cf_client = boto3.client("cloudformation", config=retry_config)
 
-    stackset_id = stackset["stackset_id"]
+    stackset_id = stackset.stackset_id
 
     stack_instances = cf_client.list_stack_instances(StackSetName=stackset_id)
     if len(stack_instances["Summaries"]) != 1:
@@ -57,10 +36,10 @@ def get_instance_details(stackset):
         "stackset_id": stackset_id,
         "account_id": account_id,
         "region": region,
-        "expiry": stackset["expiry"],
-        "username": stackset["username"],
-        "email": stackset["email"],
-        "group": stackset["group"],
+        "expiry": stackset.expiry,
+        "username": stackset.username,
+        "email": stackset.email,
+        "group": stackset.group,
         "operatingSystemName": param_dict.get("OperatingSystemName"),
         "instanceType": param_dict["InstanceType"],
         "instanceName": param_dict["InstanceName"],
@@ -120,15 +99,18 @@ def migrate(state_table, number, migrate_state_error, dry_run):
     stackset_whitelist = []  # noqa
     stackset_blacklist = []  # noqa
 
-    # Fetch stackset state from dynamodb
-    stackset_state_raw = dynamodb_client.scan(
-        TableName=state_table,
-    )
-    print(f"{stackset_state_raw=}")
-    stackset_state = [serialize_state_table_row(item) for item in stackset_state_raw["Items"]]
+    # Fetch stackset state from dynamodb, only reading the fields used below
+    codec = STATE_TABLE_CODEC.project(["stackset_id", "expiry", "username", "email", "group", "instance_status"])
+    paginator = dynamodb_client.get_paginator("scan")
+    stackset_state = [
+        codec.decode(item)
+        for page in paginator.paginate(TableName=state_table, **codec.get_projection())
+        for item in page["Items"]
+    ]
+    print(f"{stackset_state=}")
 
     def filter_stacksets(entry, migrate_state_error):
-        instance_status = entry.get("instance_status")
+        instance_status = entry.instance_status
         if migrate_state_error:
             return instance_status == "error"
         else:
@@ -141,8 +123,8 @@ def migrate(state_table, number, migrate_state_error, dry_run):
         entry
         for entry in filtered_stackset_state
         if (
-            (len(stackset_whitelist) == 0 or entry["stackset_id"] in stackset_whitelist)
-            and (len(stackset_blacklist) == 0 or entry["stackset_id"] not in stackset_blacklist)
+            (len(stackset_whitelist) == 0 or entry.stackset_id in stackset_whitelist)
+            and (len(stackset_blacklist) == 0 or entry.stackset_id not in stackset_blacklist)
         )
     ]
     print(f"Stacksets prepared for update: {filtered_stackset_state=}")
@@ -0,0 +1,105 @@
+import json
+from collections import Counter
+
+import click
+import boto3
+
+from backend.state_records import STATE_TABLE_CODEC
+
+
+def count_state_table_instances(dynamodb_client, state_table):
+    # Instances owned by each user, unclaimed warm pool instances aren't owned by anyone
+    counts = Counter()
+    codec = STATE_TABLE_CODEC.project(["email"])
+    paginator = dynamodb_client.get_paginator("scan")
+    for page in paginator.paginate(
+        TableName=state_table,
+        FilterExpression="attribute_not_exists(poolKey)",
+        **codec.get_projection(),
+    ):
+        for item in page["Items"]:
+            counts[codec.decode(item).email] += 1
+
+    return counts
+
+
+def count_queued_instances(dynamodb_client, queue_table):
+    # Instances reserved by provisioning requests that haven't started yet
+    counts = Counter()
+    paginator = dynamodb_client.get_paginator("scan")
+    for page in paginator.paginate(
+        TableName=queue_table,
+        FilterExpression="#status = :queued",
+        ExpressionAttributeNames={"#status": "status"},
+        ExpressionAttributeValues={":queued": {"S": "QUEUED"}},
+    ):
+        for item in page["Items"]:
+            payload = json.loads(item["payload"]["S"])
+            counts[payload["email"]] += len(payload["instance_names"])
+
+    return counts
+
+
+def get_counters(dynamodb_client, counters_table):
+    paginator = dynamodb_client.get_paginator("scan")
+    return {
+        item["email"]["S"]: int(item["instanceCount"]["N"])
+        for page in paginator.paginate(TableName=counters_table)
+        for item in page["Items"]
+        if "instanceCount" in item
+    }
+
+
+@click.command()
+@click.option("--state-table", help="State table name", required=True)
+@click.option("--counters-table", help="User counters table name", required=True)
+@click.option("--queue-table", help="Provisioning queue table name", default=None)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help="Dry run",
+)
+def reconcile(state_table, counters_table, queue_table, dry_run):
+    """Rebuild the per-user instance counters from the state table"""
+    dynamodb_client = boto3.client("dynamodb")
+
+    # Read the counters first, so that reservations made while the tables are scanned make the writes fail
+    counters = get_counters(dynamodb_client=dynamodb_client, counters_table=counters_table)
+    expected = count_state_table_instances(dynamodb_client=dynamodb_client, state_table=state_table)
+    if queue_table:
+        expected += count_queued_instances(dynamodb_client=dynamodb_client, queue_table=queue_table)
+
+    for email in sorted(set(counters) | set(expected)):
+        current = counters.get(email, 0)
+        if current == expected[email]:
+            continue
+
+        print(f"{email}: counted {current} instances, owns {expected[email]}")
+        if dry_run:
+            continue
+
+        try:
+            dynamodb_client.update_item(
+                TableName=counters_table,
+                Key={"email": {"S": email}},
+                UpdateExpression="SET instanceCount = :expected",
+                ConditionExpression=(
+                    "instanceCount = :current"
+                    if email in counters
+                    else "attribute_not_exists(email) OR attribute_not_exists(instanceCount)"
+                ),
+                ExpressionAttributeValues={
+                    ":expected": {"N": str(expected[email])},
+                    **({":current": {"N": str(current)}} if email in counters else {}),
+                },
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            print(f"{email}: counter changed in the meantime, skipping it")
+
+    exit(0)
+
+
+if __name__ == "__main__":
+    reconcile()
@@ -1,10 +1,26 @@
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
-from marshmallow import Schema, fields, EXCLUDE, validates_schema, ValidationError
-from marshmallow.validate import OneOf, Range, Length, Equal
+from marshmallow import Schema, fields, EXCLUDE, validates, validates_schema, ValidationError
+from marshmallow.validate import OneOf, Range, Length
+
+# Maximum number of instances that can be modified in a single batch request
+MAX_BATCH_SIZE = 100
+# Maximum number of instances that can be provisioned in a single fleet request
+MAX_FLEET_SIZE = 50
+# Number of instances listed per page, by default and at most
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# Serializers built for distinct sets of permissions, kept across requests as building their classes is costly
+SERIALIZER_CACHE_SIZE = 256
 
 
 def group_serializer(groups):
+    return build_group_serializer(groups=tuple(sorted(groups)))
+
+
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def build_group_serializer(groups):
     class GroupSchema(Schema):
         group = fields.Str(required=True, validate=OneOf(groups))
 
@@ -14,20 +30,26 @@ def group_serializer(groups):
     return GroupSchema()
 
 
-def instance_post_serializer(
-    accounts,
-    region_map,
-    instance_types,
-    max_days_to_expiry,
-    initiator_username,
-    initator_email,
-    is_superuser,
-):
-    min_date = datetime.now(timezone.utc) + timedelta(hours=2)
-    max_date = datetime.now(timezone.utc) + timedelta(days=max_days_to_expiry)
+def instance_post_serializer(accounts, region_map, instance_types, max_days_to_expiry):
+    # Region map: account -> region -> {"os_types": [...]}, flattened to be part of the cache key
+    region_permissions = tuple(
+        sorted(
+            (account_id, region, tuple(sorted(region_data.get("os_types", []))))
+            for account_id, account_map in region_map.items()
+            for region, region_data in account_map.items()
+        )
+    )
+    return build_instance_post_serializer(
+        accounts=tuple(sorted(accounts)),
+        region_permissions=region_permissions,
+        instance_types=tuple(sorted(instance_types)),
+        max_days_to_expiry=max_days_to_expiry,
+    )
+
 
-    def validate_equal_or_superuser(value):
-        return lambda _: True if is_superuser else Equal(value)
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def build_instance_post_serializer(accounts, region_permissions, instance_types, max_days_to_expiry):
+    supported_oses = {(account_id, region): os_types for account_id, region, os_types in region_permissions}
 
     class RequestValidator(Schema):
         account = fields.Str(required=True, validate=OneOf(accounts))
@@ -37,32 +59,49 @@ def instance_post_serializer(
             required=True,
             data_key="operatingSystem",
         )
-        instance_name = fields.Str(required=True, data_key="instanceName", validate=Length(max=255))
-        expiry = fields.AwareDateTime(
-            required=True,
-            validate=Range(
+        instance_name = fields.Str(data_key="instanceName", validate=Length(max=255))
+        instance_names = fields.List(
+            fields.Str(validate=Length(max=255)),
+            data_key="instanceNames",
+            validate=Length(min=1, max=MAX_FLEET_SIZE),
+        )
+        count = fields.Int(validate=Range(min=1, max=MAX_FLEET_SIZE))
+        expiry = fields.AwareDateTime(required=True)
+        email = fields.Email(required=True)
+        username = fields.Str(required=True)
+
+        @validates("expiry")
+        def validate_expiry(self, value, **kwargs):
+            # The bounds move with the time of each request, the schema outlives them
+            now = datetime.now(timezone.utc)
+            min_date = now + timedelta(hours=2)
+            max_date = now + timedelta(days=max_days_to_expiry)
+            Range(
                 min=min_date,
                 max=max_date,
                 error=(
                     f"Must be between {min_date.strftime('%Y-%m-%d %H:%M')} "
                     f"and {max_date.strftime('%Y-%m-%d %H:%M')}."
                 ),
-            ),
-        )
-        email = fields.Email(required=True, validate=validate_equal_or_superuser(initator_email))
-        username = fields.Str(required=True, validate=validate_equal_or_superuser(initiator_username))
+            )(value)
+
+        @validates_schema
+        def validate_instance_names(self, data, **kwargs):
+            # A request names either a single instance, optionally repeated `count` times, or a list of instances
+            if ("instance_name" in data) == ("instance_names" in data):
+                raise ValidationError("Exactly one of instanceName or instanceNames must be provided.")
+
+            if "count" in data and "instance_names" in data:
+                raise ValidationError("count can only be used together with instanceName.")
 
         @validates_schema
         def validate_lower_bound(self, data, **kwargs):
             # Validate region
-            supported_regions = region_map.get(data["account"])
-
-            if not supported_regions or data["region"] not in supported_regions:
+            if (data["account"], data["region"]) not in supported_oses:
                 raise ValidationError(f"Missing permission for region {data['region']}.")
 
             # Validate operating system
-            supported_oses = region_map[data["account"]][data["region"]]["os_types"]
-            if not supported_oses or data["operating_system"] not in supported_oses:
+            if data["operating_system"] not in supported_oses[(data["account"], data["region"])]:
                 raise ValidationError(f"Missing permission for operating_system {data['operating_system']}.")
 
         class Meta:
@@ -71,7 +110,23 @@ def instance_post_serializer(
     return RequestValidator()
 
 
+def validate_instance_owner(data, initiator_email, initiator_username):
+    # Only superusers provision instances on behalf of other users
+    errors = {
+        field: [f"Must be equal to {expected}."]
+        for field, expected in (("email", initiator_email), ("username", initiator_username))
+        if data[field] != expected
+    }
+    if errors:
+        raise ValidationError(errors)
+
+
 def instance_patch_serializer(instance_types):
+    return build_instance_patch_serializer(instance_types=tuple(sorted(instance_types)))
+
+
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def build_instance_patch_serializer(instance_types):
     return Schema.from_dict(
         dict(
             instance_type=fields.Str(required=True, data_key="instanceType", validate=OneOf(instance_types)),
@@ -87,10 +142,103 @@ class WaitRequestValidator(Schema):
         unknown = EXCLUDE
 
 
-class WaitForUpdateCompletionRequestValidator(Schema):
+class ProvisioningWaitStackSetValidator(Schema):
     stackset_id = fields.Str(required=True)
-    update_level = fields.Str(required=True)
+    operation_id = fields.Str(required=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class ProvisioningWaitRequestValidator(Schema):
+    stacksets = fields.List(
+        fields.Nested(ProvisioningWaitStackSetValidator), required=True, validate=Length(min=1, max=MAX_FLEET_SIZE)
+    )
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class InstanceStateChangeDetailValidator(Schema):
+    instance_id = fields.Str(required=True, data_key="instance-id")
+    state = fields.Str(required=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class InstanceStateChangeEventValidator(Schema):
+    # EventBridge "EC2 Instance State-change Notification" event
+    time = fields.AwareDateTime(required=True)
+    account = fields.Str(required=True)
+    region = fields.Str(required=True)
+    detail = fields.Nested(InstanceStateChangeDetailValidator, required=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class UpdateMonitorStackSetValidator(Schema):
+    stackset_id = fields.Str(required=True)
+    # Operations drained from the queues can differ from the level of the execution monitoring them
+    update_level = fields.Str(required=False, allow_none=True)
     operation_id = fields.Str(required=False, allow_none=True)
+    account_id = fields.Str(required=False, allow_none=True)
+    region = fields.Str(required=False, allow_none=True)
+    stack_id = fields.Str(required=False, allow_none=True)
+    instance_id = fields.Str(required=False, allow_none=True)
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class WaitForUpdateCompletionRequestValidator(Schema):
+    update_level = fields.Str(required=True)
+    stacksets = fields.List(fields.Nested(UpdateMonitorStackSetValidator), required=True, validate=Length(min=1))
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class InstanceBatchRequestValidator(Schema):
+    stackset_ids = fields.List(
+        fields.Str(),
+        required=True,
+        data_key="stacksetIds",
+        validate=Length(min=1, max=MAX_BATCH_SIZE),
+    )
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class InstanceListRequestValidator(Schema):
+    limit = fields.Int(load_default=DEFAULT_PAGE_SIZE, validate=Range(min=1, max=MAX_PAGE_SIZE))
+    cursor = fields.Str()
+    account = fields.Str()
+    region = fields.Str()
+    group = fields.Str()
+    status = fields.Str()
+    owner = fields.Email()
+    expiry_from = fields.AwareDateTime(data_key="expiryFrom")
+    expiry_to = fields.AwareDateTime(data_key="expiryTo")
+    order = fields.Str(load_default="asc", validate=OneOf(["asc", "desc"]))
+    since = fields.AwareDateTime()
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class InstanceExportRequestValidator(Schema):
+    format = fields.Str(load_default="ndjson", validate=OneOf(["ndjson", "csv"]))
+
+    class Meta:
+        unknown = EXCLUDE
+
+
+class InstanceEventsRequestValidator(Schema):
+    owner = fields.Email()
+    since = fields.AwareDateTime()
 
     class Meta:
         unknown = EXCLUDE
@@ -28,6 +28,9 @@ ADMIN_GROUP_NAME = env.str("ADMIN_GROUP_NAME")  # noqa: F405
 # AWS config
 DYNAMODB_PERMISSIONS_TABLE_NAME = env.str("DYNAMODB_PERMISSIONS_TABLE_NAME")
 DYNAMODB_STATE_TABLE_NAME = env.str("DYNAMODB_STATE_TABLE_NAME")
+DYNAMODB_STACKSET_POOL_TABLE_NAME = env.str("DYNAMODB_STACKSET_POOL_TABLE_NAME")
+DYNAMODB_USER_COUNTERS_TABLE_NAME = env.str("DYNAMODB_USER_COUNTERS_TABLE_NAME")
+DYNAMODB_STATE_TOMBSTONES_TABLE_NAME = env.str("DYNAMODB_STATE_TOMBSTONES_TABLE_NAME")
 DYNAMODB_REGIONAL_METADATA_TABLE_NAME = env.str(
     "DYNAMODB_REGIONAL_METADATA_TABLE_NAME"
 )  # noqa: F405
@@ -46,3 +49,57 @@ CLEANUP_NOTICE_NOTIFICATION_HOURS = env.str(
     "CLEANUP_NOTICE_NOTIFICATION_HOURS"
 )  # noqa: F405
 TAG_CONFIG = env.str("TAG_CONFIG")  # noqa: F405
+
+# StackSet OperationPreferences of the create, update and delete operations
+DEFAULT_STACKSET_OPERATION_PREFERENCES = (
+    '{"RegionConcurrencyType": "PARALLEL", "MaxConcurrentPercentage": 100, '
+    '"FailureToleranceCount": 0, "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE"}'
+)
+STACKSET_CREATE_OPERATION_PREFERENCES = env.json(
+    "STACKSET_CREATE_OPERATION_PREFERENCES", default=DEFAULT_STACKSET_OPERATION_PREFERENCES
+)
+STACKSET_UPDATE_OPERATION_PREFERENCES = env.json(
+    "STACKSET_UPDATE_OPERATION_PREFERENCES", default=DEFAULT_STACKSET_OPERATION_PREFERENCES
+)
+STACKSET_DELETE_OPERATION_PREFERENCES = env.json(
+    "STACKSET_DELETE_OPERATION_PREFERENCES", default=DEFAULT_STACKSET_OPERATION_PREFERENCES
+)
+
+# Provisioning queue, leave the table name empty to keep the queue in memory
+PROVISIONING_QUEUE_TABLE_NAME = env.str("PROVISIONING_QUEUE_TABLE_NAME", default="")
+# Maximum number of instances being provisioned at once in each target account
+PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT = env.int("PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT", default=10)
+# Seconds after which a started provisioning request that never reported back stops holding capacity
+PROVISIONING_IN_FLIGHT_TIMEOUT = env.int("PROVISIONING_IN_FLIGHT_TIMEOUT", default=3600)
+PRIVATE_API_FUNCTION_NAME = env.str("PRIVATE_API_FUNCTION_NAME", default="")
+
+# Seconds after which a stackset operation that never reported back stops holding the stackset,
+# letting the operations queued behind it run
+STACKSET_OPERATION_TIMEOUT = env.int("STACKSET_OPERATION_TIMEOUT", default=3600)
+
+# Idempotency keys of the mutation requests, leave the table name empty to keep the keys in memory
+IDEMPOTENCY_TABLE_NAME = env.str("IDEMPOTENCY_TABLE_NAME", default="")
+# Seconds during which a request can be retried with the same idempotency key
+IDEMPOTENCY_KEY_TTL = env.int("IDEMPOTENCY_KEY_TTL", default=86400)
+# Seconds a request holds its key, past them a request that never completed, e.g. killed by the Lambda timeout,
+# is presumed dead and a retry takes the key over. Kept above the Lambda timeout.
+IDEMPOTENCY_IN_PROGRESS_LEASE = env.int("IDEMPOTENCY_IN_PROGRESS_LEASE", default=60)
+
+# Instance listings kept in memory by each worker. Writes of other processes, e.g. the instance status
+# changes recorded by the private API, are only picked up once an entry expires (in seconds)
+LISTING_CACHE_MAX_SIZE = env.int("LISTING_CACHE_MAX_SIZE", default=1024)
+LISTING_CACHE_TTL = env.int("LISTING_CACHE_TTL", default=15)
+# Seconds an instance events long poll is held without changes, kept under the Lambda timeout,
+# and seconds between two reads of the changes and between two heartbeats of an idle poll
+EVENT_STREAM_MAX_DURATION = env.int("EVENT_STREAM_MAX_DURATION", default=25)
+EVENT_STREAM_POLL_INTERVAL = env.float("EVENT_STREAM_POLL_INTERVAL", default=2)
+EVENT_STREAM_HEARTBEAT_INTERVAL = env.int("EVENT_STREAM_HEARTBEAT_INTERVAL", default=15)
+# Seconds during which deleted instances are reported to the clients syncing changes, older sync tokens expire
+STATE_TOMBSTONE_TTL = env.int("STATE_TOMBSTONE_TTL", default=604800)
+
+# Maximum number of empty stacksets kept for reuse, per template file
+STACKSET_POOL_MAX_SIZE = env.int("STACKSET_POOL_MAX_SIZE", default=20)
+
+# Target sizes of the warm pools of stopped instances, a list of dicts with
+# "group", "operating_system", "account", "region", "instance_type" and "size"
+WARM_POOL_TARGETS = env.json("WARM_POOL_TARGETS", default="[]")
@@ -29,6 +29,9 @@ ADMIN_GROUP_NAME = "quail-admins"
 # AWS config
 DYNAMODB_PERMISSIONS_TABLE_NAME = "todo"
 DYNAMODB_STATE_TABLE_NAME = "todo"
+DYNAMODB_STACKSET_POOL_TABLE_NAME = "todo"
+DYNAMODB_USER_COUNTERS_TABLE_NAME = "todo"
+DYNAMODB_STATE_TOMBSTONES_TABLE_NAME = "todo"
 DYNAMODB_REGIONAL_METADATA_TABLE_NAME = "todo"
 
 PROVISION_SFN_ARN = "todo"
@@ -43,3 +46,23 @@ STACK_SET_ADMIN_ROLE_ARN = "todo"
 
 CLEANUP_NOTICE_NOTIFICATION_HOURS = "todo"
 TAG_CONFIG = "todo"
+STACKSET_POOL_MAX_SIZE = 20
+PROVISIONING_QUEUE_TABLE_NAME = ""
+PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT = 10
+PROVISIONING_IN_FLIGHT_TIMEOUT = 3600
+STACKSET_OPERATION_TIMEOUT = 3600
+IDEMPOTENCY_TABLE_NAME = ""
+IDEMPOTENCY_KEY_TTL = 86400
+IDEMPOTENCY_IN_PROGRESS_LEASE = 60
+LISTING_CACHE_MAX_SIZE = 1024
+LISTING_CACHE_TTL = 15
+STATE_TOMBSTONE_TTL = 604800
+EVENT_STREAM_MAX_DURATION = 25
+EVENT_STREAM_POLL_INTERVAL = 2
+EVENT_STREAM_HEARTBEAT_INTERVAL = 15
+PRIVATE_API_FUNCTION_NAME = ""
+STACKSET_CREATE_OPERATION_PREFERENCES = {}
+STACKSET_UPDATE_OPERATION_PREFERENCES = {}
+STACKSET_DELETE_OPERATION_PREFERENCES = {}
+
+WARM_POOL_TARGETS = []
@@ -0,0 +1,155 @@
+"""Records of the state table entries, and the codec converting them from and to DynamoDB items.
+
+The decoders are compiled once per set of fields, decoding an item is then a single pass over a tuple
+without any per-item closures or lookups of the attribute definitions.
+
+The API responses are built from the entries decoded as dicts, which the views annotate and serialize as they are.
+The records are used where the entries are only read: the scripts and the cleanup schedule's scan of the table.
+"""
+
+# (record field, DynamoDB attribute, DynamoDB type) of the state table entries
+STATE_TABLE_ATTRIBUTES = (
+    ("stackset_id", "stacksetID", "S"),
+    ("expiry", "expiry", "S"),
+    ("extension_count", "extensionCount", "N"),
+    ("username", "username", "S"),
+    ("email", "email", "S"),
+    ("group", "group", "S"),
+    ("account", "account", "S"),
+    ("instance_name", "instanceName", "S"),
+    ("instance_status", "instanceStatus", "S"),
+    ("instance_type", "instanceType", "S"),
+    ("operating_system", "operatingSystem", "S"),
+    ("private_ip", "privateIp", "S"),
+    ("region", "region", "S"),
+    ("connection_protocol", "connectionProtocol", "S"),
+    ("instance_id", "instanceId", "S"),
+    ("availability_zone", "availabilityZone", "S"),
+    ("update_task_token", "updateTaskToken", "S"),
+    ("fleet_id", "fleetId", "S"),
+    ("pool_key", "poolKey", "S"),
+    ("operation_id", "operationId", "S"),
+    ("template_file", "templateFile", "S"),
+    ("updated_at", "updatedAt", "S"),
+)
+
+
+class StackSetRecord:
+    """A state table entry, the fields missing from the item are None."""
+
+    __slots__ = tuple(field for field, _, _ in STATE_TABLE_ATTRIBUTES)
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, StackSetRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"StackSetRecord(stackset_id={self.stackset_id!r}, email={self.email!r})"
+
+
+def decode_number(value):
+    return int(value)
+
+
+def decode_string(value):
+    return value
+
+
+DECODERS = {"N": decode_number, "S": decode_string}
+ENCODERS = {"N": str, "S": str}
+
+
+class StateTableCodec:
+    """Converts the state table items, optionally restricted to a projection of their fields."""
+
+    def __init__(self, fields=None):
+        attributes = [attribute for attribute in STATE_TABLE_ATTRIBUTES if fields is None or attribute[0] in fields]
+        self.fields = tuple(field for field, _, _ in attributes)
+        self.attributes = {field: (name, type_key) for field, name, type_key in attributes}
+        # Slot descriptors set the fields of a record without going through its __init__
+        self.decoders = tuple(
+            (field, getattr(StackSetRecord, field).__set__, name, type_key, DECODERS[type_key])
+            for field, name, type_key in attributes
+        )
+        self.unset = tuple(
+            getattr(StackSetRecord, field).__set__ for field in StackSetRecord.__slots__ if field not in self.fields
+        )
+        self.projections = {}
+
+    def project(self, fields):
+        # Codecs are compiled once per set of fields, the views project the same few sets on every request
+        key = frozenset(fields)
+        if key not in self.projections:
+            self.projections[key] = StateTableCodec(fields=key)
+
+        return self.projections[key]
+
+    def get_projection(self):
+        # ProjectionExpression and ExpressionAttributeNames reading only the fields of the codec
+        names = {f"#{name}": name for name, _ in self.attributes.values()}
+        return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+    def decode(self, item):
+        record = StackSetRecord.__new__(StackSetRecord)
+        for _, set_field, name, type_key, decode in self.decoders:
+            value = item.get(name)
+            set_field(record, None if value is None else decode(value[type_key]))
+        for set_field in self.unset:
+            set_field(record, None)
+
+        return record
+
+    def decode_dict(self, item):
+        # Same as decode(item).to_dict(), restricted to the fields of the codec
+        result = {}
+        for field, _, name, type_key, decode in self.decoders:
+            value = item.get(name)
+            result[field] = None if value is None else decode(value[type_key])
+
+        return result
+
+    def encode(self, record):
+        # DynamoDB item of the record, the fields set to None are left out
+        item = {}
+        for field, (name, type_key) in self.attributes.items():
+            value = getattr(record, field)
+            if value is not None:
+                item[name] = {type_key: ENCODERS[type_key](value)}
+
+        return item
+
+    def encode_update(self, changes):
+        """UpdateItem arguments applying the changes, a dict of record field -> value, None removes the field."""
+        names = {}
+        values = {}
+        set_actions = []
+        remove_actions = []
+        for field, value in changes.items():
+            name, type_key = self.attributes[field]
+            names[f"#{name}"] = name
+            if value is None:
+                remove_actions.append(f"#{name}")
+            else:
+                values[f":{name}"] = {type_key: ENCODERS[type_key](value)}
+                set_actions.append(f"#{name} = :{name}")
+
+        expression = []
+        if set_actions:
+            expression.append("SET " + ", ".join(set_actions))
+        if remove_actions:
+            expression.append("REMOVE " + ", ".join(remove_actions))
+
+        update = {"UpdateExpression": " ".join(expression), "ExpressionAttributeNames": names}
+        if values:
+            update["ExpressionAttributeValues"] = values
+
+        return update
+
+
+STATE_TABLE_CODEC = StateTableCodec()
@@ -0,0 +1,12 @@
+def get_tags(environment, tag_config):
+    tags = []
+
+    for tag in tag_config:
+        if tag["tag-value"].startswith("$"):
+            # Skip leading dollar sign
+            attribute_key = tag["tag-value"][1:]
+            tag["tag-value"] = environment[attribute_key]
+
+        tags.append(tag)
+
+    return tags
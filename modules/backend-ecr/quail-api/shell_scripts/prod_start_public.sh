@@ -4,6 +4,5 @@ set -o errexit
 set -o pipefail
 set -o nounset
 
-#/usr/local/bin/gunicorn -k gevent --bind 0.0.0.0:5050 autoapp:app
-
+# Lambda sends one request at a time to each execution environment, long polls included, a sync worker is enough
 /usr/local/bin/gunicorn -b=:8080 -w=1 public_app:app
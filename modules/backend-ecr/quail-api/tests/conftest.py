@@ -3,6 +3,7 @@
 import logging
 
 import pytest
+from flask import g, has_app_context
 from flask.testing import FlaskClient
 
 from backend.app import create_public_app, create_private_app
@@ -38,3 +39,10 @@ def public_app():
 def client_anonymous(public_app):
     public_app.test_client_class = FlaskClient
     yield public_app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def empty_request_cache():
+    # The apps keep a request context pushed across the tests, don't let the reads of one test leak into the next
+    if has_app_context():
+        g.pop("request_cache", None)
@@ -0,0 +1,110 @@
+from collections import defaultdict
+
+import pytest
+
+from backend.aws_utils import UpdateLevel
+from backend.exceptions import UnauthorizedForInstanceError
+from backend.public_api import views
+
+
+class FakeEC2Client:
+    def __init__(self):
+        self.calls = []
+
+    def start_instances(self, InstanceIds):
+        self.calls.append(("start", InstanceIds))
+
+    def stop_instances(self, InstanceIds):
+        self.calls.append(("stop", InstanceIds))
+
+
+def stackset(stackset_id, account="111111111111", region="eu-west-1", email="user@example.com"):
+    return {
+        "stackset_id": stackset_id,
+        "account": account,
+        "region": region,
+        "instance_id": f"i-{stackset_id}",
+        "email": email,
+    }
+
+
+@pytest.fixture
+def ec2_clients(private_app, monkeypatch):
+    clients = defaultdict(FakeEC2Client)
+    monkeypatch.setattr(
+        private_app.aws, "get_remote_client", lambda account_id, region, service: clients[(account_id, region)]
+    )
+    yield clients
+
+
+def test_instances_are_changed_with_one_call_per_account_and_region(private_app, monkeypatch, ec2_clients):
+    monitored = []
+    # quail-4 has an operation in progress, its action is queued behind it
+    monkeypatch.setattr(
+        private_app.aws,
+        "acquire_stackset_operation",
+        lambda stackset_id, queued_fields: None if stackset_id == "quail-4" else {"email": "user@example.com"},
+    )
+    monkeypatch.setattr(
+        private_app.aws, "monitor_updates", lambda stacksets, update_level: monitored.append((stacksets, update_level))
+    )
+    stacksets = [
+        stackset("quail-1"),
+        stackset("quail-2", region="us-east-1"),
+        stackset("quail-3"),
+        stackset("quail-4"),
+    ]
+
+    started = private_app.aws.change_instances_state(stacksets=stacksets, action="stop")
+
+    assert started == ["quail-1", "quail-2", "quail-3"]
+    assert ec2_clients[("111111111111", "eu-west-1")].calls == [("stop", ["i-quail-1", "i-quail-3"])]
+    assert ec2_clients[("111111111111", "us-east-1")].calls == [("stop", ["i-quail-2"])]
+    # A single monitoring execution tracks the whole batch
+    assert len(monitored) == 1
+    assert [item["stackset_id"] for item in monitored[0][0]] == started
+    assert monitored[0][1] == UpdateLevel.INSTANCE_LEVEL
+
+
+@pytest.fixture
+def batch_request(public_app, monkeypatch):
+    changed = []
+    monkeypatch.setattr(
+        public_app.aws, "get_claims", lambda request: {"email": "user@example.com", "is_superuser": False}
+    )
+    monkeypatch.setattr(
+        public_app.aws,
+        "get_stacksets_state_data",
+        lambda stackset_ids, fields: {
+            "quail-1": stackset("quail-1"),
+            "quail-2": stackset("quail-2"),
+            "quail-3": stackset("quail-3", email="other@example.com"),
+        },
+    )
+
+    def change_instances_state(stacksets, action):
+        changed.append((stacksets, action))
+        return ["quail-1"]
+
+    monkeypatch.setattr(public_app.aws, "change_instances_state", change_instances_state)
+
+    def call(view, stackset_ids):
+        with public_app.test_request_context("/instance/batch", method="POST", json={"stacksetIds": stackset_ids}):
+            return view()
+
+    call.changed = changed
+    yield call
+
+
+def test_batch_reports_the_instances_queued_behind_an_operation(batch_request):
+    response = batch_request(views.post_instance_batch_start, stackset_ids=["quail-1", "quail-2"])
+
+    assert response == ({"queued": ["quail-2"]}, 202)
+    assert [action for _, action in batch_request.changed] == ["start"]
+
+
+def test_batch_with_an_instance_of_another_user_changes_nothing(batch_request):
+    with pytest.raises(UnauthorizedForInstanceError):
+        batch_request(views.post_instance_batch_stop, stackset_ids=["quail-1", "quail-3"])
+
+    assert batch_request.changed == []
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from backend.public_api import views
+
+CLAIMS_HEADER = json.dumps(
+    {"authorizer": {"jwt": {"claims": {"email": "user@example.com", "groups": "[devs]", "name": "user"}}}}
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_listing_cache(public_app):
+    public_app.aws.invalidate_listings()
+
+
+def test_unchanged_instances_are_not_sent_again(public_app, monkeypatch):
+    lookups = []
+    stacksets = [{"stackset_id": "quail-1", "email": "user@example.com", "instance_status": "running"}]
+    monkeypatch.setattr(public_app.aws, "get_stacksets_page", lambda **kwargs: (stacksets, None))
+    monkeypatch.setattr(public_app.aws, "get_permissions_for_all_groups", lambda groups: lookups.append(groups) or {})
+    monkeypatch.setattr(
+        public_app.aws, "annotate_user_stacksets", lambda stacksets, permissions, is_superuser: stacksets
+    )
+
+    headers = {"X-Amzn-Request-Context": CLAIMS_HEADER}
+    with public_app.test_request_context("/instance", headers=headers):
+        first = views.get_instances()
+
+    with public_app.test_request_context("/instance", headers={**headers, "If-None-Match": first.headers["ETag"]}):
+        second = views.get_instances()
+
+    # Written by another process, the cached listing is served until it is invalidated
+    stacksets[0]["instance_status"] = "stopped"
+    public_app.aws.invalidate_listings(email="user@example.com")
+    with public_app.test_request_context("/instance", headers={**headers, "If-None-Match": first.headers["ETag"]}):
+        third = views.get_instances()
+
+    assert first.status_code == 200
+    assert second.status_code == 304
+    assert third.status_code == 200
+    assert len(lookups) == 2
+
+
+def test_listing_is_served_from_cache_until_invalidated(public_app, monkeypatch):
+    scans = []
+    stacksets = [{"stackset_id": "quail-1", "email": "user@example.com", "instance_status": "running"}]
+    monkeypatch.setattr(
+        public_app.aws, "get_stacksets_page", lambda **kwargs: scans.append(kwargs) or (stacksets, None)
+    )
+    monkeypatch.setattr(public_app.aws, "get_permissions_for_all_groups", lambda groups: {})
+    monkeypatch.setattr(
+        public_app.aws, "annotate_user_stacksets", lambda stacksets, permissions, is_superuser: stacksets
+    )
+
+    headers = {"X-Amzn-Request-Context": CLAIMS_HEADER}
+    responses = []
+    for invalidate in [False, False, True]:
+        if invalidate:
+            public_app.aws.invalidate_listings(email="user@example.com")
+        with public_app.test_request_context("/instance", headers=headers):
+            responses.append(views.get_instances())
+
+    assert len(scans) == 2
+    assert responses[0].get_json() == responses[1].get_json()
+    assert responses[0].get_json()["instances"] == stacksets
+    assert responses[1].headers["ETag"] == responses[0].headers["ETag"]
+
+
+def test_params_are_versioned_by_their_content(public_app, monkeypatch):
+    permissions = {"devs": {"accounts": ["111111111111"], "instance_types": ["t3.micro"]}}
+    monkeypatch.setattr(
+        public_app.aws,
+        "get_permissions_for_all_groups",
+        lambda groups: {group: dict(permissions[group]) for group in groups},
+    )
+
+    headers = {"X-Amzn-Request-Context": CLAIMS_HEADER}
+    with public_app.test_request_context("/param", headers=headers):
+        first = views.get_params()
+
+    with public_app.test_request_context("/param", headers={**headers, "If-None-Match": first.headers["ETag"]}):
+        second = views.get_params()
+
+    permissions["devs"]["accounts"] = ["222222222222"]
+    with public_app.test_request_context("/param", headers={**headers, "If-None-Match": first.headers["ETag"]}):
+        third = views.get_params()
+
+    assert (first.status_code, second.status_code, third.status_code) == (200, 304, 200)
+    assert third.headers["ETag"] != first.headers["ETag"]
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from backend import aws_utils
+from backend.exceptions import SyncTokenExpiredError
+from tests.test_pagination import state_item
+
+CLAIMS_HEADER = json.dumps(
+    {"authorizer": {"jwt": {"claims": {"email": "user@example.com", "groups": "[devs]", "name": "user"}}}}
+)
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, TableName, **kwargs):
+        return self.pages[TableName]
+
+
+class FakeDynamoDBClient:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get_paginator(self, operation):
+        return FakePaginator(self.pages)
+
+
+def test_changes_skip_tombstones_of_recycled_stacksets(public_app, monkeypatch):
+    monkeypatch.setattr(public_app.aws, "tombstones_table_name", "tombstones")
+    client = FakeDynamoDBClient(
+        pages={
+            public_app.aws.state_table_name: [{"Items": [state_item("quail-1")]}],
+            "tombstones": [{"Items": [{"stacksetID": {"S": "quail-1"}}, {"stacksetID": {"S": "quail-2"}}]}],
+        }
+    )
+    monkeypatch.setattr(aws_utils.boto3, "client", lambda service: client)
+
+    since = public_app.aws.get_sync_token()
+    stacksets, deleted, sync_token = public_app.aws.get_stackset_changes(owner="user@example.com", since=since)
+
+    assert [stackset["stackset_id"] for stackset in stacksets] == ["quail-1"]
+    assert deleted == ["quail-2"]
+    assert sync_token >= since
+
+
+def test_sync_token_older_than_tombstones_expires(public_app):
+    with pytest.raises(SyncTokenExpiredError):
+        public_app.aws.get_stackset_changes(owner=None, since="2000-01-01T00:00:00.000000+00:00")
+
+
+def test_event_long_poll_resumes_from_last_event_id(public_app, monkeypatch):
+    calls = []
+    batches = [([], [], "token-1"), ([{"stackset_id": "quail-1"}], ["quail-2"], "token-2")]
+
+    def get_stackset_changes(owner, since):
+        calls.append(since)
+        return batches[len(calls) - 1]
+
+    monkeypatch.setattr(public_app.aws, "get_stackset_changes", get_stackset_changes)
+    monkeypatch.setattr(public_app.aws, "get_permissions_for_all_groups", lambda groups: {})
+    monkeypatch.setattr(
+        public_app.aws, "annotate_user_stacksets", lambda stacksets, permissions, is_superuser: stacksets
+    )
+    monkeypatch.setitem(public_app.config, "EVENT_STREAM_MAX_DURATION", 5)
+    monkeypatch.setitem(public_app.config, "EVENT_STREAM_POLL_INTERVAL", 0.05)
+
+    response = public_app.test_client().get(
+        "/instance/events",
+        headers={"X-Amzn-Request-Context": CLAIMS_HEADER, "Last-Event-ID": "2030-01-01T00:00:00+00:00"},
+    )
+    body = response.get_data(as_text=True)
+
+    # The poll is held until the first changes, and ends with them
+    assert response.mimetype == "text/event-stream"
+    assert calls == ["2030-01-01T00:00:00.000000+00:00", "token-1"]
+    assert 'event: instance\ndata: {"stackset_id":"quail-1"}\n\n' in body
+    assert body.endswith('event: deleted\ndata: {"stackset_id":"quail-2"}\nid: token-2\n\n')
@@ -0,0 +1,39 @@
+import json
+
+from backend import aws_utils
+
+CLAIMS_HEADER = json.dumps(
+    {"authorizer": {"jwt": {"claims": {"email": "admin@example.com", "groups": "[quail-admins]", "name": "admin"}}}}
+)
+
+
+def stackset(index):
+    return {
+        **{field: None for field in aws_utils.EXPORT_FIELDS},
+        "stackset_id": f"quail-{index}",
+        "account": "111111111111",
+        "region": "eu-west-1" if index % 2 else "us-east-1",
+        "instance_id": f"i-{index}",
+        "update_task_token": "secret",
+    }
+
+
+def test_export_streams_rows_with_their_ec2_state(public_app, monkeypatch):
+    described = []
+
+    def get_instance_states(account_id, region, instance_ids):
+        described.append(len(instance_ids))
+        return {instance_id: "running" for instance_id in instance_ids}
+
+    monkeypatch.setattr(aws_utils, "EXPORT_BATCH_SIZE", 4)
+    monkeypatch.setattr(public_app.aws, "iter_stacksets", lambda: (stackset(index) for index in range(10)))
+    monkeypatch.setattr(public_app.aws, "get_instance_states", get_instance_states)
+
+    response = public_app.test_client().get("/instance/export", headers={"X-Amzn-Request-Context": CLAIMS_HEADER})
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert response.mimetype == "application/x-ndjson"
+    assert [row["stackset_id"] for row in rows] == [f"quail-{index}" for index in range(10)]
+    assert all(row["ec2_state"] == "running" and "update_task_token" not in row for row in rows)
+    # Batches of 4 stacksets, each described per region
+    assert described == [2, 2, 2, 2, 1, 1]
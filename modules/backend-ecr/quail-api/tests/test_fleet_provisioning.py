@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+import pytest
+from marshmallow import ValidationError
+
+from backend.public_api import views
+from backend.serializers import MAX_FLEET_SIZE, instance_post_serializer
+
+ACCOUNT = "111111111111"
+REGION = "eu-west-1"
+OS_CONFIG = {
+    "template-filename": "aws_linux.yaml",
+    "connection-protocol": "ssh",
+    "user-data-file": "aws_linux.sh",
+    "region-map": {ACCOUNT: {REGION: {"ami": "ami-1", "security-group": "sg-1", "instance-profile-name": "profile"}}},
+}
+TAGS = [{"tag-name": "team", "tag-value": "devs"}, {"tag-name": "owner", "tag-value": "user"}]
+
+
+def post_body(**fields):
+    return {
+        "account": ACCOUNT,
+        "region": REGION,
+        "instanceType": "t3.micro",
+        "operatingSystem": "aws_linux",
+        "expiry": (datetime.now(timezone.utc) + timedelta(days=1)).isoformat(),
+        "email": "user@example.com",
+        "username": "user",
+        **fields,
+    }
+
+
+@pytest.fixture
+def serializer():
+    return instance_post_serializer(
+        accounts=[ACCOUNT],
+        region_map={ACCOUNT: {REGION: {"os_types": ["aws_linux"]}}},
+        instance_types=["t3.micro"],
+        max_days_to_expiry=7,
+    )
+
+
+def test_fleet_is_requested_by_count_or_names(serializer):
+    assert serializer.load(post_body(instanceName="box", count=3))["count"] == 3
+    assert serializer.load(post_body(instanceNames=["a", "b"]))["instance_names"] == ["a", "b"]
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"instanceName": "box", "instanceNames": ["a"]},
+        {"instanceNames": ["a"], "count": 2},
+        {"instanceName": "box", "count": MAX_FLEET_SIZE + 1},
+        {"instanceNames": []},
+    ],
+)
+def test_invalid_fleet_requests_are_rejected(serializer, fields):
+    with pytest.raises(ValidationError):
+        serializer.load(post_body(**fields))
+
+
+class FakeClient:
+    """Answers the CloudFormation and DynamoDB calls creating a fleet, and records them."""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = Lock()
+
+    def record(self, name, **kwargs):
+        with self.lock:
+            self.calls.append((name, kwargs))
+            return len(self.calls)
+
+    def create_stack_set(self, **kwargs):
+        return {"StackSetId": f"created-{self.record('create_stack_set', **kwargs)}"}
+
+    def update_stack_set(self, **kwargs):
+        self.record("update_stack_set", **kwargs)
+
+    def create_stack_instances(self, **kwargs):
+        self.record("create_stack_instances", **kwargs)
+        return {"OperationId": f"op-{kwargs['StackSetName']}"}
+
+    def batch_write_item(self, **kwargs):
+        self.record("batch_write_item", **kwargs)
+        return {}
+
+    def called(self, name):
+        return [kwargs for call, kwargs in self.calls if call == name]
+
+
+def test_fleet_is_created_as_one_provisioning_job(private_app, monkeypatch):
+    client = FakeClient()
+    aws = private_app.aws
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+    monkeypatch.setattr(aws, "get_os_config", lambda group_name, os_name: OS_CONFIG)
+    monkeypatch.setattr(aws, "claim_recycled_stack_sets", lambda template_filename, count: ["recycled-1"])
+    monkeypatch.setattr(
+        aws,
+        "get_provisioning_params_for_region",
+        lambda account_id, region, instance_type: {
+            "vpc_id": "vpc-1",
+            "subnet_id": "subnet-1",
+            "ssh_key_name": "key",
+            "availability_zone": "eu-west-1a",
+        },
+    )
+
+    created = aws.create_stack_sets(
+        project_name="quail",
+        tags=TAGS,
+        account=ACCOUNT,
+        region=REGION,
+        instance_type="t3.micro",
+        operating_system="aws_linux",
+        expiry=datetime.now(timezone.utc),
+        email="user@example.com",
+        group="devs",
+        instance_names=["box-1", "box-2", "box-3"],
+        username="user",
+        fleet_id="fleet-1",
+    )
+
+    # The recycled stackset only gets its parameters updated
+    assert created[0] == {"stackset_id": "recycled-1", "operation_id": "op-recycled-1"}
+    assert len(client.called("update_stack_set")) == 1
+    assert len(client.called("create_stack_set")) == 2
+    assert len(client.called("create_stack_instances")) == 3
+
+    # One state entry per instance, all part of the same fleet
+    [batch_write] = client.called("batch_write_item")
+    items = [request["PutRequest"]["Item"] for request in batch_write["RequestItems"][aws.state_table_name]]
+    assert [item["stacksetID"]["S"] for item in items] == [result["stackset_id"] for result in created]
+    assert [item["instanceName"]["S"] for item in items] == ["box-1", "box-2", "box-3"]
+    assert {item["fleetId"]["S"] for item in items} == {"fleet-1"}
+    assert not any("poolKey" in item for item in items)
+
+
+def test_fleet_request_is_queued_as_a_single_provisioning_request(public_app, monkeypatch):
+    enqueued = []
+    aws = public_app.aws
+    permissions = {
+        "region_map": {ACCOUNT: {REGION: {"os_types": ["aws_linux"]}}},
+        "instance_types": ["t3.micro"],
+        "max_days_to_expiry": 7,
+        "max_instance_count": 5,
+    }
+    monkeypatch.setattr(
+        aws,
+        "get_claims",
+        lambda request: {
+            "email": "user@example.com",
+            "groups": ["devs"],
+            "username": "user",
+            "is_superuser": False,
+            "claims": {},
+        },
+    )
+    monkeypatch.setattr(aws, "get_permissions_for_one_group", lambda group_name: permissions)
+    monkeypatch.setattr(aws, "reserve_instances", lambda email, count, max_instance_count: count <= 5)
+    monkeypatch.setattr(aws, "request_provisioning_schedule", lambda function_name: None)
+
+    def enqueue(account, group, size, payload):
+        enqueued.append((size, payload))
+        return {"request_id": "request-1"}
+
+    monkeypatch.setattr(public_app.provisioning_queue, "enqueue", enqueue)
+
+    with public_app.test_request_context(
+        "/instance", method="POST", json=post_body(group="devs", instanceName="box", count=3)
+    ):
+        response = views.post_instances()
+
+    assert response["request_id"] == "request-1"
+    assert [(size, payload["instance_names"]) for size, payload in enqueued] == [(3, ["box-1", "box-2", "box-3"])]
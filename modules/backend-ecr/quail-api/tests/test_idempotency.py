@@ -0,0 +1,132 @@
+import json
+from datetime import timedelta
+
+import pytest
+
+from backend.exceptions import IdempotencyKeyReusedError, IdempotentRequestInProgressError, InvalidArgumentsError
+from backend.idempotency import IDEMPOTENT_REPLAYED_HEADER, InMemoryIdempotencyStore, get_task_token_key, idempotent
+
+CLAIMS_HEADER = json.dumps(
+    {"authorizer": {"jwt": {"claims": {"email": "user@example.com", "groups": "[devs]", "name": "user"}}}}
+)
+
+
+@pytest.fixture
+def store(public_app):
+    public_app.idempotency_store = InMemoryIdempotencyStore(ttl=timedelta(hours=1), lease=timedelta(minutes=1))
+    yield public_app.idempotency_store
+
+
+def call(app, view, key, body):
+    headers = {"X-Amzn-Request-Context": CLAIMS_HEADER}
+    if key:
+        headers["Idempotency-Key"] = key
+
+    with app.test_request_context("/instance", method="POST", json=body, headers=headers):
+        return view()
+
+
+def test_repeated_request_gets_stored_response(public_app, store):
+    calls = []
+
+    @idempotent
+    def view():
+        calls.append(1)
+        return {"stackset_ids": [len(calls)]}
+
+    first = call(public_app, view, key="abc", body={"instanceName": "box"})
+    second = call(public_app, view, key="abc", body={"instanceName": "box"})
+
+    assert len(calls) == 1
+    assert second.get_json() == first.get_json()
+    assert second.headers[IDEMPOTENT_REPLAYED_HEADER] == "true"
+
+
+def test_requests_without_key_are_not_deduplicated(public_app, store):
+    calls = []
+
+    @idempotent
+    def view():
+        calls.append(1)
+        return {}
+
+    call(public_app, view, key=None, body={})
+    call(public_app, view, key=None, body={})
+
+    assert len(calls) == 2
+
+
+def test_key_reused_for_different_request(public_app, store):
+    @idempotent
+    def view():
+        return {}
+
+    call(public_app, view, key="abc", body={"instanceName": "box"})
+    with pytest.raises(IdempotencyKeyReusedError):
+        call(public_app, view, key="abc", body={"instanceName": "other"})
+
+
+def test_failed_request_releases_key(public_app, store):
+    calls = []
+
+    @idempotent
+    def view():
+        calls.append(1)
+        if len(calls) == 1:
+            raise InvalidArgumentsError(message="Try again")
+        return {}
+
+    with pytest.raises(InvalidArgumentsError):
+        call(public_app, view, key="abc", body={})
+    call(public_app, view, key="abc", body={})
+
+    assert len(calls) == 2
+
+
+def test_stuck_request_is_taken_over_once_its_lease_is_over(public_app, store):
+    calls = []
+
+    @idempotent
+    def view():
+        calls.append(1)
+        return {}
+
+    # The first attempt was killed while holding the key
+    call(public_app, view, key="abc", body={})
+    store.records["user@example.com#abc"].update({"status": "IN_PROGRESS", "response": None})
+    with pytest.raises(IdempotentRequestInProgressError):
+        call(public_app, view, key="abc", body={})
+
+    store.records["user@example.com#abc"]["in_progress_until"] = 0
+    call(public_app, view, key="abc", body={})
+
+    assert len(calls) == 2
+    assert store.records["user@example.com#abc"]["status"] == "COMPLETED"
+
+
+def test_task_token_replay_resends_recorded_output(private_app, monkeypatch):
+    sent = []
+    monkeypatch.setattr(private_app.aws, "send_task_success", lambda task_token, output: sent.append(output))
+    client = private_app.test_client()
+
+    first = client.get("/healthcheck", headers={"TaskToken": "token"})
+    second = client.get("/healthcheck", headers={"TaskToken": "token"})
+
+    assert first.status_code == second.status_code == 204
+    assert len(sent) == 2
+    assert private_app.idempotency_store.claim(key=get_task_token_key("token"), fingerprint="")["status"] == "COMPLETED"
+
+
+def test_task_token_of_a_dead_request_is_replayed_once_its_lease_is_over(private_app, monkeypatch):
+    sent = []
+    monkeypatch.setattr(private_app.aws, "send_task_success", lambda task_token, output: sent.append(output))
+    client = private_app.test_client()
+    key = get_task_token_key("stuck-token")
+    private_app.idempotency_store.claim(key=key, fingerprint="")
+
+    assert client.get("/healthcheck", headers={"TaskToken": "stuck-token"}).status_code == 202
+    assert not sent
+
+    private_app.idempotency_store.records[key]["in_progress_until"] = 0
+    assert client.get("/healthcheck", headers={"TaskToken": "stuck-token"}).status_code == 204
+    assert len(sent) == 1
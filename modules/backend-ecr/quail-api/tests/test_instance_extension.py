@@ -0,0 +1,138 @@
+from datetime import timedelta
+
+import pytest
+
+from backend.aws_utils import CONDITIONAL_WRITE_ATTEMPTS
+from backend.exceptions import StackSetUpdateInProgressException, UnauthorizedForInstanceError
+
+EXPIRY = "2026-10-20T12:00:00+00:00"
+EXTENDED_EXPIRY = "2026-10-21T12:00:00+00:00"
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeDynamoDBClient:
+    """Answers the update_item calls with the given results, an exception class is raised instead."""
+
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def update_item(self, **kwargs):
+        self.calls.append(kwargs)
+        result = self.results.pop(0)
+        if isinstance(result, type) and issubclass(result, Exception):
+            raise result()
+        return result
+
+
+def entry(expiry=EXPIRY, extension_count=0, email="user@example.com"):
+    return {"stackset_id": "quail-1", "email": email, "expiry": expiry, "extension_count": extension_count}
+
+
+def updated(expiry, extension_count):
+    return {
+        "Attributes": {
+            "stacksetID": {"S": "quail-1"},
+            "email": {"S": "user@example.com"},
+            "expiry": {"S": expiry},
+            "extensionCount": {"N": str(extension_count)},
+        }
+    }
+
+
+@pytest.fixture
+def extend(private_app, monkeypatch):
+    reads = []
+
+    def extend(client, stackset, reread=(), superuser=False):
+        reads.extend(reread)
+        monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+        monkeypatch.setattr(
+            private_app.aws, "get_stackset_state_data", lambda stackset_id, consistent_read, fields: reads.pop(0)
+        )
+        return private_app.aws.extend_instance_expiry(
+            stackset=stackset,
+            extension=timedelta(days=1),
+            max_extension_count=None if superuser else 2,
+            owner_email=None if superuser else "user@example.com",
+        )
+
+    yield extend
+
+
+def test_extension_is_a_single_conditional_write(extend):
+    client = FakeDynamoDBClient(updated(EXTENDED_EXPIRY, 1))
+
+    stackset = extend(client, entry())
+
+    assert stackset["expiry"] == EXTENDED_EXPIRY
+    assert stackset["extension_count"] == 1
+    [call] = client.calls
+    assert call["ConditionExpression"] == (
+        "expiry = :currentExpiry AND extensionCount < :maxExtensionCount AND email = :email"
+    )
+    assert call["ExpressionAttributeValues"][":currentExpiry"] == {"S": EXPIRY}
+    assert call["ExpressionAttributeValues"][":expiry"] == {"S": EXTENDED_EXPIRY}
+    assert call["ExpressionAttributeValues"][":maxExtensionCount"] == {"N": "2"}
+
+
+def test_superusers_extend_without_limit_nor_ownership(extend):
+    client = FakeDynamoDBClient(updated(EXTENDED_EXPIRY, 3))
+
+    extend(client, entry(extension_count=2, email="other@example.com"), superuser=True)
+
+    [call] = client.calls
+    assert call["ConditionExpression"] == "expiry = :currentExpiry"
+
+
+def test_extension_reached_limit_is_not_written(extend):
+    client = FakeDynamoDBClient()
+
+    assert extend(client, entry(extension_count=2)) is None
+    assert client.calls == []
+
+
+def test_concurrent_extension_is_retried_from_the_new_expiry(extend):
+    client = FakeDynamoDBClient(ConditionalCheckFailedException, updated("2026-10-22T12:00:00+00:00", 2))
+
+    stackset = extend(client, entry(), reread=[entry(expiry=EXTENDED_EXPIRY, extension_count=1)])
+
+    assert stackset["extension_count"] == 2
+    assert [call["ExpressionAttributeValues"][":currentExpiry"]["S"] for call in client.calls] == [
+        EXPIRY,
+        EXTENDED_EXPIRY,
+    ]
+
+
+def test_concurrent_extension_reaching_the_limit_stops_the_retries(extend):
+    client = FakeDynamoDBClient(ConditionalCheckFailedException)
+
+    assert extend(client, entry(extension_count=1), reread=[entry(expiry=EXTENDED_EXPIRY, extension_count=2)]) is None
+    assert len(client.calls) == 1
+
+
+def test_instance_deleted_or_reassigned_in_the_meantime_is_not_extended(extend):
+    with pytest.raises(UnauthorizedForInstanceError):
+        extend(FakeDynamoDBClient(ConditionalCheckFailedException), entry(), reread=[{}])
+
+    with pytest.raises(UnauthorizedForInstanceError):
+        extend(
+            FakeDynamoDBClient(ConditionalCheckFailedException),
+            entry(),
+            reread=[entry(expiry=EXTENDED_EXPIRY, email="other@example.com")],
+        )
+
+
+def test_extension_gives_up_after_repeated_conflicts(extend):
+    client = FakeDynamoDBClient(*[ConditionalCheckFailedException] * CONDITIONAL_WRITE_ATTEMPTS)
+
+    with pytest.raises(StackSetUpdateInProgressException):
+        extend(client, entry(), reread=[entry()] * CONDITIONAL_WRITE_ATTEMPTS)
+
+    assert len(client.calls) == CONDITIONAL_WRITE_ATTEMPTS
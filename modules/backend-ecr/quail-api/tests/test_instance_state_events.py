@@ -0,0 +1,67 @@
+import json
+
+from backend.private_api.views import parse_instance_state_change_events
+
+
+def get_event(instance_id, state, time):
+    return {
+        "time": time,
+        "account": "111111111111",
+        "region": "eu-west-1",
+        "detail": {"instance-id": instance_id, "state": state},
+    }
+
+
+def test_events_are_parsed_from_sqs_batches_lists_and_single_events():
+    event = get_event(instance_id="i-1", state="running", time="2030-01-01T12:00:00Z")
+
+    parsed = [
+        parse_instance_state_change_events(payload)
+        for payload in ({"Records": [{"body": json.dumps(event)}]}, {"events": [event]}, event)
+    ]
+
+    assert all(events == parsed[0] for events in parsed)
+    assert parsed[0][0]["detail"] == {"instance_id": "i-1", "state": "running"}
+    assert parsed[0][0]["time"].isoformat() == "2030-01-01T12:00:00+00:00"
+
+
+def test_only_settled_applied_changes_resolve_task_tokens(private_app, monkeypatch):
+    resolved = []
+    submitted = []
+    stacksets = {
+        "i-1": {"stackset_id": "quail-1", "update_task_token": "token-1"},
+        "i-2": {"stackset_id": "quail-2", "update_task_token": "token-2"},
+        "i-3": {"stackset_id": "quail-3", "update_task_token": "token-3"},
+    }
+    monkeypatch.setattr(private_app.aws, "get_stacksets_by_instance_ids", lambda instance_ids: stacksets)
+    # The change of i-3 is older than its recorded status, the conditional write skips it
+    monkeypatch.setattr(
+        private_app.aws,
+        "update_instance_statuses",
+        lambda status_changes: submitted.extend(status_changes)
+        or [change for change in status_changes if change["instance_id"] != "i-3"],
+    )
+    monkeypatch.setattr(
+        private_app.aws,
+        "resolve_update_task_token",
+        lambda stackset_id, task_token: resolved.append((stackset_id, task_token)) or True,
+    )
+    events = [
+        get_event(instance_id="i-1", state="stopped", time="2030-01-01T12:00:02Z"),
+        # Delivered out of order, the earlier event of i-1 is ignored
+        get_event(instance_id="i-1", state="stopping", time="2030-01-01T12:00:01Z"),
+        get_event(instance_id="i-2", state="pending", time="2030-01-01T12:00:01Z"),
+        get_event(instance_id="i-3", state="running", time="2030-01-01T12:00:01Z"),
+    ]
+
+    response = private_app.test_client().post("/instanceStateChange", json={"events": events})
+
+    assert {
+        "stackset_id": "quail-1",
+        "instance_id": "i-1",
+        "state": "stopped",
+        "time": "2030-01-01T12:00:02.000000Z",
+    } in submitted
+    assert len(submitted) == 3
+    assert response.json["updated"] == ["quail-1", "quail-2"]
+    assert resolved == [("quail-1", "token-1")]
@@ -0,0 +1,24 @@
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+from backend import json_utils
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_responses_encode_like_the_stdlib_provider(public_app, monkeypatch, fast):
+    if not fast:
+        monkeypatch.setattr(json_utils, "orjson", None)
+    obj = {"expiry": datetime(2030, 1, 1, tzinfo=timezone.utc), "price": Decimal("1.5"), "name": "é", "owner": None}
+
+    response = public_app.json.response(obj)
+
+    assert json.loads(response.get_data()) == {
+        "expiry": "Tue, 01 Jan 2030 00:00:00 GMT",
+        "price": "1.5",
+        "name": "é",
+        "owner": None,
+    }
+    assert json_utils.loads(json_utils.dumps({1: ["é"]})) == {"1": ["é"]}
@@ -0,0 +1,122 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+ACCOUNT = "111111111111"
+REGION = "eu-west-1"
+OS_CONFIG = {
+    "template-filename": "aws_linux.yaml",
+    "connection-protocol": "ssh",
+    "user-data-file": "aws_linux.sh",
+    "region-map": {ACCOUNT: {REGION: {"ami": "ami-1", "security-group": "sg-1", "instance-profile-name": "profile"}}},
+}
+TAGS = [{"tag-name": "team", "tag-value": "devs"}, {"tag-name": "owner", "tag-value": "user"}]
+PREFERENCES = {
+    "CREATE": {"RegionConcurrencyType": "PARALLEL", "MaxConcurrentPercentage": 100},
+    "UPDATE": {"RegionConcurrencyType": "PARALLEL", "FailureToleranceCount": 1},
+    "DELETE": {"RegionConcurrencyType": "SEQUENTIAL", "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE"},
+}
+
+
+class FakeCloudFormationClient:
+    def __init__(self):
+        self.calls = {}
+
+    def create_stack_set(self, **kwargs):
+        self.calls["create_stack_set"] = kwargs
+        return {"StackSetId": "quail-1"}
+
+    def update_stack_set(self, **kwargs):
+        self.calls["update_stack_set"] = kwargs
+
+    def create_stack_instances(self, **kwargs):
+        self.calls["create_stack_instances"] = kwargs
+        return {"OperationId": "op-create"}
+
+    def delete_stack_instances(self, **kwargs):
+        self.calls["delete_stack_instances"] = kwargs
+        return {"OperationId": "op-delete"}
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    def metrics(self):
+        # The embedded metric documents logged, the other messages aren't JSON
+        return [json.loads(message) for message in self.messages if message.startswith('{"_aws"')]
+
+
+@pytest.fixture
+def aws(private_app, monkeypatch):
+    monkeypatch.setattr(private_app.aws, "operation_preferences", PREFERENCES)
+    monkeypatch.setattr(private_app.aws, "logger", RecordingLogger())
+    yield private_app.aws
+
+
+def create_stack_set(aws, client, recycled_stackset_id=None):
+    return aws.create_stack_set(
+        client=client,
+        project_name="quail",
+        tags=TAGS,
+        os_config=OS_CONFIG,
+        account=ACCOUNT,
+        region=REGION,
+        instance_type="t3.micro",
+        operating_system="aws_linux",
+        expiry=datetime.now(timezone.utc),
+        instance_name="box",
+        region_params={"vpc_id": "vpc-1", "subnet_id": "subnet-1", "ssh_key_name": "key"},
+        recycled_stackset_id=recycled_stackset_id,
+    )
+
+
+def test_operations_get_the_preferences_configured_for_them(aws, monkeypatch):
+    client = FakeCloudFormationClient()
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+
+    create_stack_set(aws, client)
+    create_stack_set(aws, client, recycled_stackset_id="quail-2")
+    aws.delete_stack_instance(stackset_id="quail-1", account_id=ACCOUNT, region=REGION)
+
+    assert client.calls["create_stack_instances"]["OperationPreferences"] == PREFERENCES["CREATE"]
+    assert client.calls["update_stack_set"]["OperationPreferences"] == PREFERENCES["UPDATE"]
+    assert client.calls["delete_stack_instances"]["OperationPreferences"] == PREFERENCES["DELETE"]
+
+
+def test_submission_of_an_operation_is_timed(aws):
+    create_stack_set(aws, FakeCloudFormationClient(), recycled_stackset_id="quail-2")
+
+    [metric] = aws.logger.metrics()
+    assert metric["Action"] == "CREATE"
+    assert metric["SubmitDuration"] >= 0
+    assert metric["operation_id"] == "op-create"
+    assert metric["recycled"] is True
+    assert metric["_aws"]["CloudWatchMetrics"][0]["Namespace"] == aws.metrics_namespace
+
+
+def test_completed_operation_is_split_into_execution_and_detection_time(aws):
+    ended_at = datetime.now(timezone.utc) - timedelta(seconds=30)
+    stack_operation = {
+        "Action": "UPDATE",
+        "StackSetId": "quail-1",
+        "OperationId": "op-update",
+        "Status": "SUCCEEDED",
+        "CreationTimestamp": ended_at - timedelta(seconds=90),
+        "EndTimestamp": ended_at,
+    }
+
+    aws.record_stack_operation_timing(stack_operation=stack_operation)
+    # Operations still running have no end yet
+    aws.record_stack_operation_timing(
+        stack_operation={key: value for key, value in stack_operation.items() if key != "EndTimestamp"}
+    )
+
+    [metric] = aws.logger.metrics()
+    assert metric["ExecutionDuration"] == 90
+    assert 30 <= metric["CompletionDetectionDelay"] < 60
+    assert metric["status"] == "SUCCEEDED"
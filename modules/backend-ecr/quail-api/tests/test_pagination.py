@@ -0,0 +1,72 @@
+import pytest
+
+from backend import aws_utils
+from backend.exceptions import InvalidArgumentsError
+from backend.public_api.views import decode_cursor, encode_cursor
+
+
+def state_item(stackset_id, email="user@example.com", expiry="2030-01-01T00:00:00+00:00"):
+    return {
+        "stacksetID": {"S": stackset_id},
+        "expiry": {"S": expiry},
+        "extensionCount": {"N": "0"},
+        "username": {"S": "user"},
+        "email": {"S": email},
+        "group": {"S": "devs"},
+    }
+
+
+class FakeDynamoDBClient:
+    """Serves the items in pages of `Limit` rows, dropping the ones listed in `filtered` like a filter expression."""
+
+    def __init__(self, items, filtered=()):
+        self.items = items
+        self.filtered = set(filtered)
+        self.calls = []
+
+    def scan(self, Limit, ExclusiveStartKey=None, **kwargs):
+        self.calls.append({"ExclusiveStartKey": ExclusiveStartKey, **kwargs})
+        ids = [item["stacksetID"]["S"] for item in self.items]
+        start = ids.index(ExclusiveStartKey["stacksetID"]["S"]) + 1 if ExclusiveStartKey else 0
+        evaluated = self.items[start:][:Limit]
+        response = {"Items": [item for item in evaluated if item["stacksetID"]["S"] not in self.filtered]}
+        if start + Limit < len(self.items):
+            response["LastEvaluatedKey"] = {"stacksetID": evaluated[-1]["stacksetID"]}
+        return response
+
+    query = scan
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeDynamoDBClient(
+        items=[state_item(f"quail-{i}") for i in range(7)],
+        filtered=["quail-1", "quail-2"],
+    )
+    monkeypatch.setattr(aws_utils.boto3, "client", lambda service: client)
+    yield client
+
+
+def test_pages_are_filled_across_filtered_reads(public_app, fake_client):
+    first, next_key = public_app.aws.get_stacksets_page(owner=None, filters={"region": "eu-west-1"}, limit=3)
+    second, last_key = public_app.aws.get_stacksets_page(
+        owner=None, filters={}, limit=3, exclusive_start_key=decode_cursor(encode_cursor(next_key))
+    )
+
+    assert [stackset["stackset_id"] for stackset in first] == ["quail-0", "quail-3", "quail-4"]
+    assert [stackset["stackset_id"] for stackset in second] == ["quail-5", "quail-6"]
+    assert last_key is None
+    assert "#region = :region" in fake_client.calls[0]["FilterExpression"]
+
+
+def test_cursor_of_another_listing_is_rejected(public_app, fake_client):
+    with pytest.raises(InvalidArgumentsError):
+        decode_cursor("not a cursor")
+
+    with pytest.raises(InvalidArgumentsError):
+        public_app.aws.get_stacksets_page(
+            owner="user@example.com",
+            filters={},
+            limit=3,
+            exclusive_start_key={"stacksetID": {"S": "quail-0"}},
+        )
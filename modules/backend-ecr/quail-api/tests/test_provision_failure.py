@@ -0,0 +1,38 @@
+def get_payload():
+    # The input of the Provision state, with the error added by its Catch
+    return {
+        "account": "111111111111",
+        "queue_request_id": "2030-01-01T00:00:00+00:00#request",
+        "email": "user@example.com",
+        "instance_names": ["first", "second"],
+        "error": {"Error": "States.TaskFailed", "Cause": "create_stack_sets failed"},
+    }
+
+
+def test_failed_provision_releases_reserved_instances(private_app, monkeypatch):
+    released = []
+    monkeypatch.setattr(private_app.aws, "send_task_success", lambda task_token, output: None)
+    monkeypatch.setattr(private_app.aws, "release_instances", lambda email, count: released.append((email, count)))
+    client = private_app.test_client()
+
+    response = client.post("/provisionFailure", json=get_payload(), headers={"TaskToken": "failed-provision"})
+    replayed = client.post("/provisionFailure", json=get_payload(), headers={"TaskToken": "failed-provision"})
+
+    assert response.status_code == 204
+    assert replayed.status_code == 204
+    assert released == [("user@example.com", 2)]
+
+
+def test_failed_provision_frees_its_queue_slot(private_app, monkeypatch):
+    completed = []
+    monkeypatch.setattr(private_app.aws, "send_task_success", lambda task_token, output: None)
+    monkeypatch.setattr(private_app.aws, "release_instances", lambda email, count: None)
+    monkeypatch.setattr(
+        private_app.provisioning_queue, "complete", lambda account, request_id: completed.append((account, request_id))
+    )
+    client = private_app.test_client()
+
+    response = client.post("/provisionFailure", json=get_payload(), headers={"TaskToken": "failed-queued-provision"})
+
+    assert response.status_code == 204
+    assert completed == [("111111111111", "2030-01-01T00:00:00+00:00#request")]
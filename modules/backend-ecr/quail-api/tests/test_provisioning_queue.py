@@ -0,0 +1,111 @@
+from datetime import timedelta
+
+import pytest
+
+from backend.provisioning_queue import InMemoryProvisioningQueue, QUEUED_STATUS, IN_FLIGHT_STATUS
+
+
+def enqueue(queue, account, group, size=1):
+    return queue.enqueue(account=account, group=group, size=size, payload={"group": group})
+
+
+def test_schedule_bounds_instances_in_flight_per_account():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=2)
+    for _ in range(3):
+        enqueue(queue, account="111", group="devs")
+    enqueue(queue, account="222", group="devs")
+
+    started = queue.schedule(start=lambda request: None)
+
+    assert sorted(request["account"] for request in started) == ["111", "111", "222"]
+    assert queue.get_stats()["accounts"]["111"]["queued"] == 1
+
+
+def test_schedule_shares_capacity_across_groups():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=2)
+    for _ in range(3):
+        enqueue(queue, account="111", group="devs")
+    enqueue(queue, account="111", group="analysts")
+
+    started = queue.schedule(start=lambda request: None)
+
+    assert sorted(request["group"] for request in started) == ["analysts", "devs"]
+
+
+def test_schedule_keeps_capacity_for_large_requests():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=3)
+    enqueue(queue, account="111", group="devs", size=2)
+    enqueue(queue, account="111", group="devs", size=2)
+    enqueue(queue, account="111", group="devs", size=1)
+
+    started = queue.schedule(start=lambda request: None)
+
+    # The second request doesn't fit, the smaller one queued after it waits its turn
+    assert [request["size"] for request in started] == [2]
+
+
+def test_complete_releases_capacity():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=1)
+    first = enqueue(queue, account="111", group="devs")
+    enqueue(queue, account="111", group="devs")
+
+    assert len(queue.schedule(start=lambda request: None)) == 1
+    assert queue.schedule(start=lambda request: None) == []
+
+    queue.complete(account="111", request_id=first["request_id"])
+
+    assert len(queue.schedule(start=lambda request: None)) == 1
+    assert queue.get_stats()["queued"] == 0
+
+
+def test_failed_start_requeues_request():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=1)
+    enqueue(queue, account="111", group="devs")
+
+    def start(request):
+        raise RuntimeError("StackSet limit exceeded")
+
+    with pytest.raises(RuntimeError):
+        queue.schedule(start=start)
+
+    assert [request["status"] for request in queue.list_requests()] == [QUEUED_STATUS]
+
+
+def test_expire_releases_stale_requests():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=1)
+    enqueue(queue, account="111", group="devs")
+    queue.schedule(start=lambda request: None)
+    assert [request["status"] for request in queue.list_requests()] == [IN_FLIGHT_STATUS]
+
+    assert queue.expire(max_in_flight_age=timedelta(hours=1)) == []
+    assert len(queue.expire(max_in_flight_age=timedelta(seconds=-1))) == 1
+    assert queue.list_requests() == []
+
+
+def test_run_lists_the_queue_once(monkeypatch):
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=1)
+    enqueue(queue, account="111", group="devs")
+    enqueue(queue, account="111", group="devs")
+    list_requests = queue.list_requests
+    listings = []
+    monkeypatch.setattr(queue, "list_requests", lambda: listings.append(1) or list_requests())
+
+    expired, started, stats = queue.run(start=lambda request: None, max_in_flight_age=timedelta(hours=1))
+
+    assert listings == [1]
+    assert (len(expired), len(started)) == (0, 1)
+    assert (stats["queued"], stats["in_flight"]) == (1, 1)
+
+
+def test_concurrent_schedulers_do_not_exceed_account_capacity():
+    queue = InMemoryProvisioningQueue(max_in_flight_per_account=1)
+    enqueue(queue, account="111", group="devs")
+    enqueue(queue, account="111", group="analysts")
+    # Both runs listed the queue before either started a request
+    first_listing, second_listing = queue.list_requests(), queue.list_requests()
+
+    started = queue.schedule(start=lambda request: None, requests=first_listing)
+    started += queue.schedule(start=lambda request: None, requests=second_listing)
+
+    assert len(started) == 1
+    assert queue.get_stats()["in_flight"] == 1
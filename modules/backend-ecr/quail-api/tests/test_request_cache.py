@@ -0,0 +1,38 @@
+from backend import aws_utils
+
+ITEM = {
+    "stacksetID": {"S": "quail-1"},
+    "expiry": {"S": "2030-01-01T00:00:00+00:00"},
+    "email": {"S": "user@example.com"},
+    "group": {"S": "devs"},
+}
+
+
+class FakeDynamoDBClient:
+    def __init__(self):
+        self.reads = []
+
+    def get_item(self, ProjectionExpression=None, **kwargs):
+        self.reads.append(ProjectionExpression)
+        return {"Item": ITEM}
+
+    def update_item(self, **kwargs):
+        return {"Attributes": ITEM}
+
+
+def test_state_entries_are_read_once_per_request_until_written(public_app, monkeypatch):
+    client = FakeDynamoDBClient()
+    monkeypatch.setattr(aws_utils.boto3, "client", lambda service: client)
+
+    public_app.aws.get_stackset_state_data(stackset_id="quail-1", fields=["email", "group"])
+    assert public_app.aws.get_stackset_state_data(stackset_id="quail-1", fields=["email"])["group"] == "devs"
+    # More fields than were read, and consistent reads, go to the table
+    public_app.aws.get_stackset_state_data(stackset_id="quail-1", fields=["expiry"])
+    public_app.aws.get_stackset_state_data(stackset_id="quail-1", fields=["expiry"], consistent_read=True)
+    assert len(client.reads) == 3
+
+    public_app.aws.update_stackset_state_entry(
+        stackset_id="quail-1", data=[{"field_name": "instanceStatus", "value": "stopped"}]
+    )
+    public_app.aws.get_stackset_state_data(stackset_id="quail-1", fields=["expiry"])
+    assert len(client.reads) == 4
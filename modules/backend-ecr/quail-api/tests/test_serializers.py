@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from marshmallow import ValidationError
+
+from backend.serializers import instance_post_serializer, validate_instance_owner
+
+PERMISSIONS = {
+    "accounts": ["111111111111"],
+    "region_map": {"111111111111": {"eu-west-1": {"os_types": ["AWS Linux 2"]}}},
+    "instance_types": ["t3.micro", "t3.small"],
+    "max_days_to_expiry": 5,
+}
+
+
+def get_payload(expiry):
+    return {
+        "account": "111111111111",
+        "region": "eu-west-1",
+        "instanceType": "t3.micro",
+        "operatingSystem": "AWS Linux 2",
+        "instanceName": "test",
+        "expiry": expiry.isoformat(),
+        "email": "user@example.com",
+        "username": "user",
+    }
+
+
+def test_post_serializers_are_shared_by_equal_permissions():
+    serializer = instance_post_serializer(**PERMISSIONS)
+    now = datetime.now(timezone.utc)
+
+    assert serializer is instance_post_serializer(**{**PERMISSIONS, "instance_types": ["t3.small", "t3.micro"]})
+    assert serializer.load(get_payload(expiry=now + timedelta(days=1)))["instance_type"] == "t3.micro"
+    # The expiry bounds follow the time of each load
+    with pytest.raises(ValidationError, match="Must be between"):
+        serializer.load(get_payload(expiry=now + timedelta(minutes=30)))
+
+    with pytest.raises(ValidationError) as e:
+        validate_instance_owner(
+            data=serializer.load(get_payload(expiry=now + timedelta(days=1))),
+            initiator_email="other@example.com",
+            initiator_username="user",
+        )
+    assert list(e.value.messages) == ["email"]
@@ -0,0 +1,82 @@
+from botocore.exceptions import ClientError
+
+STACKSET = {"stackset_id": "quail-1", "email": "user@example.com", "pool_key": None, "template_file": "aws_linux.yaml"}
+
+
+class FakeClient:
+    """Answers the DynamoDB and CloudFormation calls of the recycling pool, and records them."""
+
+    def __init__(self, pooled=(), pool_size=0, conflicts=()):
+        self.pooled = pooled
+        self.pool_size = pool_size
+        self.conflicts = set(conflicts)
+        self.calls = []
+
+    def query(self, **kwargs):
+        if kwargs.get("Select") == "COUNT":
+            return {"Count": self.pool_size}
+        return {
+            "Items": [
+                {"templateFile": {"S": "aws_linux.yaml"}, "stacksetId": {"S": stackset_id}}
+                for stackset_id in self.pooled[: kwargs["Limit"]]
+            ]
+        }
+
+    def delete_item(self, **kwargs):
+        if kwargs["Key"]["stacksetId"]["S"] in self.conflicts:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "DeleteItem")
+        self.calls.append(("delete_item", kwargs))
+
+    def transact_write_items(self, **kwargs):
+        self.calls.append(("transact_write_items", kwargs))
+        return {}
+
+    def delete_stack_set(self, **kwargs):
+        self.calls.append(("delete_stack_set", kwargs))
+
+    def called(self, name):
+        return [kwargs for call, kwargs in self.calls if call == name]
+
+
+def use_client(monkeypatch, private_app, client):
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+    monkeypatch.setattr(
+        private_app.aws, "get_stackset_state_data", lambda stackset_id, consistent_read, fields: dict(STACKSET)
+    )
+
+
+def test_claim_skips_stacksets_claimed_concurrently(private_app, monkeypatch):
+    client = FakeClient(pooled=["quail-1", "quail-2", "quail-3"], conflicts=["quail-1"])
+    use_client(monkeypatch, private_app, client)
+
+    claimed = private_app.aws.claim_recycled_stack_sets(template_filename="aws_linux.yaml", count=3)
+
+    assert claimed == ["quail-2", "quail-3"]
+
+
+def test_emptied_stackset_is_moved_to_the_pool_of_its_template(private_app, monkeypatch):
+    client = FakeClient(pool_size=private_app.aws.stackset_pool_max_size - 1)
+    use_client(monkeypatch, private_app, client)
+
+    private_app.aws.recycle_stack_set(stackset_id="quail-1")
+
+    assert client.called("delete_stack_set") == []
+    [transaction] = client.called("transact_write_items")
+    put, delete = transaction["TransactItems"][:2]
+    assert "recycledAt" in put["Put"]["Item"]
+    assert put["Put"]["Item"]["templateFile"] == {"S": "aws_linux.yaml"}
+    assert put["Put"]["Item"]["stacksetId"] == {"S": "quail-1"}
+    assert delete["Delete"]["Key"] == {"stacksetID": {"S": "quail-1"}}
+
+
+def test_emptied_stackset_is_deleted_when_the_pool_is_full(private_app, monkeypatch):
+    client = FakeClient(pool_size=private_app.aws.stackset_pool_max_size)
+    use_client(monkeypatch, private_app, client)
+
+    private_app.aws.recycle_stack_set(stackset_id="quail-1")
+
+    assert client.called("delete_stack_set") == [{"StackSetName": "quail-1"}]
+    [transaction] = client.called("transact_write_items")
+    # The state entry is deleted, nothing is added to the pool
+    assert transaction["TransactItems"][0]["Delete"]["Key"] == {"stacksetID": {"S": "quail-1"}}
+    assert not any("recycledAt" in item.get("Put", {}).get("Item", {}) for item in transaction["TransactItems"])
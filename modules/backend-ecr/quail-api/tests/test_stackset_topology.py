@@ -0,0 +1,134 @@
+import pytest
+
+
+class FakeCloudFormationClient:
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.described = []
+
+    def describe_stacks(self, StackName):
+        self.described.append(StackName)
+        return {"Stacks": [{"Outputs": [{"OutputKey": "InstanceID", "OutputValue": self.instance_id}]}]}
+
+
+class FakeDynamoDBClient:
+    def __init__(self, stackset_ids):
+        self.stackset_ids = stackset_ids
+
+    def query(self, **kwargs):
+        return {
+            "Items": [
+                {"templateFile": {"S": "aws_linux.yaml"}, "stacksetId": {"S": stackset_id}}
+                for stackset_id in self.stackset_ids
+            ]
+        }
+
+    def delete_item(self, **kwargs):
+        pass
+
+
+OLD_TOPOLOGY = {"account_id": "111111111111", "region": "eu-west-1", "stack_id": "old-stack", "instance_id": "i-old"}
+
+
+@pytest.fixture(autouse=True)
+def empty_topology_cache(private_app):
+    yield
+    private_app.aws.topology_cache.clear()
+
+
+@pytest.fixture
+def stack_client(private_app, monkeypatch):
+    client = FakeCloudFormationClient(instance_id="i-new")
+    monkeypatch.setattr(private_app.aws, "get_remote_client", lambda account_id, region, service: client)
+    yield client
+
+
+def test_cached_topology_is_reused(private_app, stack_client):
+    private_app.aws.topology_cache["quail-1"] = dict(OLD_TOPOLOGY)
+
+    assert private_app.aws.get_stackset_topology(stackset_id="quail-1", stack_id="old-stack") == OLD_TOPOLOGY
+    assert stack_client.described == []
+
+
+def test_topology_of_a_stackset_recycled_elsewhere_is_looked_up_again(private_app, stack_client):
+    private_app.aws.topology_cache["quail-1"] = dict(OLD_TOPOLOGY)
+
+    topology = private_app.aws.get_stackset_topology(
+        stackset_id="quail-1", account_id="111111111111", region="eu-west-1", stack_id="new-stack"
+    )
+
+    assert topology["instance_id"] == "i-new"
+    assert stack_client.described == ["new-stack"]
+
+
+def test_claimed_recycled_stacksets_are_dropped_from_the_topology_cache(private_app, stack_client, monkeypatch):
+    private_app.aws.topology_cache["quail-1"] = dict(OLD_TOPOLOGY)
+    private_app.aws.topology_cache["quail-2"] = dict(OLD_TOPOLOGY)
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: FakeDynamoDBClient(["quail-1"]))
+
+    claimed = private_app.aws.claim_recycled_stack_sets(template_filename="aws_linux.yaml", count=1)
+
+    assert claimed == ["quail-1"]
+    assert "quail-1" not in private_app.aws.topology_cache
+    assert "quail-2" in private_app.aws.topology_cache
+
+
+class FakeEC2Client:
+    def __init__(self, states):
+        self.states = states
+        self.described = []
+
+    def describe_instances(self, InstanceIds):
+        self.described.append(InstanceIds)
+        return {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": instance_id,
+                            "State": {"Name": self.states[instance_id]},
+                            "InstanceType": "t3.micro",
+                        }
+                    ]
+                }
+                for instance_id in InstanceIds
+            ]
+        }
+
+
+class RunningOperationClient:
+    def describe_stack_set_operation(self, StackSetName, OperationId):
+        return {"StackSetOperation": {"Status": "RUNNING"}}
+
+
+def test_update_check_of_a_running_operation_skips_the_topology_lookups(private_app, monkeypatch):
+    # The fake has neither list_stack_instances nor describe_stacks, any topology lookup fails the test
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: RunningOperationClient())
+    stackset = {"stackset_id": "quail-1", "operation_id": "op-1"}
+
+    finished, pending = private_app.aws.check_stacksets_update_complete(stacksets=[stackset], update_level="instance")
+
+    assert finished == []
+    assert pending == [stackset]
+
+
+def test_instances_still_changing_state_carry_their_topology_to_the_next_check(private_app, monkeypatch):
+    ec2_client = FakeEC2Client(states={"i-old": "stopping"})
+    monkeypatch.setattr(private_app.aws, "get_remote_client", lambda account_id, region, service: ec2_client)
+
+    stackset = {"stackset_id": "quail-1", **OLD_TOPOLOGY}
+
+    finished, pending = private_app.aws.check_stacksets_update_complete(stacksets=[stackset], update_level="instance")
+
+    assert finished == []
+    assert pending == [stackset]
+    assert ec2_client.described == [["i-old"]]
+
+    # The next check gets the topology back from the monitor input, without any CloudFormation call
+    private_app.aws.topology_cache.clear()
+    ec2_client.states["i-old"] = "stopped"
+
+    finished, pending = private_app.aws.check_stacksets_update_complete(stacksets=pending, update_level="instance")
+
+    assert finished == [{"stackset_id": "quail-1", "state": "stopped", "instance_type": "t3.micro"}]
+    assert pending == []
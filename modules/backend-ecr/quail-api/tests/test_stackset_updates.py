@@ -0,0 +1,185 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from backend.aws_utils import format_event_time
+from backend.serializers import InstanceStateChangeEventValidator
+
+
+def test_failed_submit_releases_the_stackset(private_app, monkeypatch):
+    abandoned = []
+    stackset = {
+        "stackset_id": "quail-1",
+        "email": "user@example.com",
+        "account": "111111111111",
+        "region": "eu-west-1",
+        "instance_id": "i-1",
+    }
+
+    def submit_stackset_update(cf_client, stackset_id, **kwargs):
+        raise RuntimeError("Throttling")
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setattr(private_app.aws, "acquire_stackset_operation", lambda stackset_id, queued_fields: stackset)
+    monkeypatch.setattr(private_app.aws, "submit_stackset_update", submit_stackset_update)
+    monkeypatch.setattr(
+        private_app.aws,
+        "abandon_stackset_operations",
+        lambda stackset_id, email: abandoned.append((stackset_id, email)),
+    )
+
+    with pytest.raises(RuntimeError):
+        private_app.aws.update_stackset(stackset_id="quail-1", instance_type="t3.large")
+
+    assert abandoned == [("quail-1", "user@example.com")]
+
+
+def test_drained_state_changes_are_awaited_by_their_own_update_level(private_app, monkeypatch):
+    parked = []
+    pending = [{"stackset_id": "quail-1", "update_level": "instance", "operation_id": ""}]
+    monkeypatch.setattr(
+        private_app.aws, "check_stacksets_update_complete", lambda stacksets, update_level: ([], pending)
+    )
+    monkeypatch.setattr(
+        private_app.aws, "store_update_task_token", lambda stackset_ids, task_token: parked.append(stackset_ids)
+    )
+    monkeypatch.setattr(
+        private_app.aws,
+        "get_stacksets_state_data",
+        lambda stackset_ids, fields, consistent: {"quail-1": {"stackset_id": "quail-1", "instance_status": "pending"}},
+    )
+
+    # Queued behind a stackset update, the state change is monitored by a stackset level execution
+    response = private_app.test_client().post(
+        "/waitForUpdateCompletion",
+        json={"update_level": "stack_set", "stacksets": pending},
+        headers={"TaskToken": "drained-state-change"},
+    )
+
+    assert response.status_code == 202
+    assert parked == [["quail-1"]]
+
+
+def test_parked_token_is_resolved_if_the_instance_settled_in_the_meantime(private_app, monkeypatch):
+    resolved = []
+    pending = [{"stackset_id": "quail-1", "operation_id": ""}, {"stackset_id": "quail-2", "operation_id": ""}]
+    monkeypatch.setattr(
+        private_app.aws, "check_stacksets_update_complete", lambda stacksets, update_level: ([], pending)
+    )
+    monkeypatch.setattr(private_app.aws, "store_update_task_token", lambda stackset_ids, task_token: None)
+    # The state-change event of quail-2 was recorded before the token was parked
+    monkeypatch.setattr(
+        private_app.aws,
+        "get_stacksets_state_data",
+        lambda stackset_ids, fields, consistent: {
+            "quail-1": {"stackset_id": "quail-1", "instance_status": "pending"},
+            "quail-2": {"stackset_id": "quail-2", "instance_status": "stopped"},
+        },
+    )
+    monkeypatch.setattr(
+        private_app.aws,
+        "resolve_update_task_token",
+        lambda stackset_id, task_token: resolved.append((stackset_id, task_token)) or True,
+    )
+
+    response = private_app.test_client().post(
+        "/waitForUpdateCompletion",
+        json={"update_level": "instance", "stacksets": pending},
+        headers={"TaskToken": "racing-token"},
+    )
+
+    assert response.status_code == 202
+    assert resolved == [("quail-2", "racing-token")]
+
+
+def test_events_of_the_second_of_a_request_sort_before_it():
+    requested_at = datetime(2030, 1, 1, 12, 0, 0, 700000, tzinfo=timezone.utc)
+    # EventBridge times are truncated to the second
+    stale_event = InstanceStateChangeEventValidator().load(
+        {
+            "time": "2030-01-01T12:00:00Z",
+            "account": "1",
+            "region": "eu-west-1",
+            "detail": {"instance-id": "i-1", "state": "stopped"},
+        }
+    )
+    next_event = InstanceStateChangeEventValidator().load(
+        {
+            "time": "2030-01-01T12:00:01Z",
+            "account": "1",
+            "region": "eu-west-1",
+            "detail": {"instance-id": "i-1", "state": "running"},
+        }
+    )
+
+    assert format_event_time(stale_event["time"]) < format_event_time(requested_at)
+    assert format_event_time(next_event["time"]) > format_event_time(requested_at)
+
+
+def test_failed_single_instance_start_releases_the_stackset(private_app, monkeypatch):
+    abandoned = []
+
+    def set_instances_state(account_id, region, instance_ids, action):
+        raise RuntimeError("IncorrectInstanceState")
+
+    monkeypatch.setattr(
+        private_app.aws,
+        "acquire_stackset_operation",
+        lambda stackset_id, queued_fields: {"stackset_id": stackset_id, "email": "user@example.com"},
+    )
+    monkeypatch.setattr(private_app.aws, "set_instances_state", set_instances_state)
+    monkeypatch.setattr(
+        private_app.aws,
+        "abandon_stackset_operations",
+        lambda stackset_id, email: abandoned.append((stackset_id, email)),
+    )
+
+    # The original error reaches the caller, the owner is read from the acquired entry
+    with pytest.raises(RuntimeError, match="IncorrectInstanceState"):
+        private_app.aws.start_instance(
+            stackset_id="quail-1", account_id="111111111111", region_name="eu-west-1", instance_id="i-1"
+        )
+
+    assert abandoned == [("quail-1", "user@example.com")]
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeDynamoDBClient:
+    """Answers the update_item calls of the tests with the given results, an exception class is raised instead."""
+
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def update_item(self, **kwargs):
+        self.calls.append(kwargs)
+        result = self.results.pop(0)
+        if isinstance(result, type) and issubclass(result, Exception):
+            raise result()
+        return result
+
+
+def test_drained_entry_without_queued_action_does_not_change_the_instance_state(private_app, monkeypatch):
+    state_changes = []
+    item = {
+        "stacksetID": {"S": "quail-1"},
+        "email": {"S": "user@example.com"},
+        "account": {"S": "111111111111"},
+        "region": {"S": "eu-west-1"},
+        "instanceId": {"S": "i-1"},
+    }
+    client = FakeDynamoDBClient(ConditionalCheckFailedException, {"Attributes": item})
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+    monkeypatch.setattr(private_app.aws, "set_instances_state", lambda **kwargs: state_changes.append(kwargs["action"]))
+
+    drained = private_app.aws.drain_stackset_operation(stackset_id="quail-1")
+
+    assert state_changes == []
+    assert drained["update_level"] == "instance"
+    assert drained["instance_id"] == "i-1"
@@ -0,0 +1,57 @@
+from backend import aws_utils
+from backend.state_records import STATE_TABLE_CODEC, StackSetRecord
+
+ITEM = {
+    "stacksetID": {"S": "quail-1"},
+    "expiry": {"S": "2030-01-01T00:00:00+00:00"},
+    "extensionCount": {"N": "2"},
+    "username": {"S": "user"},
+    "email": {"S": "user@example.com"},
+    "group": {"S": "devs"},
+    "region": {"S": "eu-west-1"},
+}
+
+
+def test_items_round_trip_through_records():
+    record = STATE_TABLE_CODEC.decode(ITEM)
+
+    assert record.extension_count == 2
+    assert record.instance_id is None
+    assert STATE_TABLE_CODEC.encode(record) == ITEM
+    assert STATE_TABLE_CODEC.decode_dict(ITEM) == record.to_dict()
+    assert record == StackSetRecord(**record.to_dict())
+
+
+def test_projected_codec_only_reads_its_fields():
+    codec = STATE_TABLE_CODEC.project(["stackset_id", "group"])
+
+    assert codec.get_projection() == {
+        "ProjectionExpression": "#stacksetID, #group",
+        "ExpressionAttributeNames": {"#stacksetID": "stacksetID", "#group": "group"},
+    }
+    assert codec.decode_dict(ITEM) == {"stackset_id": "quail-1", "group": "devs"}
+    assert codec.decode(ITEM).email is None
+
+
+def test_partial_updates_set_and_remove_fields():
+    assert STATE_TABLE_CODEC.encode_update({"instance_status": "running", "update_task_token": None}) == {
+        "UpdateExpression": "SET #instanceStatus = :instanceStatus REMOVE #updateTaskToken",
+        "ExpressionAttributeNames": {"#instanceStatus": "instanceStatus", "#updateTaskToken": "updateTaskToken"},
+        "ExpressionAttributeValues": {":instanceStatus": {"S": "running"}},
+    }
+
+
+def test_batch_reads_only_fetch_the_requested_fields(public_app, monkeypatch):
+    requests = []
+
+    class FakeDynamoDBClient:
+        def batch_get_item(self, RequestItems):
+            requests.append(RequestItems)
+            return {"Responses": {table: [ITEM] for table in RequestItems}}
+
+    monkeypatch.setattr(aws_utils.boto3, "client", lambda service: FakeDynamoDBClient())
+    stacksets = public_app.aws.get_stacksets_state_data(stackset_ids=["quail-1"], fields=["email"])
+
+    assert stacksets == {"quail-1": {"stackset_id": "quail-1", "email": "user@example.com"}}
+    (request,) = requests[0].values()
+    assert request["ProjectionExpression"] == "#stacksetID, #email"
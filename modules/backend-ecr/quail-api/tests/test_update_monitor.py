@@ -0,0 +1,127 @@
+from collections import defaultdict
+
+import pytest
+
+ACCOUNT = "111111111111"
+
+
+class FakeEC2Client:
+    def __init__(self, states):
+        self.states = states
+        self.described = []
+
+    def describe_instances(self, InstanceIds):
+        self.described.append(InstanceIds)
+        return {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": instance_id,
+                            "State": {"Name": self.states[instance_id]},
+                            "InstanceType": "t3.micro",
+                        }
+                    ]
+                }
+                for instance_id in InstanceIds
+            ]
+        }
+
+
+class FakeCloudFormationClient:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def describe_stack_set_operation(self, StackSetName, OperationId):
+        return {"StackSetOperation": {"Status": self.statuses[StackSetName]}}
+
+
+def monitored(stackset_id, region="eu-west-1", **fields):
+    return {
+        "stackset_id": stackset_id,
+        "account_id": ACCOUNT,
+        "region": region,
+        "stack_id": f"stack-{stackset_id}",
+        "instance_id": f"i-{stackset_id}",
+        **fields,
+    }
+
+
+@pytest.fixture(autouse=True)
+def empty_topology_cache(private_app):
+    yield
+    private_app.aws.topology_cache.clear()
+
+
+def test_stacksets_are_checked_with_one_call_per_account_and_region(private_app, monkeypatch):
+    states = {"i-quail-1": "stopped", "i-quail-2": "stopping", "i-quail-3": "running"}
+    ec2_clients = defaultdict(lambda: FakeEC2Client(states))
+    monkeypatch.setattr(private_app.aws, "get_remote_client", lambda account_id, region, service: ec2_clients[region])
+    monkeypatch.setattr(
+        "backend.aws_utils.boto3.client", lambda service, **kwargs: FakeCloudFormationClient({"quail-4": "RUNNING"})
+    )
+    stacksets = [
+        monitored("quail-1"),
+        monitored("quail-2"),
+        monitored("quail-3", region="us-east-1"),
+        {"stackset_id": "quail-4", "operation_id": "op-4"},
+    ]
+
+    finished, pending = private_app.aws.check_stacksets_update_complete(stacksets=stacksets, update_level="instance")
+
+    assert ec2_clients["eu-west-1"].described == [["i-quail-1", "i-quail-2"]]
+    assert ec2_clients["us-east-1"].described == [["i-quail-3"]]
+    assert finished == [
+        {"stackset_id": "quail-1", "state": "stopped", "instance_type": "t3.micro"},
+        {"stackset_id": "quail-3", "state": "running", "instance_type": "t3.micro"},
+    ]
+    assert sorted(stackset["stackset_id"] for stackset in pending) == ["quail-2", "quail-4"]
+
+
+@pytest.fixture
+def update_check(private_app, monkeypatch):
+    completed, drained = [], []
+    monkeypatch.setattr(private_app.aws, "complete_stackset_updates", lambda finished: completed.extend(finished))
+
+    def drain_stackset_operations(stackset_ids):
+        # Nothing was queued behind the finished stacksets
+        drained.extend(stackset_ids)
+        return []
+
+    monkeypatch.setattr(private_app.aws, "drain_stackset_operations", drain_stackset_operations)
+
+    def check(finished, pending, stacksets):
+        monkeypatch.setattr(
+            private_app.aws, "check_stacksets_update_complete", lambda stacksets, update_level: (finished, pending)
+        )
+        return private_app.test_client().post(
+            "/waitForUpdateCompletion", json={"update_level": "instance", "stacksets": stacksets}
+        )
+
+    check.completed = completed
+    check.drained = drained
+    yield check
+
+
+def test_finished_stacksets_are_finalized_without_waiting_for_the_rest_of_the_batch(update_check):
+    finished = [{"stackset_id": "quail-1", "state": "stopped", "instance_type": "t3.micro"}]
+    pending = [monitored("quail-2")]
+
+    response = update_check(finished=finished, pending=pending, stacksets=[monitored("quail-1"), *pending])
+
+    assert update_check.completed == finished
+    assert update_check.drained == ["quail-1"]
+    # Only the pending stacksets are checked again
+    assert response.get_json() == {"complete": False, "stacksets": pending}
+
+
+def test_batch_is_complete_once_every_stackset_finished(update_check):
+    finished = [
+        {"stackset_id": stackset_id, "state": "running", "instance_type": "t3.micro"}
+        for stackset_id in ("quail-1", "quail-2")
+    ]
+
+    response = update_check(finished=finished, pending=[], stacksets=[monitored("quail-1"), monitored("quail-2")])
+
+    assert len(update_check.completed) == 2
+    assert response.get_json() == {"complete": True}
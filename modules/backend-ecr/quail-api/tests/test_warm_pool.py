@@ -0,0 +1,236 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.exceptions import ClientError
+
+from backend.aws_utils import EC2_INSTANCE_STOPPED_STATE, WARM_POOL_OWNER, warm_pool_key
+from backend.public_api import views
+
+POOL_TARGET = {
+    "group": "devs",
+    "operating_system": "aws_linux",
+    "account": "111111111111",
+    "region": "eu-west-1",
+    "instance_type": "t3.micro",
+}
+POOL_KEY = warm_pool_key(**POOL_TARGET)
+
+
+def conditional_check_failed():
+    return ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+
+
+def pooled_stackset(stackset_id, **fields):
+    return {
+        "stackset_id": stackset_id,
+        "email": WARM_POOL_OWNER,
+        "pool_key": POOL_KEY,
+        "account": POOL_TARGET["account"],
+        "region": POOL_TARGET["region"],
+        "instance_id": f"i-{stackset_id}",
+        "instance_status": EC2_INSTANCE_STOPPED_STATE,
+        **fields,
+    }
+
+
+class FakeEC2Client:
+    def __init__(self):
+        self.stopped = []
+
+    def stop_instances(self, InstanceIds):
+        self.stopped.extend(InstanceIds)
+
+
+class FakeDynamoDBClient:
+    """Records the update_item calls, the stacksets listed in conflicts fail their conditional write."""
+
+    def __init__(self, conflicts=()):
+        self.conflicts = set(conflicts)
+        self.updated = []
+
+    def update_item(self, **kwargs):
+        stackset_id = kwargs["Key"]["stacksetID"]["S"]
+        if stackset_id in self.conflicts:
+            raise conditional_check_failed()
+        self.updated.append(stackset_id)
+        return {
+            "Attributes": {
+                "stacksetID": {"S": stackset_id},
+                "email": kwargs["ExpressionAttributeValues"].get(":email", {"S": WARM_POOL_OWNER}),
+            }
+        }
+
+
+@pytest.fixture
+def ec2_client(private_app, monkeypatch):
+    client = FakeEC2Client()
+    monkeypatch.setattr(private_app.aws, "get_remote_client", lambda account_id, region, service: client)
+    yield client
+
+
+def test_deleting_an_instance_taken_out_of_the_pool_leaves_no_count_nor_tombstone(private_app):
+    # Surplus and failed pool instances are taken out of the pool before their deprovisioning
+    items = private_app.aws.build_state_entry_deletion(stackset=pooled_stackset("quail-1", pool_key=None))
+
+    assert [list(item) for item in items] == [["Delete"]]
+
+
+def test_deleting_an_owned_instance_releases_it_and_leaves_a_tombstone(private_app):
+    items = private_app.aws.build_state_entry_deletion(
+        stackset=pooled_stackset("quail-1", pool_key=None, email="user@example.com")
+    )
+
+    assert [list(item) for item in items] == [["Delete"], ["Update"], ["Put"]]
+    assert items[1]["Update"]["Key"] == {"email": {"S": "user@example.com"}}
+
+
+def test_claim_skips_instances_not_ready_and_claimed_concurrently(private_app, monkeypatch):
+    pooled = [
+        pooled_stackset("quail-1"),
+        pooled_stackset("quail-2", instance_status="pending"),
+        pooled_stackset("quail-3"),
+    ]
+    client = FakeDynamoDBClient(conflicts=["quail-1"])
+    monkeypatch.setattr(private_app.aws, "get_pooled_stacksets", lambda pool_key: pooled)
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+
+    claimed = private_app.aws.claim_pooled_stacksets(
+        pool_key=POOL_KEY,
+        instance_names=["box-1", "box-2"],
+        email="user@example.com",
+        username="user",
+        expiry=datetime.now(timezone.utc),
+    )
+
+    assert [stackset["stackset_id"] for stackset in claimed] == ["quail-3"]
+    assert sorted(client.updated) == ["quail-3"]
+
+
+def test_returned_stacksets_are_pooled_again_and_stopped(private_app, monkeypatch, ec2_client):
+    client = FakeDynamoDBClient(conflicts=["quail-2"])
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: client)
+    claimed = [pooled_stackset(stackset_id, email="user@example.com") for stackset_id in ("quail-1", "quail-2")]
+
+    private_app.aws.return_to_warm_pool(stacksets=claimed, pool_key=POOL_KEY)
+
+    # The second stackset was changed by its new owner in the meantime
+    assert client.updated == ["quail-1"]
+    assert ec2_client.stopped == ["i-quail-1"]
+
+
+def test_failed_activation_of_claimed_instances_returns_them_and_their_quota(public_app, monkeypatch):
+    released, returned = [], []
+    claimed = [pooled_stackset("quail-1", email="user@example.com")]
+    permissions = {
+        "region_map": {POOL_TARGET["account"]: {POOL_TARGET["region"]: {"os_types": ["aws_linux"]}}},
+        "instance_types": [POOL_TARGET["instance_type"]],
+        "max_days_to_expiry": 7,
+        "max_instance_count": 5,
+    }
+
+    def activate_pooled_stacksets(stacksets, tags):
+        raise RuntimeError("Instance limit exceeded")
+
+    aws = public_app.aws
+    monkeypatch.setitem(public_app.config, "WARM_POOL_TARGETS", [POOL_TARGET])
+    monkeypatch.setitem(public_app.config, "TAG_CONFIG", "[]")
+    monkeypatch.setattr(views, "get_tags", lambda environment, tag_config: [])
+    monkeypatch.setattr(
+        aws,
+        "get_claims",
+        lambda request: {
+            "email": "user@example.com",
+            "groups": ["devs"],
+            "username": "user",
+            "is_superuser": False,
+            "claims": {},
+        },
+    )
+    monkeypatch.setattr(aws, "get_permissions_for_one_group", lambda group_name: permissions)
+    monkeypatch.setattr(aws, "reserve_instances", lambda email, count, max_instance_count: True)
+    monkeypatch.setattr(aws, "claim_pooled_stacksets", lambda **kwargs: claimed)
+    monkeypatch.setattr(aws, "activate_pooled_stacksets", activate_pooled_stacksets)
+    monkeypatch.setattr(aws, "return_to_warm_pool", lambda stacksets, pool_key: returned.append((stacksets, pool_key)))
+    monkeypatch.setattr(aws, "release_instances", lambda email, count: released.append((email, count)))
+
+    body = {
+        "group": "devs",
+        "account": POOL_TARGET["account"],
+        "region": POOL_TARGET["region"],
+        "instanceType": POOL_TARGET["instance_type"],
+        "operatingSystem": POOL_TARGET["operating_system"],
+        "instanceName": "box",
+        "expiry": (datetime.now(timezone.utc) + timedelta(days=1)).isoformat(),
+        "email": "user@example.com",
+        "username": "user",
+    }
+    with public_app.test_request_context("/instance", method="POST", json=body):
+        with pytest.raises(RuntimeError):
+            views.post_instances()
+
+    assert returned == [(claimed, POOL_KEY)]
+    assert released == [("user@example.com", 1)]
+
+
+class FakeCloudFormationClient:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def describe_stack_set_operation(self, StackSetName, OperationId):
+        return {"StackSetOperation": {"Status": self.statuses[StackSetName]}}
+
+
+def test_replenish_stops_created_instances_and_replaces_failed_ones(private_app, monkeypatch, ec2_client):
+    pooled = [
+        pooled_stackset("quail-1", instance_status=None, operation_id="op-1"),
+        pooled_stackset("quail-2", instance_status=None, operation_id="op-2"),
+        pooled_stackset("quail-3", instance_status=None, operation_id="op-3"),
+        pooled_stackset("quail-4"),
+    ]
+    statuses = {"quail-1": "SUCCEEDED", "quail-2": "FAILED", "quail-3": "RUNNING"}
+    deprovisioned, created = [], []
+    aws = private_app.aws
+    monkeypatch.setattr(aws, "get_pooled_stacksets", lambda pool_key: pooled)
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: FakeCloudFormationClient(statuses))
+    monkeypatch.setattr(
+        aws, "iter_stackset_instances", lambda stackset_id: iter([{"instance_id": "i-new", "private_ip": "10.0.0.1"}])
+    )
+    monkeypatch.setattr(aws, "update_stackset_state_entry", lambda stackset_id, data: None)
+    monkeypatch.setattr(aws, "remove_from_warm_pool", lambda stackset_id, pool_key: True)
+    monkeypatch.setattr(
+        aws,
+        "initiate_stackset_deprovisioning",
+        lambda stackset_id, owner_email: deprovisioned.append((stackset_id, owner_email)),
+    )
+    monkeypatch.setattr(aws, "create_stack_sets", lambda **kwargs: created.append(kwargs))
+
+    summary = aws.replenish_warm_pool(project_name="quail", tags=[], expiry="", size=4, **POOL_TARGET)
+
+    assert ec2_client.stopped == ["i-new"]
+    assert deprovisioned == [("quail-2", WARM_POOL_OWNER)]
+    assert [len(kwargs["instance_names"]) for kwargs in created] == [1]
+    assert created[0]["pool_key"] == POOL_KEY
+    assert summary == {"pool_key": POOL_KEY, "size": 4, "ready": 1, "created": 1, "deprovisioned": 1}
+
+
+def test_replenish_deprovisions_ready_instances_over_the_target(private_app, monkeypatch):
+    pooled = [
+        pooled_stackset("quail-1"),
+        pooled_stackset("quail-2"),
+        pooled_stackset("quail-3", instance_status="stopping"),
+    ]
+    deprovisioned = []
+    aws = private_app.aws
+    monkeypatch.setattr(aws, "get_pooled_stacksets", lambda pool_key: pooled)
+    monkeypatch.setattr("backend.aws_utils.boto3.client", lambda service, **kwargs: FakeCloudFormationClient({}))
+    monkeypatch.setattr(aws, "remove_from_warm_pool", lambda stackset_id, pool_key: stackset_id != "quail-2")
+    monkeypatch.setattr(
+        aws, "initiate_stackset_deprovisioning", lambda stackset_id, owner_email: deprovisioned.append(stackset_id)
+    )
+
+    summary = aws.replenish_warm_pool(project_name="quail", tags=[], expiry="", size=1, **POOL_TARGET)
+
+    # quail-2 was claimed before it could be taken out of the pool, the instance still stopping isn't touched
+    assert deprovisioned == ["quail-1"]
+    assert summary["created"] == 0
+    assert summary["ready"] == 0
@@ -8,6 +8,7 @@ locals {
   quail-api-debug     = 1
   quail-api-env       = "development"
   quail-api-log-level = "debug"
+  quail-api-timeout   = 30
 
   cloudwatch_log_retention = 0
   sns_error_topic_arn      = var.external-sns-failure-topic-arn == "" ? aws_sns_topic.error_topic[0].arn : var.external-sns-failure-topic-arn
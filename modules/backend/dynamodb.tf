@@ -44,6 +44,99 @@ resource "aws_dynamodb_table" "dynamodb-state-table" {
     name = "stacksetID"
     type = "S"
   }
+
+  attribute {
+    name = "instanceId"
+    type = "S"
+  }
+
+  attribute {
+    name = "poolKey"
+    type = "S"
+  }
+
+  attribute {
+    name = "email"
+    type = "S"
+  }
+
+  attribute {
+    name = "expiry"
+    type = "S"
+  }
+
+  attribute {
+    name = "updatedAt"
+    type = "S"
+  }
+
+  # Maps EC2 state-change events back to the stacksets owning the instances
+  global_secondary_index {
+    name            = "instanceId-index"
+    hash_key        = "instanceId"
+    projection_type = "ALL"
+  }
+
+  # Sparse index of the unclaimed warm pool stacksets
+  global_secondary_index {
+    name            = "poolKey-index"
+    hash_key        = "poolKey"
+    projection_type = "ALL"
+  }
+
+  # Pages through the stacksets of a user in expiry order
+  global_secondary_index {
+    name            = "email-expiry-index"
+    hash_key        = "email"
+    range_key       = "expiry"
+    projection_type = "ALL"
+  }
+
+  # Changes to the stacksets of a user since a sync token
+  global_secondary_index {
+    name            = "email-updatedAt-index"
+    hash_key        = "email"
+    range_key       = "updatedAt"
+    projection_type = "ALL"
+  }
+}
+
+## Table storing the emptied stacksets kept for reuse, by template file
+resource "aws_dynamodb_table" "dynamodb-stackset-pool-table" {
+  name         = "${var.project-name}-stackset-pool"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "templateFile"
+  range_key    = "stacksetId"
+  tags         = local.resource_tags
+
+  attribute {
+    name = "templateFile"
+    type = "S"
+  }
+
+  attribute {
+    name = "stacksetId"
+    type = "S"
+  }
+}
+
+## Table queueing the provisioning requests, per target account
+resource "aws_dynamodb_table" "dynamodb-provisioning-queue-table" {
+  name         = "${var.project-name}-provisioning-queue"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "account"
+  range_key    = "requestId"
+  tags         = local.resource_tags
+
+  attribute {
+    name = "account"
+    type = "S"
+  }
+
+  attribute {
+    name = "requestId"
+    type = "S"
+  }
 }
 
 ## Table storing group permissions
@@ -76,3 +169,59 @@ resource "aws_dynamodb_table_item" "permissions-table-items" {
     maxDaysToExpiry   = { "N" = tostring(each.value.max-days-to-expiry) },
   })
 }
+
+# Idempotency keys of the public API mutation requests and task tokens of the private API requests,
+# with the response of the first request
+resource "aws_dynamodb_table" "dynamodb-idempotency-table" {
+  name         = "${var.project-name}-idempotency"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "idempotencyKey"
+  tags         = local.resource_tags
+
+  attribute {
+    name = "idempotencyKey"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expiresAt"
+    enabled        = true
+  }
+}
+
+# Number of instances owned by each user, checked and reserved in a single write when provisioning
+# Deleted state entries, reported to the clients syncing the changes to their instances
+resource "aws_dynamodb_table" "dynamodb-state-tombstones-table" {
+  name         = "${var.project-name}-state-tombstones"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "email"
+  range_key    = "tombstoneKey"
+  tags         = local.resource_tags
+
+  attribute {
+    name = "email"
+    type = "S"
+  }
+
+  attribute {
+    name = "tombstoneKey"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expiresAt"
+    enabled        = true
+  }
+}
+
+resource "aws_dynamodb_table" "dynamodb-user-counters-table" {
+  name         = "${var.project-name}-user-counters"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "email"
+  tags         = local.resource_tags
+
+  attribute {
+    name = "email"
+    type = "S"
+  }
+}
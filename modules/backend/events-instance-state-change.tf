@@ -0,0 +1,79 @@
+# EC2 state-change notifications, used to update the instance status without polling.
+# The events of the primary account and region are captured here, the utilities-regional module forwards the
+# events of the other accounts and regions to the primary default event bus.
+resource "aws_cloudwatch_event_rule" "instance_state_change" {
+  name        = "${var.project-name}-instance-state-change"
+  description = "EC2 instance state-change notifications"
+  tags        = local.resource_tags
+
+  event_pattern = jsonencode({
+    "source" : ["aws.ec2"],
+    "detail-type" : ["EC2 Instance State-change Notification"],
+  })
+}
+
+# Let the remote accounts forward their events to the default event bus
+data "aws_iam_policy_document" "instance_state_change_forwarding" {
+  statement {
+    effect    = "Allow"
+    actions   = ["events:PutEvents"]
+    resources = ["arn:aws:events:${var.region-primary}:${var.account-primary}:event-bus/default"]
+
+    principals {
+      type        = "AWS"
+      identifiers = var.remote-accounts
+    }
+  }
+}
+
+resource "aws_cloudwatch_event_bus_policy" "instance_state_change_forwarding" {
+  count = length(var.remote-accounts) > 0 ? 1 : 0
+
+  event_bus_name = "default"
+  policy         = data.aws_iam_policy_document.instance_state_change_forwarding.json
+}
+
+resource "aws_sqs_queue" "instance_state_change" {
+  name                       = "${var.project-name}-instance-state-change"
+  message_retention_seconds  = 3600
+  visibility_timeout_seconds = 60
+  tags                       = local.resource_tags
+}
+
+data "aws_iam_policy_document" "instance_state_change_queue" {
+  statement {
+    effect    = "Allow"
+    actions   = ["sqs:SendMessage"]
+    resources = [aws_sqs_queue.instance_state_change.arn]
+
+    principals {
+      type        = "Service"
+      identifiers = ["events.amazonaws.com"]
+    }
+
+    condition {
+      test     = "ArnEquals"
+      variable = "aws:SourceArn"
+      values   = [aws_cloudwatch_event_rule.instance_state_change.arn]
+    }
+  }
+}
+
+resource "aws_sqs_queue_policy" "instance_state_change" {
+  queue_url = aws_sqs_queue.instance_state_change.id
+  policy    = data.aws_iam_policy_document.instance_state_change_queue.json
+}
+
+resource "aws_cloudwatch_event_target" "instance_state_change" {
+  rule      = aws_cloudwatch_event_rule.instance_state_change.name
+  target_id = "sqs"
+  arn       = aws_sqs_queue.instance_state_change.arn
+}
+
+# Deliver the events to the private api in batches
+resource "aws_lambda_event_source_mapping" "instance_state_change" {
+  event_source_arn                   = aws_sqs_queue.instance_state_change.arn
+  function_name                      = aws_lambda_function.private_api.arn
+  batch_size                         = 100
+  maximum_batching_window_in_seconds = 2
+}
@@ -0,0 +1,28 @@
+# Run the provisioning scheduler every minute, on top of the runs triggered by new requests
+# and finished provisioning jobs, so that capacity released by expired requests gets used
+resource "aws_cloudwatch_event_rule" "schedule_provisioning" {
+  name                = "${var.project-name}-schedule-provisioning"
+  description         = "Fires every minute"
+  schedule_expression = "rate(1 minute)"
+  tags                = local.resource_tags
+}
+
+resource "aws_cloudwatch_event_target" "schedule_provisioning" {
+  rule      = aws_cloudwatch_event_rule.schedule_provisioning.name
+  target_id = "lambda"
+  arn       = aws_lambda_function.private_api.arn
+
+  input = jsonencode({
+    "resourcePath" : "/scheduleProvisioning",
+    "path" : "/scheduleProvisioning",
+    "httpMethod" : "POST",
+  })
+}
+
+resource "aws_lambda_permission" "cloudwatch_invoke_private_api_schedule_provisioning" {
+  statement_id  = "AllowProvisioningScheduleExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.private_api.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.schedule_provisioning.arn
+}
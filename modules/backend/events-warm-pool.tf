@@ -0,0 +1,33 @@
+# Keep the warm pools at their target size, only scheduled if any pool is configured
+resource "aws_cloudwatch_event_rule" "replenish_warm_pool" {
+  count = length(var.warm-pool-targets) > 0 ? 1 : 0
+
+  name                = "${var.project-name}-replenish-warm-pool"
+  description         = "Fires every five minutes"
+  schedule_expression = "rate(5 minutes)"
+  tags                = local.resource_tags
+}
+
+resource "aws_cloudwatch_event_target" "replenish_warm_pool" {
+  count = length(var.warm-pool-targets) > 0 ? 1 : 0
+
+  rule      = aws_cloudwatch_event_rule.replenish_warm_pool[0].name
+  target_id = "lambda"
+  arn       = aws_lambda_function.private_api.arn
+
+  input = jsonencode({
+    "resourcePath" : "/replenishWarmPool",
+    "path" : "/replenishWarmPool",
+    "httpMethod" : "POST",
+  })
+}
+
+resource "aws_lambda_permission" "cloudwatch_invoke_private_api_warm_pool" {
+  count = length(var.warm-pool-targets) > 0 ? 1 : 0
+
+  statement_id  = "AllowWarmPoolExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.private_api.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.replenish_warm_pool[0].arn
+}
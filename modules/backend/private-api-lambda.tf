@@ -91,6 +91,8 @@ data "aws_iam_policy_document" "private_api" {
       "cloudformation:ListStackSetOperations",
       "cloudformation:DescribeStackSetOperation",
       "cloudformation:DeleteStackInstances",
+      "cloudformation:DescribeStackSet",
+      "cloudformation:UpdateStackSet",
     ]
     resources = [
       "arn:aws:cloudformation:*:${var.account-primary}:stackset/${var.project-name}*:*"
@@ -143,6 +145,8 @@ data "aws_iam_policy_document" "private_api" {
     actions = [
       "dynamodb:PutItem",
       "dynamodb:GetItem",
+      "dynamodb:BatchGetItem",
+      "dynamodb:BatchWriteItem",
       "dynamodb:UpdateItem",
       "dynamodb:DeleteItem",
       "dynamodb:Scan"
@@ -150,6 +154,73 @@ data "aws_iam_policy_document" "private_api" {
     resources = [aws_dynamodb_table.dynamodb-state-table.arn]
   }
 
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:Query",
+    ]
+    resources = ["${aws_dynamodb_table.dynamodb-state-table.arn}/index/*"]
+  }
+
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:Query",
+      "dynamodb:PutItem",
+      "dynamodb:DeleteItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-stackset-pool-table.arn]
+  }
+
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:Scan",
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-provisioning-queue-table.arn]
+  }
+
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-idempotency-table.arn]
+  }
+
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:UpdateItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-user-counters-table.arn]
+  }
+
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:PutItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-state-tombstones-table.arn]
+  }
+
+  # Instance state-change events queue
+  statement {
+    effect = "Allow"
+    actions = [
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+    ]
+    resources = [aws_sqs_queue.instance_state_change.arn]
+  }
+
 
   # Allow publishing to the error SNS topic
   statement {
@@ -181,6 +252,7 @@ data "aws_iam_policy_document" "private_api" {
     content {
       effect = "Allow"
       actions = [
+        "states:StartExecution",
         "states:SendTaskSuccess",
         "states:SendTaskFailure",
       ]
@@ -234,7 +306,7 @@ resource "random_password" "private_api_secret_key" {
 resource "aws_lambda_function" "private_api" {
   function_name = local.ecr_private_api_name
   role          = aws_iam_role.private_api.arn
-  timeout       = 30
+  timeout       = local.quail-api-timeout
   memory_size   = 512
   tags          = local.resource_tags
 
@@ -246,9 +318,34 @@ resource "aws_lambda_function" "private_api" {
       "PROJECT_NAME" = var.project-name
       "TAG_CONFIG"   = jsonencode(var.instance-tags)
 
+      "WARM_POOL_TARGETS" = jsonencode([
+        for target in var.warm-pool-targets : {
+          group            = target.group
+          operating_system = target.operating-system
+          account          = target.account
+          region           = target.region
+          instance_type    = target.instance-type
+          size             = target.size
+        }
+      ])
+
       "DYNAMODB_PERMISSIONS_TABLE_NAME"       = aws_dynamodb_table.permissions-table.name
       "DYNAMODB_STATE_TABLE_NAME"             = aws_dynamodb_table.dynamodb-state-table.name
+      "DYNAMODB_STACKSET_POOL_TABLE_NAME"     = aws_dynamodb_table.dynamodb-stackset-pool-table.name
+      "DYNAMODB_USER_COUNTERS_TABLE_NAME"     = aws_dynamodb_table.dynamodb-user-counters-table.name
+      "DYNAMODB_STATE_TOMBSTONES_TABLE_NAME"  = aws_dynamodb_table.dynamodb-state-tombstones-table.name
       "DYNAMODB_REGIONAL_METADATA_TABLE_NAME" = aws_dynamodb_table.dynamodb-regional-metadata-table.name
+      "STATE_TOMBSTONE_TTL"                   = var.state-tombstone-ttl
+
+      # Task token ledger, deduplicating the requests replayed by Step Functions retries
+      "IDEMPOTENCY_TABLE_NAME"        = aws_dynamodb_table.dynamodb-idempotency-table.name
+      "IDEMPOTENCY_KEY_TTL"           = var.idempotency-key-ttl
+      "IDEMPOTENCY_IN_PROGRESS_LEASE" = local.quail-api-timeout + 30
+
+      "PROVISIONING_QUEUE_TABLE_NAME"          = aws_dynamodb_table.dynamodb-provisioning-queue-table.name
+      "PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT" = var.provisioning-max-in-flight-per-account
+      "PROVISIONING_IN_FLIGHT_TIMEOUT"         = var.provision-timeout + 900
+      "STACKSET_OPERATION_TIMEOUT"             = var.update-timeout + 300
 
       # Fetching the SFNs ARN indirectly to avoid dependency cycles
       "PROVISION_SFN_ARN" = (var.skip-resources-first-deployment ?
@@ -274,12 +371,18 @@ resource "aws_lambda_function" "private_api" {
       "STACK_SET_EXECUTION_ROLE_NAME"     = var.stack-set-execution-role-name
       "STACK_SET_ADMIN_ROLE_ARN"          = aws_iam_role.stackset_admin_role.arn
 
+      "STACKSET_CREATE_OPERATION_PREFERENCES" = jsonencode(var.stackset-operation-preferences.create)
+      "STACKSET_UPDATE_OPERATION_PREFERENCES" = jsonencode(var.stackset-operation-preferences.update)
+      "STACKSET_DELETE_OPERATION_PREFERENCES" = jsonencode(var.stackset-operation-preferences.delete)
+
       "FLASK_DEBUG"                  = local.quail-api-debug
       "FLASK_ENV"                    = local.quail-api-env
       "GUNICORN_WORKERS"             = 1
       "LOG_LEVEL"                    = local.quail-api-log-level
       "SECRET_KEY"                   = random_password.private_api_secret_key.result
       "AWS_LWA_READINESS_CHECK_PATH" = "/healthcheck"
+      # Non-HTTP events (the SQS instance state-change batches) are posted to this path
+      "AWS_LWA_PASS_THROUGH_PATH" = "/instanceStateChange"
     }
   }
 }
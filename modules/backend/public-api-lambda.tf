@@ -54,10 +54,63 @@ data "aws_iam_policy_document" "public_api" {
     actions = [
       "dynamodb:Scan",
       "dynamodb:GetItem",
+      "dynamodb:BatchGetItem",
       "dynamodb:UpdateItem"
     ]
     resources = [aws_dynamodb_table.dynamodb-state-table.arn]
   }
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:Query",
+    ]
+    resources = ["${aws_dynamodb_table.dynamodb-state-table.arn}/index/*"]
+  }
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:PutItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-provisioning-queue-table.arn]
+  }
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-idempotency-table.arn]
+  }
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-user-counters-table.arn]
+  }
+  statement {
+    effect = "Allow"
+    actions = [
+      "dynamodb:Query",
+      "dynamodb:Scan",
+    ]
+    resources = [aws_dynamodb_table.dynamodb-state-tombstones-table.arn]
+  }
+
+  # Kick off the provisioning scheduler of the private API
+  statement {
+    effect = "Allow"
+    actions = [
+      "lambda:InvokeFunction",
+    ]
+    resources = [
+      aws_lambda_function.private_api.arn,
+      "${aws_lambda_function.private_api.arn}:*",
+    ]
+  }
   statement {
     effect = "Allow"
     actions = [
@@ -116,6 +169,7 @@ data "aws_iam_policy_document" "public_api" {
     actions = [
       "ec2:StartInstances",
       "ec2:StopInstances",
+      "ec2:CreateTags",
     ]
     resources = ["*"]
     condition {
@@ -153,7 +207,7 @@ resource "random_password" "public_api_secret_key" {
 resource "aws_lambda_function" "public_api" {
   function_name = local.ecr_public_api_name
   role          = aws_iam_role.public_api.arn
-  timeout       = 30
+  timeout       = local.quail-api-timeout
   memory_size   = 512
   tags          = local.resource_tags
 
@@ -165,9 +219,34 @@ resource "aws_lambda_function" "public_api" {
       "PROJECT_NAME" = var.project-name
       "TAG_CONFIG"   = jsonencode(var.instance-tags)
 
+      "WARM_POOL_TARGETS" = jsonencode([
+        for target in var.warm-pool-targets : {
+          group            = target.group
+          operating_system = target.operating-system
+          account          = target.account
+          region           = target.region
+          instance_type    = target.instance-type
+          size             = target.size
+        }
+      ])
+
       "DYNAMODB_PERMISSIONS_TABLE_NAME"       = aws_dynamodb_table.permissions-table.name
       "DYNAMODB_STATE_TABLE_NAME"             = aws_dynamodb_table.dynamodb-state-table.name
+      "DYNAMODB_STACKSET_POOL_TABLE_NAME"     = aws_dynamodb_table.dynamodb-stackset-pool-table.name
+      "DYNAMODB_USER_COUNTERS_TABLE_NAME"     = aws_dynamodb_table.dynamodb-user-counters-table.name
+      "DYNAMODB_STATE_TOMBSTONES_TABLE_NAME"  = aws_dynamodb_table.dynamodb-state-tombstones-table.name
       "DYNAMODB_REGIONAL_METADATA_TABLE_NAME" = aws_dynamodb_table.dynamodb-regional-metadata-table.name
+      "STATE_TOMBSTONE_TTL"                   = var.state-tombstone-ttl
+
+      "IDEMPOTENCY_TABLE_NAME"        = aws_dynamodb_table.dynamodb-idempotency-table.name
+      "IDEMPOTENCY_KEY_TTL"           = var.idempotency-key-ttl
+      "IDEMPOTENCY_IN_PROGRESS_LEASE" = local.quail-api-timeout + 30
+
+      "PROVISIONING_QUEUE_TABLE_NAME"          = aws_dynamodb_table.dynamodb-provisioning-queue-table.name
+      "PROVISIONING_MAX_IN_FLIGHT_PER_ACCOUNT" = var.provisioning-max-in-flight-per-account
+      "PROVISIONING_IN_FLIGHT_TIMEOUT"         = var.provision-timeout + 900
+      "STACKSET_OPERATION_TIMEOUT"             = var.update-timeout + 300
+      "PRIVATE_API_FUNCTION_NAME"              = aws_lambda_function.private_api.function_name
 
       "PROVISION_SFN_ARN"       = aws_sfn_state_machine.provision_state_machine.arn
       "CLEANUP_SFN_ARN"         = aws_sfn_state_machine.cleanup_state_machine.arn
@@ -183,6 +262,10 @@ resource "aws_lambda_function" "public_api" {
       "STACK_SET_EXECUTION_ROLE_NAME"     = var.stack-set-execution-role-name
       "STACK_SET_ADMIN_ROLE_ARN"          = aws_iam_role.stackset_admin_role.arn
 
+      "STACKSET_CREATE_OPERATION_PREFERENCES" = jsonencode(var.stackset-operation-preferences.create)
+      "STACKSET_UPDATE_OPERATION_PREFERENCES" = jsonencode(var.stackset-operation-preferences.update)
+      "STACKSET_DELETE_OPERATION_PREFERENCES" = jsonencode(var.stackset-operation-preferences.delete)
+
       "FLASK_DEBUG"                  = local.quail-api-debug
       "FLASK_ENV"                    = local.quail-api-env
       "GUNICORN_WORKERS"             = 1
@@ -93,7 +93,38 @@ resource "aws_sfn_state_machine" "provision_state_machine" {
             "body.$" : "States.JsonToString($)"
           },
         },
-        "Next" : "Wait"
+        "Next" : "Wait",
+        "Catch" : [
+          {
+            "ErrorEquals" : ["States.ALL"],
+            "ResultPath" : "$.error",
+            "Next" : "Provision Failure"
+          }
+        ]
+      },
+      "Provision Failure" : {
+        "Type" : "Task",
+        "Resource" : "arn:aws:states:::lambda:invoke.waitForTaskToken",
+        "HeartbeatSeconds" : 30,
+        "Parameters" : {
+          "FunctionName" : "${aws_lambda_function.private_api.arn}:$LATEST",
+          "Payload" : {
+            "resourcePath" : "/provisionFailure",
+            "path" : "/provisionFailure",
+            "headers" : {
+              "Content-Type" : "application/json",
+              "TaskToken.$" : "$$.Task.Token"
+            },
+            "httpMethod" : "POST",
+            "body.$" : "States.JsonToString($)"
+          },
+        },
+        "Next" : "Provision Failed"
+      },
+      "Provision Failed" : {
+        "Type" : "Fail",
+        "Error" : "ProvisionFailed",
+        "Cause" : "The instances could not be created, their quota and provisioning slot were released"
       },
       "Wait" : {
         "Type" : "Task",
@@ -105,16 +136,12 @@ resource "aws_sfn_state_machine" "provision_state_machine" {
           "Payload" : {
             "resourcePath" : "/wait",
             "path" : "/wait",
-            "httpMethod" : "GET",
+            "httpMethod" : "POST",
             "headers" : {
               "Content-Type" : "application/json",
               "TaskToken.$" : "$$.Task.Token"
             },
-            "queryStringParameters" : {
-              "stackset_email.$" : "$.stackset_email",
-              "stackset_id.$" : "$..stackset_id",
-              "operation_id.$" : "$.operation_id"
-            }
+            "body.$" : "States.JsonToString($)"
           }
         },
         "ResultPath" : null,
@@ -1,6 +1,7 @@
 locals {
-  update_sfn_name    = "${var.project-name}-update-state-machine"
-  update_retry_delay = 20
+  update_sfn_name         = "${var.project-name}-update-state-machine"
+  update_retry_delay      = 20
+  update_max_check_counts = floor(var.update-timeout / local.update_retry_delay) + 1
 }
 
 # CloudWatch log group
@@ -73,9 +74,17 @@ resource "aws_sfn_state_machine" "update_state_machine" {
 
   definition = jsonencode({
     "Comment" : "Workflow for updating stacksets",
-    "StartAt" : "Wait",
+    "StartAt" : "Init",
     "States" : {
-      "Wait" : {
+      "Init" : {
+        "Type" : "Pass",
+        "Result" : { "count" : 0 },
+        "ResultPath" : "$.attempt",
+        "Next" : "Check"
+      },
+      # Checks all the monitored stacksets in one pass, finalizes the finished ones
+      # and returns the ones still being updated
+      "Check" : {
         "Type" : "Task",
         "Resource" : "arn:aws:states:::lambda:invoke.waitForTaskToken",
         "TimeoutSeconds" : 1800,
@@ -85,37 +94,23 @@ resource "aws_sfn_state_machine" "update_state_machine" {
           "Payload" : {
             "resourcePath" : "/waitForUpdateCompletion",
             "path" : "/waitForUpdateCompletion",
-            "httpMethod" : "GET",
+            "httpMethod" : "POST",
             "headers" : {
               "Content-Type" : "application/json",
               "TaskToken.$" : "$$.Task.Token"
             },
-            "queryStringParameters" : {
-              "stackset_id.$" : "$.stackset_id",
-              "update_level.$" : "$.update_level",
-              "operation_id.$" : "$.operation_id"
-            }
+            "body.$" : "States.JsonToString($)"
           }
         },
-        "ResultPath" : null,
-        "Next" : "Update Complete",
-        "Retry" : [
-          {
-            "ErrorEquals" : [
-              "StackSetUpdateInProgressException"
-            ],
-            "IntervalSeconds" : local.update_retry_delay,
-            "BackoffRate" : 1,
-            "MaxAttempts" : floor(var.update-timeout / local.update_retry_delay) + 1
-          }
-        ],
+        "ResultPath" : "$.check",
+        "Next" : "Evaluate",
         "Catch" : [
           {
-            "ErrorEquals" : [
-              "StackSetUpdateInProgressException"
-            ],
+            # Instance-level updates are resolved by EC2 state-change events, the heartbeat
+            # timeout only fires if no event has been received, in which case the state is polled again
+            "ErrorEquals" : ["States.HeartbeatTimeout"],
             "ResultPath" : null,
-            "Next" : "Update Failure"
+            "Next" : "Interval"
           },
           {
             "ErrorEquals" : ["States.ALL"],
@@ -124,24 +119,74 @@ resource "aws_sfn_state_machine" "update_state_machine" {
           }
         ]
       },
-      "Update Complete" : {
-        "Type" : "Task",
-        "Resource" : "arn:aws:states:::lambda:invoke.waitForTaskToken",
-        "HeartbeatSeconds" : 30,
-        "Parameters" : {
-          "FunctionName" : "${aws_lambda_function.private_api.arn}:$LATEST",
-          "Payload" : {
-            "resourcePath" : "/updateComplete",
-            "path" : "/updateComplete",
-            "headers" : {
-              "Content-Type" : "application/json",
-              "TaskToken.$" : "$$.Task.Token"
-            },
-            "httpMethod" : "POST",
-            "body.$" : "States.JsonToString($)"
+      "Evaluate" : {
+        "Type" : "Choice",
+        "Choices" : [
+          {
+            "And" : [
+              { "Variable" : "$.check.complete", "IsPresent" : true },
+              { "Variable" : "$.check.complete", "BooleanEquals" : true }
+            ],
+            "Next" : "Update Complete"
+          },
+          {
+            # Operations queued on the finished stacksets were started, monitor them in this same execution
+            "Variable" : "$.check.drained",
+            "IsPresent" : true,
+            "Next" : "Carry Drained"
+          },
+          {
+            "Variable" : "$.attempt.count",
+            "NumericGreaterThanEquals" : local.update_max_check_counts,
+            "Next" : "Update Failure"
           },
+          {
+            # Woken up by a state-change event, check again straight away
+            "Variable" : "$.check.recheck",
+            "IsPresent" : true,
+            "Next" : "Count"
+          },
+          {
+            "Variable" : "$.check.stacksets",
+            "IsPresent" : true,
+            "Next" : "Carry Pending"
+          }
+        ],
+        "Default" : "Interval"
+      },
+      "Carry Pending" : {
+        "Type" : "Pass",
+        "Parameters" : {
+          "update_level.$" : "$.update_level",
+          "stacksets.$" : "$.check.stacksets",
+          "attempt.$" : "$.attempt"
         },
-        "End" : true
+        "Next" : "Interval"
+      },
+      "Carry Drained" : {
+        "Type" : "Pass",
+        "Parameters" : {
+          "update_level.$" : "$.update_level",
+          "stacksets.$" : "$.check.stacksets",
+          "attempt" : { "count" : 0 }
+        },
+        "Next" : "Interval"
+      },
+      "Interval" : {
+        "Type" : "Wait",
+        "Seconds" : local.update_retry_delay,
+        "Next" : "Count"
+      },
+      "Count" : {
+        "Type" : "Pass",
+        "Parameters" : {
+          "count.$" : "States.MathAdd($.attempt.count, 1)"
+        },
+        "ResultPath" : "$.attempt",
+        "Next" : "Check"
+      },
+      "Update Complete" : {
+        "Type" : "Succeed"
       },
       "Update Failure" : {
         "Type" : "Task",
@@ -115,6 +115,54 @@ variable "instance-tags" {
   }
 }
 
+variable "warm-pool-targets" {
+  type = list(object({
+    group            = string,
+    operating-system = string,
+    account          = string,
+    region           = string,
+    instance-type    = string,
+    size             = number,
+  }))
+  default     = []
+  description = "Warm pools of stopped, pre-provisioned instances that POST /instance claims from before provisioning new ones. Each entry sets the target size of the pool for one instance configuration."
+}
+
+variable "stackset-operation-preferences" {
+  type = object({
+    create = any,
+    update = any,
+    delete = any,
+  })
+  default = {
+    create = {
+      RegionConcurrencyType   = "PARALLEL"
+      MaxConcurrentPercentage = 100
+      FailureToleranceCount   = 0
+      ConcurrencyMode         = "SOFT_FAILURE_TOLERANCE"
+    }
+    update = {
+      RegionConcurrencyType   = "PARALLEL"
+      MaxConcurrentPercentage = 100
+      FailureToleranceCount   = 0
+      ConcurrencyMode         = "SOFT_FAILURE_TOLERANCE"
+    }
+    delete = {
+      RegionConcurrencyType   = "PARALLEL"
+      MaxConcurrentPercentage = 100
+      FailureToleranceCount   = 0
+      ConcurrencyMode         = "SOFT_FAILURE_TOLERANCE"
+    }
+  }
+  description = "OperationPreferences passed to the StackSet create, update and delete operations. See https://docs.aws.amazon.com/AWSCloudFormation/latest/APIReference/API_StackSetOperationPreferences.html"
+}
+
+variable "provisioning-max-in-flight-per-account" {
+  type        = number
+  default     = 10
+  description = "Maximum number of instances being provisioned at once in each target account. Further provisioning requests are queued."
+}
+
 variable "resource-tags" {
   type        = map(string)
   default     = {}
@@ -182,3 +230,15 @@ variable "skip-resources-first-deployment" {
     the first deployment and recreated during the second deployment.
   EOF
 }
+
+variable "idempotency-key-ttl" {
+  type        = number
+  default     = 86400
+  description = "The number of seconds during which a public API mutation request can be retried with the same Idempotency-Key header and get the original response back."
+}
+
+variable "state-tombstone-ttl" {
+  type        = number
+  default     = 604800
+  description = "The number of seconds during which deleted instances are reported to clients syncing changes with GET /instance?since=. Older sync tokens expire."
+}
@@ -2,7 +2,20 @@ import { axiosInstance } from './Axios';
 
 const getParams = async () => axiosInstance.get('param');
 
-const getInstances = async () => axiosInstance.get('instance');
+// Follow the cursors of the listing, returning the instances of all pages in a single response
+const getInstances = async () => {
+  const instances = [];
+  let cursor = null;
+  let response;
+  do {
+    // eslint-disable-next-line no-await-in-loop
+    response = await axiosInstance.get('instance', { params: cursor ? { cursor } : {} });
+    instances.push(...response.data.instances);
+    cursor = response.data.next_cursor;
+  } while (cursor);
+
+  return { ...response, data: { ...response.data, instances } };
+};
 
 const deleteInstance = async ({ instanceId }) => axiosInstance.delete(`instance/${instanceId}`);
 
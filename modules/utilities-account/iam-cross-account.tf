@@ -45,7 +45,8 @@ data "aws_iam_policy_document" "cross_account_role" {
     effect = "Allow"
     actions = [
       "ec2:StopInstances",
-      "ec2:StartInstances"
+      "ec2:StartInstances",
+      "ec2:CreateTags"
     ]
     resources = ["*"]
     condition {
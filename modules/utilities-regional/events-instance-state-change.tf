@@ -0,0 +1,66 @@
+# Forward the EC2 state-change notifications of the region to the default event bus of the primary account and
+# region, where the backend picks them up. Not needed where the backend itself is deployed.
+locals {
+  forward-instance-state-changes = !(
+    data.aws_caller_identity.current.account_id == var.account-primary && data.aws_region.current.name == var.region-primary
+  )
+}
+
+resource "aws_cloudwatch_event_rule" "instance_state_change_forwarding" {
+  count = local.forward-instance-state-changes ? 1 : 0
+
+  name        = "${var.project-name}-instance-state-change-forwarding"
+  description = "Forward EC2 instance state-change notifications to the ${var.project-name} backend"
+  tags        = local.resource_tags
+
+  event_pattern = jsonencode({
+    "source" : ["aws.ec2"],
+    "detail-type" : ["EC2 Instance State-change Notification"],
+  })
+}
+
+resource "aws_iam_role" "instance_state_change_forwarding" {
+  count = local.forward-instance-state-changes ? 1 : 0
+
+  name = "${var.project-name}-event-forwarding-${data.aws_region.current.name}"
+
+  assume_role_policy = jsonencode({
+    "Version" : "2012-10-17",
+    "Statement" : [
+      {
+        "Action" : "sts:AssumeRole",
+        "Principal" : { "Service" : "events.amazonaws.com" },
+        "Effect" : "Allow"
+      }
+    ]
+  })
+
+  tags = local.resource_tags
+}
+
+resource "aws_iam_role_policy" "instance_state_change_forwarding" {
+  count = local.forward-instance-state-changes ? 1 : 0
+
+  name = "put-events"
+  role = aws_iam_role.instance_state_change_forwarding[0].id
+
+  policy = jsonencode({
+    "Version" : "2012-10-17",
+    "Statement" : [
+      {
+        "Action" : "events:PutEvents",
+        "Effect" : "Allow",
+        "Resource" : "arn:aws:events:${var.region-primary}:${var.account-primary}:event-bus/default"
+      }
+    ]
+  })
+}
+
+resource "aws_cloudwatch_event_target" "instance_state_change_forwarding" {
+  count = local.forward-instance-state-changes ? 1 : 0
+
+  rule      = aws_cloudwatch_event_rule.instance_state_change_forwarding[0].name
+  target_id = "primary-event-bus"
+  arn       = "arn:aws:events:${var.region-primary}:${var.account-primary}:event-bus/default"
+  role_arn  = aws_iam_role.instance_state_change_forwarding[0].arn
+}
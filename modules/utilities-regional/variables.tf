@@ -8,3 +8,13 @@ variable "resource-tags" {
   default     = {}
   description = "Tags to assign to resources provisioned by terraform. Apart from the listed tags, a {part_of: $${project-name}} tag is assigned to all resources."
 }
+
+variable "account-primary" {
+  type        = string
+  description = "AWS account hosting the infrastructure and the stacksets"
+}
+
+variable "region-primary" {
+  type        = string
+  description = "AWS region where the backend is deployed"
+}